@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, Optional
+
+from . import config
+from .data_loader import source_hash
+
+
+class AnswerStore:
+    """
+    Pre-generated narratives for one dataset, stored in SQLite next to it.
+
+    Answers are keyed by a content hash of the data summary they were
+    written from, so a question is served from the store only when its
+    summary is exactly the one that was warmed. The store records the
+    dataset version (source hash) it was built for and is emptied when
+    opened with a different version.
+    """
+
+    def __init__(self, path: str, version: str):
+        self.path = path
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " summary_hash TEXT PRIMARY KEY,"
+            " query TEXT NOT NULL,"
+            " question TEXT NOT NULL,"
+            " answer TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'dataset_version'").fetchone()
+        if row is None or row[0] != version:
+            self._db.execute("DELETE FROM answers")
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('dataset_version', ?)", (version,)
+            )
+        self._db.commit()
+
+    @staticmethod
+    def summary_hash(summary: Dict[str, Any]) -> str:
+        data = json.dumps(summary, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, summary: Dict[str, Any]) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT answer FROM answers WHERE summary_hash = ?", (self.summary_hash(summary),)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, summary: Dict[str, Any], query: Dict[str, Any], question: str, answer: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers (summary_hash, query, question, answer, created)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (self.summary_hash(summary), json.dumps(query), question, answer, time.time()),
+            )
+            self._db.commit()
+
+    def __contains__(self, summary: Dict[str, Any]) -> bool:
+        with self._lock:
+            return self._db.execute(
+                "SELECT 1 FROM answers WHERE summary_hash = ?", (self.summary_hash(summary),)
+            ).fetchone() is not None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            (count,) = self._db.execute("SELECT COUNT(*) FROM answers").fetchone()
+        return {"version": self.version[:12], "hits": self.hits, "misses": self.misses, "entries": count}
+
+    def close(self) -> None:
+        self._db.close()
+
+
+_active: Optional[AnswerStore] = None
+
+
+def store_path(data_path: str) -> str:
+    return data_path.rstrip(os.sep) + ".answers.sqlite"
+
+
+def open_store(data_path: str) -> AnswerStore:
+    """
+    Answer store of a dataset, for the dataset's current version.
+    """
+    return AnswerStore(store_path(data_path), source_hash(data_path))
+
+
+def activate(data_path: str) -> Optional[AnswerStore]:
+    """
+    Serve warmed answers for this dataset at question time (see lookup).
+    Does nothing if WARM_ANSWERS is off or no warm-up has been run.
+    """
+    global _active
+    store = None
+    if config.WARM_ANSWERS and os.path.exists(store_path(data_path)):
+        store = open_store(data_path)
+    # Requests still holding the previous store finish with it
+    _active = store
+    return store
+
+
+def active_store() -> Optional[AnswerStore]:
+    return _active
+
+
+def lookup(summary: Dict[str, Any]) -> Optional[str]:
+    """
+    Warmed answer for this summary, or None.
+    """
+    store = _active
+    if store is None:
+        return None
+    return store.get(summary)
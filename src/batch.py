@@ -0,0 +1,136 @@
+import csv
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Optional
+
+import pandas as pd
+
+from . import narrative, query_parser, summarizer, tracing
+
+STAGES = ["parse", "data", "narrative", "total"]
+
+
+def read_questions(path: str) -> List[Dict[str, Any]]:
+    """
+    Read questions from a .jsonl file (objects with a "question" key and
+    optional "id", or bare JSON strings) or a .csv file with a "question"
+    column and optional "id" column.
+    Returns a list of {"id", "question"} dicts.
+    """
+    items = []
+    if path.endswith(".jsonl"):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                row = json.loads(line)
+                if isinstance(row, str):
+                    row = {"question": row}
+                items.append(row)
+    elif path.endswith(".csv"):
+        with open(path, newline="") as f:
+            items = [row for row in csv.DictReader(f) if row.get("question")]
+    else:
+        raise ValueError("Unsupported question file; use .jsonl or .csv")
+
+    return [
+        {"id": row.get("id", i), "question": row["question"]}
+        for i, row in enumerate(items)
+    ]
+
+
+def run_batch(
+    df: pd.DataFrame,
+    questions: List[Dict[str, Any]],
+    out_path: str,
+    concurrency: int = 4,
+    vocab: Optional[Dict[str, Any]] = None,
+    index=None,
+    cube=None,
+) -> Dict[str, Any]:
+    """
+    Answer many questions against one loaded table.
+
+    Questions move through parse -> filter/summarize -> narrative as a
+    pipeline: at most `concurrency` LLM requests are in flight at once,
+    while the pandas stage runs one question at a time alongside them.
+    Results are appended to out_path as JSONL in completion order, with
+    progress, throughput and per-stage latency printed as it runs.
+    Returns the run statistics.
+    """
+    llm_slots = threading.BoundedSemaphore(concurrency)
+    data_lock = threading.Lock()
+    timings: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+
+    def process(item: Dict[str, Any]) -> Dict[str, Any]:
+        with tracing.trace(item["question"]):
+            t0 = time.perf_counter()
+            with llm_slots:
+                query, source = query_parser.parse_question(item["question"], vocab)
+            t1 = time.perf_counter()
+            with data_lock:
+                summary = summarizer.summarize_query(df, query, index, cube)
+            t2 = time.perf_counter()
+            with llm_slots:
+                answer = narrative.llm_generate_answer(item["question"], query, summary)
+            t3 = time.perf_counter()
+
+        return {
+            "id": item["id"],
+            "question": item["question"],
+            "query": query,
+            "parse_source": source,
+            "has_data": summary["has_data"],
+            "answer": answer,
+            "timings": {"parse": t1 - t0, "data": t2 - t1, "narrative": t3 - t2, "total": t3 - t0},
+        }
+
+    start = time.perf_counter()
+    n_done = n_failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency * 2) as pool, open(out_path, "w") as out:
+        futures = {pool.submit(process, item): item for item in questions}
+        for fut in as_completed(futures):
+            item = futures[fut]
+            try:
+                record = fut.result()
+                for stage in STAGES:
+                    timings[stage].append(record["timings"][stage])
+            except Exception as e:
+                record = {"id": item["id"], "question": item["question"], "error": str(e)}
+                n_failed += 1
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+
+            n_done += 1
+            elapsed = time.perf_counter() - start
+            # Running p50 per stage, so slow stages show up mid-run
+            latency = ", ".join(
+                f"{stage} {tracing.percentile(timings[stage], 50, 0.0) * 1e3:.0f} ms"
+                for stage in STAGES
+            )
+            print(
+                f"[{n_done}/{len(questions)}] {n_done / elapsed:.2f} questions/s, "
+                f"{n_failed} failed | p50 {latency}",
+                flush=True,
+            )
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "questions": len(questions),
+        "failed": n_failed,
+        "elapsed_s": elapsed,
+        "throughput_qps": len(questions) / elapsed if elapsed else 0.0,
+        "stages": {
+            stage: {"p50_s": tracing.percentile(v, 50, 0.0), "p95_s": tracing.percentile(v, 95, 0.0)}
+            for stage, v in timings.items()
+        },
+    }
+
+    print(f"\nAnswered {len(questions) - n_failed}/{len(questions)} questions in {elapsed:.1f} s "
+          f"({stats['throughput_qps']:.2f} questions/s), results in {out_path}")
+    for stage, p in stats["stages"].items():
+        print(f"  {stage:<10} p50 {p['p50_s'] * 1e3:8.1f} ms   p95 {p['p95_s'] * 1e3:8.1f} ms")
+    return stats
@@ -0,0 +1,418 @@
+"""
+Benchmarks for the pipeline, run on synthetic WHO-style prevalence
+tables and a local Ollama stub (src.llm_stub).
+
+Usage:
+  python -m src.benchmark suite --sizes 10000,100000,1000000,10000000 --out bench.json
+  python -m src.benchmark summarize --rows 5000000
+  python -m src.benchmark client --calls 200
+  python -m src.benchmark memory --rows 1000000
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+import pandas as pd
+import requests
+
+from . import config, main as pipeline, narrative, summarizer
+from .data_loader import load_data, normalize_table
+from .index import PrevalenceIndex
+from .llm_client import OllamaClient
+from .llm_stub import start_stub
+
+# Malaria-endemic countries, so generated questions read like real ones
+COUNTRY_NAMES = [
+    "Angola", "Benin", "Burkina Faso", "Burundi", "Cambodia", "Cameroon",
+    "Central African Republic", "Chad", "Congo", "Democratic Republic of the Congo",
+    "Equatorial Guinea", "Eritrea", "Ethiopia", "Gabon", "Gambia", "Ghana", "Guinea",
+    "Guinea-Bissau", "Kenya", "Laos", "Liberia", "Madagascar", "Malawi", "Mali",
+    "Mozambique", "Myanmar", "Niger", "Nigeria", "Rwanda", "Senegal", "Sierra Leone",
+    "Somalia", "South Sudan", "Sudan", "Tanzania", "Thailand", "Togo", "Uganda",
+    "Vietnam", "Zambia",
+]
+
+
+def make_synthetic_prevalence(
+    n_rows: int,
+    n_countries: int = 40,
+    n_sites: int = 3000,
+    n_mutations: int = 30,
+    n_studies: int = 800,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Build a table with the columns load_data returns. Sites belong to one
+    country and studies to one publication year, as in the WHO table.
+    """
+    rng = np.random.default_rng(seed)
+
+    countries = np.array(
+        [COUNTRY_NAMES[i] if i < len(COUNTRY_NAMES) else f"Country{i}" for i in range(n_countries)],
+        dtype=object,
+    )
+    sites = np.array([f"Site{i}" for i in range(n_sites)], dtype=object)
+    site_country = rng.integers(0, n_countries, n_sites)
+    positions = rng.choice(np.arange(400, 730), n_mutations, replace=False)
+    aas = rng.choice(list("ACDEFGHIKLMNPQRSTVWY"), n_mutations)
+    mutations = np.array([f"{p}{a}" for p, a in zip(positions, aas)], dtype=object)
+    study_pub = rng.integers(2005, 2024, n_studies)
+
+    site = rng.integers(0, n_sites, n_rows)
+    mutation = rng.integers(0, n_mutations, n_rows)
+    study = rng.integers(0, n_studies, n_rows)
+
+    return pd.DataFrame({
+        "country": countries[site_country[site]],
+        "site": sites[site],
+        "year": rng.integers(2000, 2024, n_rows),
+        "gene": "k13",
+        "position": np.array([str(p) for p in positions], dtype=object)[mutation],
+        "aa": aas[mutation].astype(object),
+        "mutation": mutations[mutation],
+        "prevalence": rng.random(n_rows).round(3),
+        "n_samples": rng.integers(1, 300, n_rows),
+        "study_id": study,
+        "authors": np.array([f"Author{i} et al." for i in range(n_studies)], dtype=object)[study],
+        "year_pub": study_pub[study],
+        "url": np.array([f"https://example.org/study/{i}" for i in range(n_studies)], dtype=object)[study],
+    })
+
+
+def to_raw_export(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert a make_synthetic_prevalence table back to the WHO export
+    layout (gene:position:aa labels, original column names), so load_data
+    does its full normalization when reading it.
+    """
+    return pd.DataFrame({
+        "country_name": df["country"],
+        "site_name": df["site"],
+        "year": df["year"],
+        "mutation": df["gene"] + ":" + df["position"] + ":" + df["aa"],
+        "prevalence": df["prevalence"],
+        "denominator": df["n_samples"],
+        "study_id": df["study_id"],
+        "authors": df["authors"],
+        "publication_year": df["year_pub"],
+        "url": df["url"],
+    })
+
+
+def _time(fn, *args, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_summarize(n_rows: int, repeat: int = 3) -> Dict[str, Any]:
+    """
+    Time the summary of a broad query (one mutation, every country) over
+    a synthetic table, from a subset table and from row positions.
+    """
+    df = make_synthetic_prevalence(n_rows)
+    query = {"mutation": df["mutation"].iloc[0]}
+    subset = summarizer.filter_data(df, query)
+    positions = summarizer.select_rows(df, query)
+
+    return {
+        "rows": n_rows,
+        "subset_rows": len(subset),
+        "subset_s": _time(summarizer.summarize_prevalence, subset, repeat=repeat),
+        "positions_s": _time(summarizer.summarize_rows, df, positions, repeat=repeat),
+    }
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    return {
+        "p50_s": float(np.percentile(values, 50)),
+        "p95_s": float(np.percentile(values, 95)),
+        "mean_s": float(np.mean(values)),
+    }
+
+
+def bench_pipeline(
+    n_rows: int,
+    workdir: str,
+    latency: float = 0.2,
+    n_questions: int = 10,
+    repeat: int = 3,
+) -> Dict[str, Any]:
+    """
+    Time each stage on a synthetic WHO export of n_rows rows written to
+    workdir (reused if already there), then answer n_questions questions
+    end to end through main.answer_question against the Ollama stub.
+    """
+    path = os.path.join(workdir, f"prevalence_{n_rows}.csv")
+    if not os.path.exists(path):
+        to_raw_export(make_synthetic_prevalence(n_rows)).to_csv(path, index=False)
+    result: Dict[str, Any] = {"rows": n_rows, "file_mb": os.path.getsize(path) / 1e6}
+
+    # Loading prints its own report; keep the benchmark output readable
+    quiet = contextlib.redirect_stdout(io.StringIO())
+
+    with quiet:
+        start = time.perf_counter()
+        df = load_data(path, use_snapshot=False)
+        result["load_source_s"] = time.perf_counter() - start
+        load_data(path)  # make sure a snapshot exists
+        result["load_snapshot_s"] = _time(load_data, path, repeat=repeat)
+    result["memory_mb"] = df.memory_usage(deep=True).sum() / 1e6
+
+    # The most common (country, mutation) pair: a typical narrow question
+    pairs = df.groupby(["country", "mutation"], observed=True).size().sort_values(ascending=False)
+    country, mutation = pairs.index[0]
+    narrow = {"country": country, "mutation": mutation, "year_min": None, "year_max": None}
+    broad = {"country": None, "mutation": mutation, "year_min": None, "year_max": None}
+
+    start = time.perf_counter()
+    index = PrevalenceIndex(df)
+    result["index_build_s"] = time.perf_counter() - start
+    result["filter_scan_s"] = _time(summarizer.filter_data, df, narrow, repeat=repeat)
+    result["filter_index_s"] = _time(summarizer.filter_data, df, narrow, index, repeat=repeat)
+
+    narrow_subset = summarizer.filter_data(df, narrow, index)
+    broad_subset = summarizer.filter_data(df, broad, index)
+    result["narrow_rows"] = len(narrow_subset)
+    result["broad_rows"] = len(broad_subset)
+    result["summarize_narrow_s"] = _time(summarizer.summarize_prevalence, narrow_subset, repeat=repeat)
+    result["summarize_broad_s"] = _time(summarizer.summarize_prevalence, broad_subset, repeat=repeat)
+
+    summary = summarizer.summarize_prevalence(broad_subset)
+    question = f"How has {mutation} prevalence changed over time?"
+    with quiet:
+        result["prompt_build_s"] = _time(narrative.build_prompt, question, broad, summary, repeat=repeat)
+        _, user_msg = narrative.build_prompt(question, broad, summary)
+    result["prompt_tokens"] = narrative.estimate_tokens(narrative.NARRATIVE_SYSTEM_MSG + user_msg)
+
+    # End to end against the stub, with the app's own startup path
+    questions = [
+        f"How has {m} prevalence changed over time in {c}?" if i % 2 == 0
+        else f"Which sites in {c} report the {m} mutation after 2015?"
+        for i, (c, m) in enumerate(pairs.index[:n_questions])
+    ]
+    server, url = start_stub(latency=latency)
+    saved = (config.OLLAMA_URL, config.LLM_CACHE_ENABLED, config._client)
+    config.OLLAMA_URL, config.LLM_CACHE_ENABLED, config._client = url, False, None
+    try:
+        with quiet:
+            start = time.perf_counter()
+            df, vocab, index, cube = pipeline.load_dataset(path)
+            result["startup_s"] = time.perf_counter() - start
+
+            times = []
+            for q in questions:
+                start = time.perf_counter()
+                pipeline.answer_question(df, q, vocab, index, cube)
+                times.append(time.perf_counter() - start)
+        result["answer"] = {"questions": len(questions), "stub_latency_s": latency, **_percentiles(times)}
+        result["answer"]["overhead_p50_s"] = result["answer"]["p50_s"] - server.requests / len(questions) * latency
+    finally:
+        config.get_client().close()
+        config.OLLAMA_URL, config.LLM_CACHE_ENABLED, config._client = saved
+        server.shutdown()
+        server.server_close()
+    return result
+
+
+def _environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, cwd=os.path.dirname(__file__),
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_suite(
+    sizes: List[int],
+    out_path: str,
+    latency: float = 0.2,
+    n_questions: int = 10,
+    workdir: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Run bench_pipeline for each table size and write the results, with
+    the library versions and git commit, to out_path as JSON.
+    """
+    report = {"environment": _environment(), "results": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_rows in sizes:
+            print(f"Benchmarking {n_rows} rows...", flush=True)
+            r = bench_pipeline(n_rows, workdir or tmp, latency, n_questions)
+            report["results"].append(r)
+            print(
+                f"  load {r['load_source_s']:.2f} s (snapshot {r['load_snapshot_s']:.3f} s), "
+                f"filter {r['filter_scan_s'] * 1e3:.1f} ms (index {r['filter_index_s'] * 1e3:.2f} ms), "
+                f"summarize {r['summarize_broad_s'] * 1e3:.1f} ms, "
+                f"prompt {r['prompt_build_s'] * 1e3:.2f} ms, "
+                f"answer p50 {r['answer']['p50_s']:.3f} s"
+            )
+
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {out_path}")
+    return report
+
+
+def _peak_mb(fn, *args) -> float:
+    """
+    Peak memory traced while fn runs, in MB.
+    """
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1e6
+
+
+def _summarize_copy(df: pd.DataFrame, query: Dict[str, Any], index: PrevalenceIndex) -> Dict[str, Any]:
+    # The original path: a scanned subset copied out of the table, then
+    # summarized (index unused)
+    subset = summarizer.filter_data(df, query).copy()
+    return summarizer.summarize_prevalence(subset, summarizer.is_comparison(query))
+
+
+def bench_memory(n_rows: int, n_questions: int = 20) -> Dict[str, Any]:
+    """
+    tracemalloc peak per question for the filter + summary step: through
+    a copied subset table (the original df[mask].copy() path) and through
+    summarize_query (index positions, no subset), on a loaded-form
+    synthetic table. Questions
+    alternate between one pair, one mutation everywhere, one country and
+    a three-country comparison.
+    """
+    df = normalize_table(to_raw_export(make_synthetic_prevalence(n_rows)))
+    index = PrevalenceIndex(df)
+    countries = df["country"].value_counts().index.tolist()
+    mutations = df["mutation"].value_counts().index.tolist()
+    shapes = [
+        lambda i: {"country": countries[i % len(countries)], "mutation": mutations[i % len(mutations)]},
+        lambda i: {"mutation": mutations[i % len(mutations)]},
+        lambda i: {"country": countries[i % len(countries)]},
+        lambda i: {"country": countries[i % 3:i % 3 + 3], "mutation": mutations[i % len(mutations)]},
+    ]
+    queries = [shapes[i % len(shapes)](i) for i in range(n_questions)]
+
+    result: Dict[str, Any] = {"rows": n_rows, "questions": n_questions}
+    for name, fn in [("copy", _summarize_copy), ("summarize_query", summarizer.summarize_query)]:
+        peaks = [_peak_mb(fn, df, q, index) for q in queries]
+        times = []
+        for q in queries:
+            start = time.perf_counter()
+            fn(df, q, index)
+            times.append(time.perf_counter() - start)
+        result[name] = {
+            "peak_mb_p50": float(np.percentile(peaks, 50)),
+            "peak_mb_max": max(peaks),
+            **_percentiles(times),
+        }
+    return result
+
+
+def bench_client(n_calls: int = 200, latency: float = 0.0) -> Dict[str, Any]:
+    """
+    Per-call overhead of a fresh connection per request (the old
+    requests.post) versus the pooled OllamaClient, against the local stub.
+    """
+    server, url = start_stub(latency=latency, words=20)
+    messages = [{"role": "system", "content": "Be brief."}, {"role": "user", "content": "675V in Uganda"}]
+    payload = {"model": "stub", "messages": messages, "stream": False}
+    try:
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            requests.post(url + "/api/chat", json=payload).json()
+        unpooled = (time.perf_counter() - start) / n_calls
+
+        client = OllamaClient(url)
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            client.chat("stub", messages)
+        pooled = (time.perf_counter() - start) / n_calls
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return {"calls": n_calls, "unpooled_ms": unpooled * 1e3, "pooled_ms": pooled * 1e3}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("suite", help="stage timings and end-to-end answers at several table sizes")
+    p.add_argument("--sizes", default="10000,100000,1000000,10000000", help="comma-separated row counts")
+    p.add_argument("--latency", type=float, default=0.2, help="stub delay per LLM call (s)")
+    p.add_argument("--questions", type=int, default=10)
+    p.add_argument("--workdir", help="keep generated tables here and reuse them across runs")
+    p.add_argument("--out", default="benchmark.json")
+
+    p = sub.add_parser("summarize", help="summary time on a broad query")
+    p.add_argument("--rows", type=int, default=5_000_000)
+    p.add_argument("--repeat", type=int, default=3)
+
+    p = sub.add_parser("client", help="pooled vs. unpooled HTTP calls against the Ollama stub")
+    p.add_argument("--calls", type=int, default=200)
+    p.add_argument("--latency", type=float, default=0.0)
+
+    p = sub.add_parser("memory", help="tracemalloc peak per question of the filter + summary step")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--questions", type=int, default=20)
+
+    args = parser.parse_args()
+
+    if args.command == "suite":
+        sizes = [int(n) for n in args.sizes.split(",")]
+        run_suite(sizes, args.out, args.latency, args.questions, args.workdir)
+
+    elif args.command == "summarize":
+        result = bench_summarize(args.rows, args.repeat)
+        print(f"Summary of {result['subset_rows']} of {result['rows']} rows")
+        print(f"  from subset table:   {result['subset_s']:.3f} s")
+        print(f"  from row positions:  {result['positions_s']:.3f} s")
+
+    elif args.command == "client":
+        result = bench_client(args.calls, args.latency)
+        print(f"{result['calls']} calls against the Ollama stub")
+        print(f"  new connection per call: {result['unpooled_ms']:.2f} ms/call")
+        print(f"  pooled client:           {result['pooled_ms']:.2f} ms/call")
+
+    elif args.command == "memory":
+        result = bench_memory(args.rows, args.questions)
+        print(f"Filter + summary, {result['questions']} questions on {result['rows']} rows")
+        for name in ("copy", "summarize_query"):
+            r = result[name]
+            print(
+                f"  {name:<16} peak p50 {r['peak_mb_p50']:7.1f} MB, max {r['peak_mb_max']:7.1f} MB, "
+                f"time p50 {r['p50_s'] * 1e3:7.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
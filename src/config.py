@@ -1,33 +1,392 @@
-import requests
+import json
 import os
+import threading
+import time
+from typing import Callable, Dict, Any, Iterable, List, Optional, Tuple
+
+from . import llm_dispatch, tracing
+from .llm_cache import LLMCache
+from .llm_client import AsyncOllamaClient, OllamaClient
 
 # Path to data table
-DATA_PATH = "data/raw/all_who_get_prevalence.csv"  # or .parquet
+DATA_PATH = "data/raw/all_who_get_prevalence.csv"  # or .parquet, or a partitioned dataset directory
+
+# Cache the normalized table next to DATA_PATH and memory-map it on later runs
+USE_SNAPSHOT = True
+
+# Stream the source in chunks instead of loading it into memory
+# (for tables larger than RAM); CHUNK_ROWS bounds peak memory
+STREAMING = False
+CHUNK_ROWS = 200_000
+
+# Answer summaries from a pre-aggregated cube stored next to DATA_PATH
+# (rebuilt automatically when the source file changes)
+USE_SUMMARY_CUBE = True
 
 # Deine LLM Model
 LLM_MODEL = "llama3"
 
-def call_llm(system_prompt: str, user_prompt: str) -> str:
+# Model per pipeline step (None: LLM_MODEL); the parse step is short and
+# can use a smaller, faster model than the narrative
+PARSE_MODEL = None
+NARRATIVE_MODEL = None
+
+# Print the narrative token by token as it is generated
+STREAM_ANSWERS = True
+
+# Size limit for the data summary in the narrative prompt (approximate
+# tokens). Larger summaries keep the top sites/studies by sample size and
+# collapse the rest into one aggregate row each.
+NARRATIVE_SUMMARY_TOKENS = 2000
+NARRATIVE_TOP_SITES = 15
+NARRATIVE_TOP_STUDIES = 10
+# Comparison summaries over the limit first pool their per-(country,
+# mutation, year) cells into periods of these many years, then leave them
+# out, before sites and studies are cut further
+NARRATIVE_CELL_PERIODS = (2, 5, 10)
+
+# Ollama server and HTTP client settings
+OLLAMA_URL = "http://localhost:11434"
+LLM_CONNECT_TIMEOUT = 5.0    # seconds to establish a connection
+LLM_READ_TIMEOUT = 300.0     # seconds to wait for a response
+LLM_MAX_RETRIES = 2          # retries on connection errors, timeouts and 5xx
+LLM_RETRY_BACKOFF = 0.5      # first retry delay in seconds, doubled each retry
+LLM_KEEP_ALIVE = "30m"       # keep the model loaded between questions (None: Ollama default)
+LLM_POOL_SIZE = 10           # pooled connections (raise for concurrent batch runs)
+
+# Several Ollama instances to spread calls over, e.g.
+#   [{"url": "http://localhost:11434"},
+#    {"url": "http://localhost:11435", "models": ["llama3"], "max_in_flight": 2}]
+# "models" lists the models an instance serves (default: all). Empty: only OLLAMA_URL.
+LLM_BACKENDS: List[Dict[str, Any]] = []
+LLM_BACKEND_MAX_IN_FLIGHT = 4  # requests sent to one instance at a time
+LLM_BACKEND_COOLDOWN = 30.0    # seconds a failed instance is skipped while others work
+
+# Persistent cache of LLM replies, keyed by model + system + user prompt
+LLM_CACHE_ENABLED = True
+LLM_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "malaria-genomics-llm", "llm_cache.sqlite")
+LLM_CACHE_MAX_ENTRIES = 10_000
+LLM_CACHE_MAX_MB = 100
+LLM_CACHE_MAX_AGE_DAYS = 30
+
+# While the LLM parses a question, summarize a local guess of the query in
+# the background and use it if the parse agrees (src.speculate)
+SPECULATIVE_PARSE = False
+SPECULATIVE_WORKERS = 2
+
+# Query parsing: the reply is constrained to QUERY_SCHEMA (Ollama's format
+# option), sampled greedily and capped at this many tokens
+PARSE_NUM_PREDICT = 96
+PARSE_TEMPERATURE = 0.0
+
+# Answer questions from narratives generated ahead of time by src.warmup
+# when the question's data summary matches a warmed one
+WARM_ANSWERS = True
+
+# Write one JSON line per pipeline stage (src.tracing) to this file; None disables
+TRACE_LOG_PATH = None
+
+_client = None
+_async_client = None
+_dispatcher = None
+_dispatcher_spec = None
+_cache = None
+_init_lock = threading.Lock()
+
+# Ollama's timing fields summed over all uncached calls (durations in s).
+# prompt_eval covers the input prompt; Ollama skips re-evaluating a prefix
+# it still holds from the previous call, so a stable system prompt and
+# keep_alive show up here as lower prompt_eval time.
+LLM_TIMINGS = {"calls": 0, "prompt_tokens": 0, "prompt_eval_s": 0.0, "eval_tokens": 0, "eval_s": 0.0, "load_s": 0.0}
+_timings_lock = threading.Lock()
+_last_timings = threading.local()
+
+
+def get_client() -> OllamaClient:
+    """
+    Shared pooled client, created on first use from the settings above.
+    """
+    global _client
+    with _init_lock:
+        if _client is None:
+            _client = OllamaClient(
+                OLLAMA_URL,
+                connect_timeout=LLM_CONNECT_TIMEOUT,
+                read_timeout=LLM_READ_TIMEOUT,
+                max_retries=LLM_MAX_RETRIES,
+                backoff=LLM_RETRY_BACKOFF,
+                keep_alive=LLM_KEEP_ALIVE,
+                pool_size=LLM_POOL_SIZE,
+            )
+    return _client
+
+
+def get_async_client() -> AsyncOllamaClient:
+    """
+    Shared asyncio client (see get_client), created on first use.
+    """
+    global _async_client
+    with _init_lock:
+        if _async_client is None:
+            _async_client = AsyncOllamaClient(
+                OLLAMA_URL,
+                connect_timeout=LLM_CONNECT_TIMEOUT,
+                read_timeout=LLM_READ_TIMEOUT,
+                max_retries=LLM_MAX_RETRIES,
+                backoff=LLM_RETRY_BACKOFF,
+                keep_alive=LLM_KEEP_ALIVE,
+                pool_size=LLM_POOL_SIZE,
+            )
+    return _async_client
+
+
+def _backend_clients(url: str) -> Tuple[Callable[[], OllamaClient], Callable[[], AsyncOllamaClient]]:
+    # Failover replaces retries on the same instance
+    settings = dict(
+        connect_timeout=LLM_CONNECT_TIMEOUT,
+        read_timeout=LLM_READ_TIMEOUT,
+        max_retries=0,
+        keep_alive=LLM_KEEP_ALIVE,
+        pool_size=LLM_POOL_SIZE,
+    )
+    client = OllamaClient(url, **settings)
+    async_client = AsyncOllamaClient(url, **settings)
+    return (lambda: client), (lambda: async_client)
+
+
+def get_dispatcher() -> "llm_dispatch.LLMDispatcher":
     """
-    Call a local Ollama model running at http://localhost:11434.
-    Uses the /api/chat endpoint with a system + user message.
+    Shared dispatcher over LLM_BACKENDS, or over OLLAMA_URL alone (using
+    the shared clients above) when none are configured. Rebuilt when
+    either setting changes.
     """
-    url = "http://localhost:11434/api/chat"
-    payload = {
-        "model": LLM_MODEL,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        "stream": False,
-    }
+    global _dispatcher, _dispatcher_spec
+    spec = repr((OLLAMA_URL, LLM_BACKENDS))
+    with _init_lock:
+        if _dispatcher is None or _dispatcher_spec != spec:
+            if LLM_BACKENDS:
+                backends = [
+                    llm_dispatch.Backend(
+                        b["url"],
+                        *_backend_clients(b["url"]),
+                        max_in_flight=b.get("max_in_flight", LLM_BACKEND_MAX_IN_FLIGHT),
+                        models=b.get("models"),
+                    )
+                    for b in LLM_BACKENDS
+                ]
+                attempts = max(len(backends), LLM_MAX_RETRIES + 1)
+            else:
+                # One instance: the client retries itself, nothing to fail over to
+                backends = [llm_dispatch.Backend(OLLAMA_URL, get_client, get_async_client, max_in_flight=None)]
+                attempts = 1
+            _dispatcher = llm_dispatch.LLMDispatcher(
+                backends,
+                attempts=attempts,
+                cooldown=LLM_BACKEND_COOLDOWN,
+                queue_timeout=LLM_READ_TIMEOUT,
+                backoff=LLM_RETRY_BACKOFF,
+            )
+            _dispatcher_spec = spec
+    return _dispatcher
 
-    resp = requests.post(url, json=payload)
 
-    if resp.status_code != 200:
-        # Print Ollama's error message for debugging
-        print("Ollama error:", resp.status_code, resp.text)
-        resp.raise_for_status()
+def model_for(role: str) -> str:
+    """
+    Model used for a pipeline step ("parse" or "narrative").
+    """
+    model = {"parse": PARSE_MODEL, "narrative": NARRATIVE_MODEL}.get(role)
+    return model or LLM_MODEL
+
+
+def get_cache() -> LLMCache:
+    """
+    Shared reply cache, opened on first use from the settings above.
+    """
+    global _cache
+    with _init_lock:
+        if _cache is None:
+            _cache = LLMCache(
+                LLM_CACHE_PATH,
+                max_entries=LLM_CACHE_MAX_ENTRIES,
+                max_bytes=LLM_CACHE_MAX_MB * 1024 * 1024,
+                max_age_s=LLM_CACHE_MAX_AGE_DAYS * 24 * 3600,
+            )
+    return _cache
+
+
+def _record_timings(data: Optional[Dict[str, Any]], span: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Extract Ollama's timing fields from a response (None for a cache hit),
+    add them to LLM_TIMINGS and the tracing span, and remember them for
+    last_call_timings().
+    """
+    timings = None
+    if data is not None:
+        timings = {
+            "prompt_tokens": data.get("prompt_eval_count", 0),
+            "prompt_eval_s": data.get("prompt_eval_duration", 0) / 1e9,
+            "eval_tokens": data.get("eval_count", 0),
+            "eval_s": data.get("eval_duration", 0) / 1e9,
+            "load_s": data.get("load_duration", 0) / 1e9,
+        }
+        with _timings_lock:
+            LLM_TIMINGS["calls"] += 1
+            for name, value in timings.items():
+                LLM_TIMINGS[name] += value
+        span.update(timings)
+    span["cached"] = data is None
+    _last_timings.value = timings
+    return timings
+
+
+def last_call_timings() -> Optional[Dict[str, Any]]:
+    """
+    Timings of the most recent LLM call made from this thread: prompt
+    tokens and prompt_eval_s, generated tokens and eval_s, model load_s.
+    None if that call was answered from the cache.
+    """
+    return getattr(_last_timings, "value", None)
+
+
+def _messages(system_prompt: str, user_prompt: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def _cache_key(model: str, system_prompt: str, user_prompt: str, extra: Dict[str, Any]) -> str:
+    # Output format and sampling options change the reply
+    if extra:
+        model = model + json.dumps(extra, sort_keys=True)
+    return LLMCache.make_key(model, system_prompt, user_prompt)
+
+
+def _llm_span(model: str, system_prompt: str, user_prompt: str):
+    return tracing.span("llm", model=model, prompt_chars=len(system_prompt) + len(user_prompt))
+
+
+def _lookup(
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    use_cache: bool,
+    extra: Dict[str, Any],
+    span: Dict[str, Any],
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    (cache key, cached reply) for an LLM call; the key is None when the
+    cache is not used and the reply None when the model has to answer.
+    """
+    if not (use_cache and LLM_CACHE_ENABLED):
+        return None, None
+    key = _cache_key(model, system_prompt, user_prompt, extra)
+    cached = get_cache().get(key)
+    if cached is not None:
+        _record_timings(None, span)
+        span["response_chars"] = len(cached)
+    return key, cached
+
+
+def _store(data: Dict[str, Any], span: Dict[str, Any], key: Optional[str], tags: Iterable[str]) -> str:
+    """
+    Reply text of an Ollama response, with its timings recorded and the
+    text cached under key (if not None).
+    """
+    _record_timings(data, span)
+    answer = data["message"]["content"].strip()
+    span["response_chars"] = len(answer)
+    if key is not None:
+        get_cache().put(key, answer, tags)
+    return answer
+
+
+def cached_reply_stats(start: float) -> Dict[str, Any]:
+    """
+    Streaming stats (see call_llm_stream) for a reply that was passed on
+    in one piece without calling the model.
+    """
+    elapsed = time.perf_counter() - start
+    return {"ttft_s": elapsed, "tokens_per_second": 0.0, "total_s": elapsed, "cached": True}
+
+
+def call_llm(
+    system_prompt: str,
+    user_prompt: str,
+    use_cache: bool = True,
+    tags: Iterable[str] = (),
+    role: str = "narrative",
+    **extra: Any,
+) -> str:
+    """
+    Call the local Ollama model for a pipeline step (model_for(role)) on
+    OLLAMA_URL or the least-loaded of LLM_BACKENDS.
+    Uses the /api/chat endpoint with a system + user message; extra
+    request fields (e.g. format, options) are passed to Ollama.
+    Replies are served from / stored in the persistent cache unless
+    use_cache is False or LLM_CACHE_ENABLED is off; tags are stored with
+    the reply so it can be invalidated later (LLMCache.invalidate).
+    """
+    model = model_for(role)
+    with _llm_span(model, system_prompt, user_prompt) as span:
+        key, cached = _lookup(model, system_prompt, user_prompt, use_cache, extra, span)
+        if cached is not None:
+            return cached
+        data, span["backend"] = get_dispatcher().chat(model, _messages(system_prompt, user_prompt), **extra)
+        return _store(data, span, key, tags)
+
+
+async def acall_llm(
+    system_prompt: str,
+    user_prompt: str,
+    use_cache: bool = True,
+    tags: Iterable[str] = (),
+    role: str = "narrative",
+    **extra: Any,
+) -> str:
+    """
+    asyncio version of call_llm, sharing the same reply cache.
+    """
+    model = model_for(role)
+    with _llm_span(model, system_prompt, user_prompt) as span:
+        key, cached = _lookup(model, system_prompt, user_prompt, use_cache, extra, span)
+        if cached is not None:
+            return cached
+        data, span["backend"] = await get_dispatcher().achat(model, _messages(system_prompt, user_prompt), **extra)
+        return _store(data, span, key, tags)
+
+
+def call_llm_stream(
+    system_prompt: str,
+    user_prompt: str,
+    on_token: Callable[[str], None],
+    use_cache: bool = True,
+    tags: Iterable[str] = (),
+    role: str = "narrative",
+    **extra: Any,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Like call_llm, but streams the reply: on_token is called with each
+    token as it arrives (a cached reply is passed in one piece).
+    Returns (full_text, stats) where stats has ttft_s, tokens_per_second,
+    total_s and cached, plus the last_call_timings() fields when the
+    reply came from the model.
+    """
+    model = model_for(role)
+    with _llm_span(model, system_prompt, user_prompt) as span:
+        start = time.perf_counter()
+        key, cached = _lookup(model, system_prompt, user_prompt, use_cache, extra, span)
+        if cached is not None:
+            on_token(cached)
+            return cached, cached_reply_stats(start)
 
-    data = resp.json()
-    return data["message"]["content"].strip()
\ No newline at end of file
+        data, span["backend"] = get_dispatcher().chat_stream(model, _messages(system_prompt, user_prompt), on_token, **extra)
+        span["ttft_s"] = data["ttft_s"]
+        answer = _store(data, span, key, tags)
+        return answer, {
+            "ttft_s": data["ttft_s"],
+            "tokens_per_second": data["tokens_per_second"],
+            "total_s": time.perf_counter() - start,
+            "cached": False,
+            **last_call_timings(),
+        }
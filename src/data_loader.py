@@ -1,19 +1,81 @@
+import glob
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Any, Iterator, List, Optional
+
+import numpy as np
 import pandas as pd
 
-from . import config
+from . import config, summarizer
+
+try:
+    import pyarrow  # noqa: F401  (needed for snapshots and Parquet)
+    _HAVE_PYARROW = True
+except ImportError:
+    _HAVE_PYARROW = False
+
+# Bump when normalize_table changes so old snapshots are not reused
+LOADER_VERSION = 1
+
+# Directory levels of a partitioned dataset (see write_partitioned)
+PARTITION_COLS = ["gene", "mutation", "country_key"]
+
+# Repeated strings stored as categoricals
+CATEGORICAL_COLS = ["country", "site", "gene", "position", "aa", "mutation", "authors", "url"]
+
+# Bump when the cube layout changes so stale cubes are rebuilt
+CUBE_VERSION = 1
 
-def load_data(path: str) -> pd.DataFrame:
+# (country, mutation, year) plus the site or study dimension. Year is kept
+# in both so that year-range queries can be answered from the cube.
+CUBE_SITE_KEYS = ["country", "mutation", "year", "site"]
+CUBE_STUDY_KEYS = ["country", "mutation", "year", "study_id", "authors", "year_pub"]
+
+def _read_source(path: str) -> pd.DataFrame:
+    if os.path.isdir(path):
+        return ChunkedSource(path).to_frame()
     if path.endswith(".csv"):
-        df = pd.read_csv(path)
+        return pd.read_csv(path)
     elif path.endswith(".parquet"):
-        df = pd.read_parquet(path)
+        return pd.read_parquet(path)
     else:
         raise ValueError("Unsupported file type; use .csv or .parquet")
-    
+
+
+def _categorical_parts(values: pd.Series) -> pd.DataFrame:
+    """
+    Split 'gene:position:aa' labels into gene/position/aa/mutation
+    categoricals. Only the distinct labels are split; rows are mapped
+    through integer codes.
+    """
+    codes, labels = pd.factorize(values, sort=True)
+    parts = pd.Series(labels).str.split(":", expand=True).reindex(columns=range(3))
+    parts.columns = ["gene", "position", "aa"]
+    parts["mutation"] = parts["position"] + parts["aa"]
+
+    out = {}
+    for col in ["gene", "position", "aa", "mutation"]:
+        part_codes, part_labels = pd.factorize(parts[col], sort=True)
+        # Append -1 so missing labels (code -1) stay missing
+        row_codes = np.append(part_codes, -1)[codes]
+        out[col] = pd.Categorical.from_codes(row_codes, part_labels)
+    return pd.DataFrame(out, index=values.index)
+
+
+def normalize_table(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Turn a raw WHO prevalence export into the table the pipeline expects:
+    split the mutation label, rename columns, check required columns and
+    store them with compact types (categoricals for repeated strings,
+    small integers for year and n_samples).
+    """
     # Extract gene and mutation
-    df[["gene", "position", "aa"]] = df["mutation"].str.split(":", expand=True)
-    df["mutation"] = df["position"] + df["aa"]
-    
+    parts = _categorical_parts(df["mutation"])
+    df = df.drop(columns=["mutation"])
+    df[parts.columns] = parts
+
     # Rename certain columns
     df = df.rename(columns={
         "country_name": "country",
@@ -33,9 +95,460 @@ def load_data(path: str) -> pd.DataFrame:
         raise ValueError(f"Missing columns in data: {missing}")
 
     # Ensure types
-    df["year"] = df["year"].astype(int)
+    df["year"] = pd.to_numeric(df["year"].astype(int), downcast="integer")
     # df["year_pub"] = df["year_pub"].astype(int)
     df["prevalence"] = df["prevalence"].astype(float)
-    df["n_samples"] = df["n_samples"].astype(int)
+    df["n_samples"] = pd.to_numeric(df["n_samples"].astype(int), downcast="integer")
+    for col in CATEGORICAL_COLS:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
 
     return df
+
+
+def source_hash(path: str) -> str:
+    """
+    Content hash of a source file. The hash is remembered in a small
+    sidecar keyed by size+mtime so unchanged files are only read once.
+    For a partitioned dataset directory, the file listing is hashed.
+    """
+    if os.path.isdir(path):
+        return _dataset_hash(path)
+
+    sidecar = path + ".sha256.json"
+    current = source_fingerprint(path)
+    try:
+        with open(sidecar) as f:
+            cached = json.load(f)
+        if all(cached.get(k) == v for k, v in current.items()):
+            return cached["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    digest = file_sha256(path)
+    try:
+        with open(sidecar, "w") as f:
+            json.dump({"sha256": digest, **current}, f)
+    except OSError:
+        pass
+    return digest
+
+
+def _dataset_hash(path: str) -> str:
+    listing = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            full = os.path.join(root, name)
+            st = os.stat(full)
+            listing.append((os.path.relpath(full, path), st.st_size, st.st_mtime_ns))
+    return hashlib.sha256(json.dumps(sorted(listing)).encode()).hexdigest()
+
+
+def _snapshot_path(path: str, key: str) -> str:
+    return f"{path}.snapshot-{key[:16]}.arrow"
+
+
+def _write_snapshot(df: pd.DataFrame, snapshot: str) -> None:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    # Drop snapshots of older versions of the source
+    for old in glob.glob(glob.escape(snapshot.rsplit(".snapshot-", 1)[0]) + ".snapshot-*.arrow"):
+        os.remove(old)
+
+    tmp = snapshot + ".tmp"
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    feather.write_feather(table, tmp, compression="uncompressed")
+    os.replace(tmp, snapshot)
+
+
+def _read_snapshot(snapshot: str) -> pd.DataFrame:
+    import pyarrow.feather as feather
+
+    return feather.read_table(snapshot, memory_map=True).to_pandas()
+
+
+def load_data(path: str, use_snapshot: bool = True) -> pd.DataFrame:
+    """
+    Load and normalize the prevalence table.
+
+    With use_snapshot, the normalized table is written next to the source
+    as an uncompressed Arrow file on first load and memory-mapped on later
+    runs. Snapshots are keyed by the source content hash and LOADER_VERSION.
+    path may also be a partitioned dataset directory (write_partitioned).
+    """
+    start = time.perf_counter()
+    if os.path.isdir(path):
+        # Partitioned dataset (see write_partitioned): already normalized
+        df = _read_source(path)
+        _report_load(path, "dataset", df, start)
+        return df
+
+    snapshot = None
+    if use_snapshot and _HAVE_PYARROW:
+        key = hashlib.sha256(f"{LOADER_VERSION}:{source_hash(path)}".encode()).hexdigest()
+        snapshot = _snapshot_path(path, key)
+        if os.path.exists(snapshot):
+            df = _read_snapshot(snapshot)
+            _report_load(path, "snapshot", df, start)
+            return df
+
+    df = normalize_table(_read_source(path))
+
+    if snapshot is not None:
+        try:
+            _write_snapshot(df, snapshot)
+        except OSError as e:
+            print(f"Could not write snapshot {snapshot}: {e}")
+    _report_load(path, "source", df, start)
+    return df
+
+
+def _report_load(path: str, how: str, df: pd.DataFrame, start: float) -> None:
+    mem = df.memory_usage(deep=True).sum()
+    print(
+        f"Loaded {len(df)} rows from {how} ({os.path.basename(path)}) "
+        f"in {time.perf_counter() - start:.2f} s, {mem / 1e6:.1f} MB in memory"
+    )
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_fingerprint(path: str) -> Dict[str, Any]:
+    """
+    Cheap identity of a source file (size + mtime). Used to decide whether
+    data derived from it is still current.
+    """
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def build_cube(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    Pre-aggregate the table into summary cells:
+      sites:   per (country, mutation, year, site) -> n_samples,
+               weighted (sum of prevalence * n_samples)
+      studies: per (country, mutation, year, study_id, authors, year_pub)
+               -> n_samples, prev_sum, n_prev (for the unweighted mean)
+    First/last years of any roll-up are the min/max of the year key.
+    """
+    work = df[sorted(set(CUBE_SITE_KEYS + CUBE_STUDY_KEYS))].copy()
+    work["n_samples"] = df["n_samples"].astype("int64")
+    work["weighted"] = df["prevalence"] * df["n_samples"]
+    work["prevalence"] = df["prevalence"]
+
+    sites = (
+        work.groupby(CUBE_SITE_KEYS, dropna=False, observed=True)
+        .agg(n_samples=("n_samples", "sum"), weighted=("weighted", "sum"))
+        .reset_index()
+    )
+    studies = (
+        work.groupby(CUBE_STUDY_KEYS, dropna=False, observed=True)
+        .agg(
+            n_samples=("n_samples", "sum"),
+            prev_sum=("prevalence", "sum"),
+            n_prev=("prevalence", "count"),
+        )
+        .reset_index()
+    )
+    return {"sites": sites, "studies": studies}
+
+
+def merge_cubes(parts: List[Dict[str, pd.DataFrame]]) -> Dict[str, pd.DataFrame]:
+    """
+    Combine cubes built from disjoint pieces of a table (e.g. chunks).
+    Every cube measure is a sum, so cells are re-summed on their keys.
+    """
+    merged = {}
+    for name, keys in [("sites", CUBE_SITE_KEYS), ("studies", CUBE_STUDY_KEYS)]:
+        frames = [p[name] for p in parts if not p[name].empty]
+        if not frames:
+            merged[name] = parts[0][name] if parts else pd.DataFrame(columns=keys)
+            continue
+        merged[name] = (
+            pd.concat(frames, ignore_index=True)
+            .groupby(keys, dropna=False, observed=True)
+            .sum()
+            .reset_index()
+        )
+    return merged
+
+
+def _cube_paths(path: str) -> Dict[str, str]:
+    path = path.rstrip(os.sep)
+    return {
+        "sites": path + ".cube.sites.parquet",
+        "studies": path + ".cube.studies.parquet",
+        "meta": path + ".cube.json",
+    }
+
+
+def _cube_is_fresh(path: str, meta_path: str) -> bool:
+    """
+    The cube is fresh if it was built by this CUBE_VERSION from a source
+    with the same content hash.
+    """
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get("version") == CUBE_VERSION and meta.get("sha256") == source_hash(path)
+
+
+def load_cube(path: str, df: Optional[pd.DataFrame] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Load the summary cube stored next to the source file, rebuilding it
+    when the source has changed. df is the already-loaded table, if any;
+    it is only used when a rebuild is needed; without it the cube is
+    built by streaming the source in chunks.
+    """
+    paths = _cube_paths(path)
+
+    if _cube_is_fresh(path, paths["meta"]):
+        return {
+            "sites": pd.read_parquet(paths["sites"]),
+            "studies": pd.read_parquet(paths["studies"]),
+        }
+
+    # Fingerprint before reading so a change during the build is not missed
+    sha256 = source_hash(path)
+    if df is None:
+        # Build chunk by chunk so the full table is never in memory
+        cube = ChunkedSource(path).cube()
+    else:
+        cube = build_cube(df)
+
+    save_cube(path, cube, sha256)
+    return cube
+
+
+def save_cube(path: str, cube: Dict[str, pd.DataFrame], sha256: str) -> None:
+    """
+    Store a cube next to the source, marked as built from the source
+    content with this hash.
+    """
+    paths = _cube_paths(path)
+    cube["sites"].to_parquet(paths["sites"], index=False)
+    cube["studies"].to_parquet(paths["studies"], index=False)
+    with open(paths["meta"], "w") as f:
+        json.dump({"version": CUBE_VERSION, "sha256": sha256}, f)
+
+
+def _arrow_filter(query: Dict[str, Any], names: List[str], partitioned: bool = False):
+    """
+    Pushdown expression so non-matching partitions and row groups are
+    skipped. For raw Parquet this covers country and year (mutation is
+    matched after normalization); for a partitioned dataset, country and
+    mutation select partition directories and year uses row-group stats.
+    """
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    expr = None
+
+    def add(e):
+        return e if expr is None else expr & e
+
+    countries = summarizer.query_values(query, "country")
+    mutations = summarizer.query_values(query, "mutation")
+    if partitioned:
+        if countries:
+            expr = add(ds.field("country_key").isin([summarizer.label_key(c) for c in countries]))
+        if mutations:
+            labels = [summarizer.normalize_mutation_label(m) for m in mutations]
+            expr = add(ds.field("mutation").isin(labels))
+    else:
+        country_col = "country_name" if "country_name" in names else "country"
+        if countries and country_col in names:
+            keys = [summarizer.label_key(c) for c in countries]
+            expr = add(pc.utf8_lower(pc.utf8_trim_whitespace(ds.field(country_col))).isin(keys))
+    if query.get("year_min") is not None and "year" in names:
+        expr = add(ds.field("year") >= int(query["year_min"]))
+    if query.get("year_max") is not None and "year" in names:
+        expr = add(ds.field("year") <= int(query["year_max"]))
+    return expr
+
+
+class ChunkedSource:
+    """
+    Lazy view of a prevalence file that is read in chunks (CSV) or record
+    batches (Parquet, or a partitioned dataset from write_partitioned),
+    for tables that do not fit in memory.
+
+    Each chunk goes through normalize_table and the pending filters, so
+    only matching rows are materialized. filter_data on a ChunkedSource
+    returns another ChunkedSource; summarize_prevalence on one streams the
+    chunks into a summary cube, so peak memory follows the chunk size
+    rather than the file size.
+    """
+
+    def __init__(self, path: str, chunksize: Optional[int] = None, queries: Optional[List[Dict[str, Any]]] = None):
+        self.partitioned = os.path.isdir(path)
+        if not (self.partitioned or path.endswith(".csv") or path.endswith(".parquet")):
+            raise ValueError("Unsupported file type; use .csv, .parquet or a partitioned dataset directory")
+        self.path = path
+        self.chunksize = chunksize or config.CHUNK_ROWS
+        self.queries = queries or []
+
+    def filter(self, query: Dict[str, Any]) -> "ChunkedSource":
+        return ChunkedSource(self.path, self.chunksize, self.queries + [query])
+
+    def _raw_chunks(self) -> Iterator[pd.DataFrame]:
+        if self.path.endswith(".csv"):
+            yield from pd.read_csv(self.path, chunksize=self.chunksize)
+            return
+
+        import pyarrow.dataset as ds
+
+        if self.partitioned:
+            dataset = ds.dataset(self.path, format="parquet", partitioning=_partitioning())
+        else:
+            dataset = ds.dataset(self.path, format="parquet")
+        expr = None
+        for q in self.queries:
+            e = _arrow_filter(q, dataset.schema.names, self.partitioned)
+            if e is not None:
+                expr = e if expr is None else expr & e
+        for batch in dataset.to_batches(filter=expr, batch_size=self.chunksize):
+            yield batch.to_pandas()
+
+    def __iter__(self) -> Iterator[pd.DataFrame]:
+        # Small pieces (e.g. one per partition file) are buffered up to
+        # chunksize rows so consumers see few, reasonably sized chunks.
+        pending, n_pending = [], 0
+        for raw in self._raw_chunks():
+            if raw.empty:
+                continue
+            if self.partitioned:
+                chunk = raw.drop(columns=["country_key"])
+            else:
+                chunk = normalize_table(raw)
+            for q in self.queries:
+                chunk = summarizer.filter_data(chunk, q)
+            if chunk.empty:
+                continue
+            pending.append(chunk)
+            n_pending += len(chunk)
+            if n_pending >= self.chunksize:
+                yield pending[0] if len(pending) == 1 else pd.concat(pending, ignore_index=True)
+                pending, n_pending = [], 0
+        if pending:
+            yield pending[0] if len(pending) == 1 else pd.concat(pending, ignore_index=True)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Materialize the matching rows as one DataFrame.
+        """
+        chunks = list(self)
+        if not chunks:
+            return self._empty()
+        df = pd.concat(chunks, ignore_index=True)
+        # Chunks have their own categories; unify them
+        for col in CATEGORICAL_COLS:
+            df[col] = df[col].astype("category")
+        return df
+
+    def distinct(self, columns: List[str]) -> pd.DataFrame:
+        """
+        Distinct combinations of columns over the matching rows.
+        """
+        if self.partitioned and not self.queries:
+            # Already normalized: read only these columns
+            import pyarrow.dataset as ds
+
+            dataset = ds.dataset(self.path, format="parquet", partitioning=_partitioning())
+            batches = dataset.to_batches(columns=columns, batch_size=self.chunksize)
+            parts = [batch.to_pandas().drop_duplicates() for batch in batches]
+        else:
+            parts = [chunk[columns].drop_duplicates() for chunk in self]
+        if not parts:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(parts, ignore_index=True).astype(str).drop_duplicates()
+
+    def cube(self) -> Dict[str, pd.DataFrame]:
+        """
+        Summary cube (see build_cube) over the matching rows, merged
+        chunk by chunk.
+        """
+        merged = None
+        for chunk in self:
+            part = build_cube(chunk)
+            merged = part if merged is None else merge_cubes([merged, part])
+        if merged is None:
+            return build_cube(self._empty())
+        return merged
+
+    def _empty(self) -> pd.DataFrame:
+        if self.partitioned:
+            import pyarrow.dataset as ds
+
+            dataset = ds.dataset(self.path, format="parquet", partitioning=_partitioning())
+            return dataset.schema.empty_table().to_pandas().drop(columns=["country_key"])
+        return normalize_table(next(ChunkedSource(self.path, self.chunksize)._raw_chunks()).head(0))
+
+
+def _partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    schema = pa.schema([(col, pa.string()) for col in PARTITION_COLS])
+    return ds.partitioning(schema, flavor="hive")
+
+
+def write_partitioned(
+    source: str,
+    out_dir: str,
+    chunksize: Optional[int] = None,
+    row_group_rows: int = 50_000,
+) -> int:
+    """
+    Convert a CSV/Parquet source into a Parquet dataset partitioned by
+    gene/mutation/country (hive layout, country as its label_key in
+    country_key). Rows are sorted by year inside each file so row-group
+    statistics on year can skip data. The source is streamed in chunks.
+    Returns the number of rows written.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    if os.path.exists(out_dir) and os.listdir(out_dir):
+        raise ValueError(f"Output directory is not empty: {out_dir}")
+
+    schema = None
+    n_rows = 0
+    for i, chunk in enumerate(ChunkedSource(source, chunksize)):
+        chunk = chunk.assign(country_key=chunk["country"].map(summarizer.label_key))
+        for col in CATEGORICAL_COLS + ["country_key"]:
+            chunk[col] = chunk[col].astype(object)
+        chunk = chunk.sort_values(PARTITION_COLS + ["year"], kind="stable")
+
+        if schema is None:
+            # Fix column types on the first chunk so every file agrees
+            schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+            schema = schema.set(schema.get_field_index("year"), pa.field("year", pa.int16()))
+            schema = schema.set(schema.get_field_index("n_samples"), pa.field("n_samples", pa.int32()))
+        table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        # A chunk can span every country x mutation pair, more than
+        # write_dataset's default limit of 1024 partitions
+        n_partitions = len(chunk[PARTITION_COLS].drop_duplicates())
+
+        ds.write_dataset(
+            table,
+            out_dir,
+            format="parquet",
+            partitioning=_partitioning(),
+            basename_template=f"part-{i}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            max_partitions=max(n_partitions, 1024),
+            max_rows_per_group=row_group_rows,
+            min_rows_per_group=min(row_group_rows, 1024),
+        )
+        n_rows += len(chunk)
+    return n_rows
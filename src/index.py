@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, Any, Optional
+
+from .labels import LabelTable
+from .summarizer import query_values
+
+
+class PrevalenceIndex:
+    """
+    Lookup structure built once at load time so that filter_data does not
+    scan and copy the whole table for every question.
+
+    Rows are ordered by (country, mutation, year) using the case-insensitive
+    label codes of a LabelTable. Each (country, mutation) pair owns a
+    contiguous block of that ordering, so a query becomes a block lookup
+    plus a binary search on year.
+    """
+
+    def __init__(self, df: pd.DataFrame, labels: Optional[LabelTable] = None):
+        self.labels = labels if labels is not None else LabelTable(df)
+
+        # Shift by one so missing labels (code -1) get their own bucket
+        country_codes = self.labels.row_codes(df, "country").astype(np.int64) + 1
+        mutation_codes = self.labels.row_codes(df, "mutation").astype(np.int64) + 1
+        self._n_mut = len(self.labels.labels["mutation"]) + 1
+
+        years = df["year"].to_numpy()
+        order = np.lexsort((years, mutation_codes, country_codes))
+        keys = country_codes[order].astype(np.int64) * self._n_mut + mutation_codes[order]
+
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        self._keys = keys[starts]
+        self._starts = starts
+        self._ends = np.r_[starts[1:], len(keys)]
+        self._order = order
+        self._years = years[order]
+        self.n_rows = len(df)
+
+    def _blocks(self, query: Dict[str, Any]) -> np.ndarray:
+        """
+        Indices into the (country, mutation) block arrays matching the query.
+        """
+        blocks = np.arange(len(self._keys))
+
+        countries = query_values(query, "country")
+        if countries:
+            codes = self._codes("country", countries)
+            if not codes:
+                return blocks[:0]
+            # Each country owns one contiguous range of block keys
+            ranges = [
+                blocks[slice(*np.searchsorted(self._keys, [code * self._n_mut, (code + 1) * self._n_mut]))]
+                for code in sorted(codes)
+            ]
+            blocks = np.concatenate(ranges)
+
+        mutations = query_values(query, "mutation")
+        if mutations:
+            codes = self._codes("mutation", mutations)
+            if not codes:
+                return blocks[:0]
+            blocks = blocks[np.isin(self._keys[blocks] % self._n_mut, codes)]
+
+        return blocks
+
+    def _codes(self, column: str, labels) -> list:
+        """
+        Block codes (label code + 1) of the known labels.
+        """
+        codes = {self.labels.lookup(column, label) for label in labels}
+        return [code + 1 for code in codes if code is not None]
+
+    def positions(self, query: Dict[str, Any]) -> np.ndarray:
+        """
+        Sorted row positions (for df.iloc) of the rows matching the query.
+        """
+        year_min = query.get("year_min")
+        year_max = query.get("year_max")
+
+        pieces = []
+        for b in self._blocks(query):
+            start, end = self._starts[b], self._ends[b]
+            if year_min is not None:
+                start += np.searchsorted(self._years[start:end], int(year_min), side="left")
+            if year_max is not None:
+                end = self._starts[b] + np.searchsorted(
+                    self._years[self._starts[b]:end], int(year_max), side="right"
+                )
+            if start < end:
+                pieces.append(self._order[start:end])
+
+        if not pieces:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate(pieces))
+
+    def filter(self, df: pd.DataFrame, query: Dict[str, Any]) -> pd.DataFrame:
+        """
+        Same result as summarizer.filter_data, without touching rows outside
+        the matching blocks.
+        """
+        if len(df) != self.n_rows:
+            raise ValueError("Index was built for a different table; rebuild it after reloading data")
+        return df.iloc[self.positions(query)]
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional
+
+from .summarizer import label_key, normalize_mutation_label
+
+LABEL_COLUMNS = ("country", "mutation")
+
+# Spellings of a mutation that resolve to its '675V' label
+_MUTATION_FORMS = ("{gene} {label}", "{gene}:{pos}:{aa}", "{gene}_{label}", "{gene}-{label}", "{gene}{label}")
+
+
+class LabelTable:
+    """
+    Country and mutation labels, interned once at load time for
+    index.PrevalenceIndex.
+
+    Labels with the same summarizer.label_key share one integer code. For
+    each column the table keeps:
+      labels:  code -> canonical label (first spelling in the data)
+      aliases: label_key of a spelling -> code; for mutations this includes
+               gene-prefixed forms such as 'K13 675V' and 'k13:675:V'
+    Row codes come from the categorical codes of the loaded table through
+    a small per-category lookup array, so no per-row strings are built.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.labels: Dict[str, List[str]] = {}
+        self.aliases: Dict[str, Dict[str, int]] = {}
+        self._categories: Dict[str, pd.Index] = {}
+        self._category_codes: Dict[str, np.ndarray] = {}
+
+        for col in LABEL_COLUMNS:
+            categories = df[col].astype("category").cat.categories
+            labels: List[str] = []
+            aliases: Dict[str, int] = {}
+            # One extra slot so missing values (category code -1) map to -1
+            category_codes = np.full(len(categories) + 1, -1, dtype=np.int32)
+            for i, label in enumerate(categories):
+                key = label_key(label)
+                if key not in aliases:
+                    aliases[key] = len(labels)
+                    labels.append(str(label))
+                category_codes[i] = aliases[key]
+
+            self.labels[col] = labels
+            self.aliases[col] = aliases
+            self._categories[col] = categories
+            self._category_codes[col] = category_codes
+
+        if {"gene", "position", "aa"} <= set(df.columns):
+            self._add_mutation_aliases(df)
+
+    def _add_mutation_aliases(self, df: pd.DataFrame) -> None:
+        aliases = self.aliases["mutation"]
+        combos = df[["gene", "position", "aa", "mutation"]].drop_duplicates().dropna()
+        for gene, pos, aa, label in combos.itertuples(index=False):
+            code = aliases[label_key(label)]
+            for form in _MUTATION_FORMS:
+                aliases.setdefault(label_key(form.format(gene=gene, pos=pos, aa=aa, label=label)), code)
+
+    def lookup(self, column: str, label: Optional[str]) -> Optional[int]:
+        """
+        Code of a query label (any known spelling), or None if unknown.
+        """
+        if label is None:
+            return None
+        aliases = self.aliases[column]
+        code = aliases.get(label_key(label))
+        if code is None and column == "mutation":
+            code = aliases.get(label_key(normalize_mutation_label(label)))
+        return code
+
+    def row_codes(self, df: pd.DataFrame, column: str) -> np.ndarray:
+        """
+        Label code of every row of df[column] (-1 for missing). df must
+        have the categories the table was built from (the same table or a
+        row subset of it).
+        """
+        values = df[column]
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(pd.CategoricalDtype(self._categories[column]))
+        categories = values.cat.categories
+        if categories is not self._categories[column] and not categories.equals(self._categories[column]):
+            raise ValueError(f"{column!r} categories differ from the ones the label table was built on")
+        return self._category_codes[column][values.cat.codes.to_numpy()]
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, Iterable, Optional
+
+
+class LLMCache:
+    """
+    Persistent on-disk cache of LLM replies, stored in SQLite.
+
+    Entries are keyed by a hash of (model, system prompt, user prompt) and
+    evicted when older than max_age_s, or least-recently-used first when
+    the cache holds more than max_entries or max_bytes of replies.
+    Entries can carry tags so a group of them can be dropped at once
+    (invalidate). Hit and miss counters are kept for the current process.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 10_000,
+        max_bytes: int = 100 * 1024 * 1024,
+        max_age_s: float = 30 * 24 * 3600,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS replies ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tags ("
+            " tag TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " PRIMARY KEY (tag, key))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS tags_key ON tags (key)")
+        self._db.commit()
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, user_prompt: str) -> str:
+        h = hashlib.sha256()
+        for part in (model, system_prompt, user_prompt):
+            data = part.encode()
+            # Length prefix so ('ab', 'c') and ('a', 'bc') differ
+            h.update(len(data).to_bytes(8, "little"))
+            h.update(data)
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, created FROM replies WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.max_age_s:
+                if row is not None:
+                    self._db.execute("DELETE FROM replies WHERE key = ?", (key,))
+                    self._db.commit()
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE replies SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str, tags: Iterable[str] = ()) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO replies (key, value, size, created, last_used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode()), now, now),
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO tags (tag, key) VALUES (?, ?)",
+                [(tag, key) for tag in tags],
+            )
+            self._evict(now)
+            self._db.commit()
+
+    def invalidate(self, tags: Iterable[str]) -> int:
+        """
+        Drop every entry carrying any of the tags. Returns the number of
+        entries removed.
+        """
+        tags = list(tags)
+        if not tags:
+            return 0
+        marks = ",".join("?" * len(tags))
+        with self._lock:
+            removed = self._db.execute(
+                f"DELETE FROM replies WHERE key IN (SELECT key FROM tags WHERE tag IN ({marks}))",
+                tags,
+            ).rowcount
+            self._drop_orphan_tags()
+            self._db.commit()
+        return removed
+
+    def _drop_orphan_tags(self) -> None:
+        self._db.execute("DELETE FROM tags WHERE key NOT IN (SELECT key FROM replies)")
+
+    def _evict(self, now: float) -> None:
+        expired = self._db.execute("DELETE FROM replies WHERE created < ?", (now - self.max_age_s,)).rowcount
+        if expired:
+            self._drop_orphan_tags()
+
+        count, total = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM replies"
+        ).fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        # Drop least-recently-used entries until both limits hold
+        rows = self._db.execute("SELECT key, size FROM replies ORDER BY last_used").fetchall()
+        drop = []
+        for key, size in rows:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            drop.append((key,))
+            count -= 1
+            total -= size
+        self._db.executemany("DELETE FROM replies WHERE key = ?", drop)
+        self._drop_orphan_tags()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM replies")
+            self._db.execute("DELETE FROM tags")
+            self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM replies"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count, "bytes": total}
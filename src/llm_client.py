@@ -0,0 +1,220 @@
+import asyncio
+import json
+import time
+from typing import Callable, Dict, Any, List, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+# Status codes worth retrying: overloaded or restarting backend
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    True for failures of the backend rather than the request: connection
+    errors, timeouts, and 429 or 5xx replies. The same request may succeed
+    later or on another backend.
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+class OllamaClient:
+    """
+    Reusable client for Ollama's /api/chat endpoint.
+
+    Keeps a pooled requests.Session so consecutive calls reuse the same
+    TCP connection, applies separate connect/read timeouts, retries
+    transient failures (connection errors, timeouts, 5xx/429) with
+    exponential backoff, and can send keep_alive so the model stays
+    loaded between questions.
+    """
+
+    def __init__(
+        self,
+        base_url: str = "http://localhost:11434",
+        connect_timeout: float = 5.0,
+        read_timeout: float = 300.0,
+        max_retries: int = 2,
+        backoff: float = 0.5,
+        keep_alive: Optional[str] = None,
+        pool_size: int = 10,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.keep_alive = keep_alive
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _post(self, path: str, payload: Dict[str, Any], stream: bool = False) -> requests.Response:
+        url = self.base_url + path
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                resp = self.session.post(url, json=payload, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    raise
+            else:
+                if resp.status_code not in RETRY_STATUS or last:
+                    break
+            time.sleep(self.backoff * 2 ** attempt)
+
+        if resp.status_code != 200:
+            # Print Ollama's error message for debugging
+            print("Ollama error:", resp.status_code, resp.text)
+            resp.raise_for_status()
+        return resp
+
+    def chat(self, model: str, messages: List[Dict[str, str]], **extra: Any) -> Dict[str, Any]:
+        """
+        Non-streaming chat call. Returns Ollama's full response JSON
+        (message plus timing fields). extra is merged into the payload
+        (e.g. options, format).
+        """
+        payload = {"model": model, "messages": messages, "stream": False, **extra}
+        if self.keep_alive is not None:
+            payload.setdefault("keep_alive", self.keep_alive)
+        return self._post("/api/chat", payload).json()
+
+    def chat_stream(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        on_token: Callable[[str], None],
+        **extra: Any,
+    ) -> Dict[str, Any]:
+        """
+        Streaming chat call. Reads Ollama's newline-delimited JSON chunks
+        and passes each token to on_token as it arrives. Retries only
+        apply before the response starts.
+
+        Returns the final chunk (Ollama's timing fields) with the full
+        text under message.content, plus:
+          ttft_s: seconds until the first token arrived
+          tokens_per_second: generation speed (Ollama's eval_count /
+                             eval_duration when reported)
+        """
+        payload = {"model": model, "messages": messages, "stream": True, **extra}
+        if self.keep_alive is not None:
+            payload.setdefault("keep_alive", self.keep_alive)
+
+        start = time.perf_counter()
+        first = None
+        parts = []
+        final: Dict[str, Any] = {}
+        with self._post("/api/chat", payload, stream=True) as resp:
+            for line in resp.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(f"Ollama error: {chunk['error']}")
+                token = chunk.get("message", {}).get("content", "")
+                if token:
+                    if first is None:
+                        first = time.perf_counter()
+                    parts.append(token)
+                    on_token(token)
+                if chunk.get("done"):
+                    final = chunk
+                    break
+        end = time.perf_counter()
+
+        if final.get("eval_count") and final.get("eval_duration"):
+            tps = final["eval_count"] / (final["eval_duration"] / 1e9)
+        elif first is not None and end > first:
+            tps = len(parts) / (end - first)
+        else:
+            tps = 0.0
+
+        final["message"] = {"role": "assistant", "content": "".join(parts)}
+        final["ttft_s"] = (first or end) - start
+        final["tokens_per_second"] = tps
+        return final
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class AsyncOllamaClient:
+    """
+    asyncio counterpart of OllamaClient for /api/chat, built on an
+    httpx.AsyncClient so many requests can wait on Ollama without a
+    thread each. Applies the same timeouts, retry/backoff and keep_alive
+    settings.
+    """
+
+    def __init__(
+        self,
+        base_url: str = "http://localhost:11434",
+        connect_timeout: float = 5.0,
+        read_timeout: float = 300.0,
+        max_retries: int = 2,
+        backoff: float = 0.5,
+        keep_alive: Optional[str] = None,
+        pool_size: int = 10,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.keep_alive = keep_alive
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop = None
+
+    def _session(self) -> httpx.AsyncClient:
+        # Pooled connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        if self._client is None or loop is not self._loop:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+            self._loop = loop
+        return self._client
+
+    async def _post(self, path: str, payload: Dict[str, Any]) -> httpx.Response:
+        client = self._session()
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                resp = await client.post(path, json=payload)
+            except httpx.TransportError:
+                if last:
+                    raise
+            else:
+                if resp.status_code not in RETRY_STATUS or last:
+                    break
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+        if resp.status_code != 200:
+            print("Ollama error:", resp.status_code, resp.text)
+            resp.raise_for_status()
+        return resp
+
+    async def chat(self, model: str, messages: List[Dict[str, str]], **extra: Any) -> Dict[str, Any]:
+        """
+        Non-streaming chat call; same contract as OllamaClient.chat.
+        """
+        payload = {"model": model, "messages": messages, "stream": False, **extra}
+        if self.keep_alive is not None:
+            payload.setdefault("keep_alive", self.keep_alive)
+        return (await self._post("/api/chat", payload)).json()
+
+    def close(self) -> None:
+        client, loop = self._client, self._loop
+        self._client = None
+        if client is None or loop is None or loop.is_closed():
+            return
+        if loop.is_running():
+            loop.create_task(client.aclose())
+        else:
+            loop.run_until_complete(client.aclose())
@@ -0,0 +1,294 @@
+"""
+Spreads LLM calls over several Ollama instances.
+
+Each call goes to the least-loaded healthy backend that serves the
+requested model, with at most max_in_flight requests per backend; calls
+wait for a free slot when every backend is full. A backend that fails or
+times out is skipped for a cool-down period and the call moves to the
+next one; errors caused by the request itself (e.g. HTTP 400) are raised
+without failing over. Latency, failures and queue depth are kept per
+backend.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Any, Iterator, List, Optional, Sequence, Tuple
+
+from . import tracing
+from .llm_client import AsyncOllamaClient, OllamaClient, is_transient
+
+# Latencies kept per backend for the percentiles
+MAX_SAMPLES = 1000
+
+
+class NoBackendAvailable(RuntimeError):
+    pass
+
+
+class Backend:
+    """
+    One Ollama instance. models lists the models it serves (None: any);
+    max_in_flight=None leaves the number of concurrent requests open.
+    client and async_client are callables returning the clients to use,
+    so a backend can share the process-wide clients from config.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        client: Callable[[], OllamaClient],
+        async_client: Callable[[], AsyncOllamaClient],
+        max_in_flight: Optional[int] = 4,
+        models: Optional[Sequence[str]] = None,
+    ):
+        self.url = url
+        self.client = client
+        self.async_client = async_client
+        self.max_in_flight = max_in_flight
+        self.models = set(models) if models else None
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.last_error: Optional[str] = None
+        self.latencies: deque = deque(maxlen=MAX_SAMPLES)
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.down_until
+
+    def has_slot(self) -> bool:
+        return self.max_in_flight is None or self.in_flight < self.max_in_flight
+
+    def load(self) -> float:
+        return self.in_flight / (self.max_in_flight or 1)
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = list(self.latencies)
+        return {
+            "url": self.url,
+            "models": sorted(self.models) if self.models else None,
+            "healthy": self.healthy(time.monotonic()),
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "calls": self.calls,
+            "failures": self.failures,
+            "p50_s": tracing.percentile(latencies, 50),
+            "p95_s": tracing.percentile(latencies, 95),
+            "last_error": self.last_error,
+        }
+
+
+class LLMDispatcher:
+    """
+    Routes chat calls over a list of backends.
+
+    attempts bounds how many backends (or retries of one, once every
+    serving backend has been tried) a single call may use; cooldown is
+    how long a failed backend is skipped while others are available.
+    """
+
+    def __init__(
+        self,
+        backends: List[Backend],
+        attempts: Optional[int] = None,
+        cooldown: float = 30.0,
+        queue_timeout: float = 300.0,
+        backoff: float = 0.5,
+    ):
+        if not backends:
+            raise ValueError("at least one LLM backend is required")
+        self.backends = backends
+        self.attempts = attempts or len(backends)
+        self.cooldown = cooldown
+        self.queue_timeout = queue_timeout
+        self.backoff = backoff
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.wait_s = 0.0
+        self._cond = threading.Condition()
+
+    def _pick(self, model: str, tried: List[Backend]) -> Optional[Backend]:
+        """
+        Least-loaded healthy backend with a free slot, preferring ones not
+        yet tried for this call; None if the call has to wait. Called with
+        the lock held.
+        """
+        serving = [b for b in self.backends if b.serves(model)]
+        if not serving:
+            raise NoBackendAvailable(f"no LLM backend serves model {model!r}")
+        now = time.monotonic()
+        # Backends cooling down are only used when none is healthy; a full
+        # healthy backend is waited for instead
+        candidates = [b for b in serving if b.healthy(now)] or serving
+        free = [b for b in candidates if b.has_slot()]
+        if not free:
+            return None
+        return min(free, key=lambda b: (b in tried, b.load(), b.down_until))
+
+    def _claim(self, backend: Backend) -> None:
+        backend.in_flight += 1
+        backend.peak_in_flight = max(backend.peak_in_flight, backend.in_flight)
+
+    def _acquire(self, model: str, tried: List[Backend]) -> Backend:
+        with self._cond:
+            backend = self._pick(model, tried)
+            if backend is None:
+                start = time.perf_counter()
+                self.waiting += 1
+                self.peak_waiting = max(self.peak_waiting, self.waiting)
+                try:
+                    deadline = time.monotonic() + self.queue_timeout
+                    while backend is None:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            raise NoBackendAvailable("timed out waiting for a free LLM backend")
+                        self._cond.wait(left)
+                        backend = self._pick(model, tried)
+                finally:
+                    self.waiting -= 1
+                    self.wait_s += time.perf_counter() - start
+            self._claim(backend)
+            return backend
+
+    async def _aacquire(self, model: str, tried: List[Backend]) -> Backend:
+        # Poll instead of blocking the event loop on the condition
+        with self._cond:
+            backend = self._pick(model, tried)
+            if backend is not None:
+                self._claim(backend)
+                return backend
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+        start = time.perf_counter()
+        try:
+            deadline = time.monotonic() + self.queue_timeout
+            while True:
+                await asyncio.sleep(0.01)
+                with self._cond:
+                    backend = self._pick(model, tried)
+                    if backend is not None:
+                        self._claim(backend)
+                        return backend
+                if time.monotonic() > deadline:
+                    raise NoBackendAvailable("timed out waiting for a free LLM backend")
+        finally:
+            with self._cond:
+                self.waiting -= 1
+                self.wait_s += time.perf_counter() - start
+
+    def _release(self, backend: Backend, start: float, error: Optional[BaseException]) -> None:
+        with self._cond:
+            backend.in_flight -= 1
+            backend.calls += 1
+            if error is None:
+                backend.latencies.append(time.perf_counter() - start)
+                backend.down_until = 0.0
+            elif is_transient(error):
+                # Errors caused by the request itself leave the backend alone
+                backend.failures += 1
+                backend.last_error = repr(error)
+                backend.down_until = time.monotonic() + self.cooldown
+            self._cond.notify_all()
+
+    def _retry_delay(self, backend: Backend, tried: List[Backend], attempt: int) -> float:
+        # Back off only when going back to a backend that already failed
+        return self.backoff * 2 ** attempt if backend in tried else 0.0
+
+    @contextmanager
+    def _attempt(
+        self,
+        backend: Backend,
+        tried: List[Backend],
+        attempt: int,
+        can_retry: Callable[[], bool] = lambda: True,
+    ) -> Iterator[float]:
+        """
+        One try of a call on a claimed backend. Yields the backoff to wait
+        before sending (not counted in the latency) and releases the
+        backend on exit. A transient error is logged and suppressed when
+        another attempt may follow, so the caller's loop moves on.
+        """
+        delay = self._retry_delay(backend, tried, attempt)
+        start = time.perf_counter() + delay
+        error = None
+        try:
+            yield delay
+        except Exception as e:
+            error = e
+            if attempt == self.attempts - 1 or not can_retry() or not is_transient(e):
+                raise
+            print(f"LLM backend {backend.url} failed ({e!r}); trying another")
+        finally:
+            self._release(backend, start, error)
+            tried.append(backend)
+
+    def chat(self, model: str, messages: List[Dict[str, str]], **extra: Any) -> Tuple[Dict[str, Any], str]:
+        """
+        OllamaClient.chat on the chosen backend. Returns (response, backend url).
+        """
+        return self._call(model, lambda backend: backend.client().chat(model, messages, **extra))
+
+    def chat_stream(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        on_token: Callable[[str], None],
+        **extra: Any,
+    ) -> Tuple[Dict[str, Any], str]:
+        """
+        OllamaClient.chat_stream on the chosen backend. A call only moves
+        to another backend if no token has been passed to on_token yet.
+        """
+        started = [False]
+
+        def forward(token: str) -> None:
+            started[0] = True
+            on_token(token)
+
+        return self._call(
+            model,
+            lambda backend: backend.client().chat_stream(model, messages, forward, **extra),
+            can_retry=lambda: not started[0],
+        )
+
+    def _call(self, model: str, fn, can_retry: Callable[[], bool] = lambda: True):
+        tried: List[Backend] = []
+        for attempt in range(self.attempts):
+            backend = self._acquire(model, tried)
+            with self._attempt(backend, tried, attempt, can_retry) as delay:
+                if delay:
+                    time.sleep(delay)
+                return fn(backend), backend.url
+
+    async def achat(self, model: str, messages: List[Dict[str, str]], **extra: Any) -> Tuple[Dict[str, Any], str]:
+        """
+        asyncio version of chat.
+        """
+        tried: List[Backend] = []
+        for attempt in range(self.attempts):
+            backend = await self._aacquire(model, tried)
+            with self._attempt(backend, tried, attempt) as delay:
+                if delay:
+                    await asyncio.sleep(delay)
+                return await backend.async_client().chat(model, messages, **extra), backend.url
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "waiting": self.waiting,
+                "peak_waiting": self.peak_waiting,
+                "wait_s": self.wait_s,
+                "backends": [b.stats() for b in self.backends],
+            }
+
+    def close(self) -> None:
+        for backend in self.backends:
+            backend.client().close()
+            backend.async_client().close()
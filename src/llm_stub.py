@@ -0,0 +1,206 @@
+"""
+Local stand-in for Ollama's /api/chat endpoint, for testing and
+benchmarking without a model.
+
+Replies are deterministic: requests with a format schema, or whose system
+prompt asks to return only JSON, get a query guessed from the question
+with simple patterns; anything else gets a fixed-length placeholder
+narrative. options.num_predict caps the number of reply tokens. The
+first `failures` chat requests can be answered with an error status
+instead, to exercise client retries.
+
+Usage:
+  python -m src.llm_stub --port 11435 --latency 0.5
+"""
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Tuple
+
+_MUTATION = re.compile(r"(?<![A-Za-z0-9])[A-Za-z]?(\d{2,4})[:_]?([A-Z])(?![A-Za-z0-9])")
+_PLACE = re.compile(r"\b(?:in|across)\s+([A-Z][A-Za-z'-]+(?:\s+[A-Z][A-Za-z'-]+)*)")
+_YEAR = re.compile(r"\b((?:19|20)\d{2})\b")
+
+
+def _guess_query(question: str) -> Dict[str, Any]:
+    mutation = _MUTATION.search(question)
+    place = _PLACE.search(question)
+    years = sorted(int(y) for y in _YEAR.findall(question))
+    return {
+        "country": place.group(1) if place else None,
+        "mutation": mutation.group(1) + mutation.group(2) if mutation else None,
+        "year_min": years[0] if years else None,
+        "year_max": years[-1] if len(years) > 1 else None,
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like Ollama
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            self._send_json(200, {"version": "stub"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._send_json(400, {"error": "invalid JSON"})
+            return
+        if self.path != "/api/chat":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.last_payload = payload
+            failing = server.requests <= server.failures
+        if failing:
+            self._send_json(server.fail_status, {"error": "stub failure"})
+            return
+        start = time.perf_counter()
+
+        messages = payload.get("messages", [])
+        system = next((m["content"] for m in messages if m.get("role") == "system"), "")
+        user = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+
+        if payload.get("format") or "Return ONLY valid JSON" in system:
+            content = json.dumps(_guess_query(user))
+        else:
+            content = " ".join(["Prevalence"] + ["data"] * (server.words - 1))
+        tokens = re.findall(r"\S+\s*", content) or [content]
+        num_predict = payload.get("options", {}).get("num_predict")
+        if num_predict is not None and num_predict >= 0:
+            tokens = tokens[:num_predict]
+            content = "".join(tokens)
+        prompt_eval_count = (len(system) + len(user)) // 4
+
+        time.sleep(server.latency)
+        prompt_eval_duration = int((time.perf_counter() - start) * 1e9)
+
+        if payload.get("stream", True):
+            self._stream_tokens(payload, tokens, start, prompt_eval_count, prompt_eval_duration)
+            return
+
+        time.sleep(server.token_delay * len(tokens))
+        self._send_json(200, {
+            "model": payload.get("model"),
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "total_duration": int((time.perf_counter() - start) * 1e9),
+            "prompt_eval_count": prompt_eval_count,
+            "prompt_eval_duration": prompt_eval_duration,
+            "eval_count": len(tokens),
+            "eval_duration": int((time.perf_counter() - start) * 1e9) - prompt_eval_duration,
+        })
+
+    def _write_chunk(self, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode() + b"\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream_tokens(self, payload, tokens, start, prompt_eval_count, prompt_eval_duration) -> None:
+        """
+        Newline-delimited JSON chunks, one per token, as Ollama sends
+        with "stream": true.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        eval_start = time.perf_counter()
+        for token in tokens:
+            time.sleep(self.server.token_delay)
+            self._write_chunk({
+                "model": payload.get("model"),
+                "message": {"role": "assistant", "content": token},
+                "done": False,
+            })
+        end = time.perf_counter()
+        self._write_chunk({
+            "model": payload.get("model"),
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "total_duration": int((end - start) * 1e9),
+            "prompt_eval_count": prompt_eval_count,
+            "prompt_eval_duration": prompt_eval_duration,
+            "eval_count": len(tokens),
+            "eval_duration": int((end - eval_start) * 1e9),
+        })
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_stub(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    latency: float = 0.0,
+    token_delay: float = 0.0,
+    words: int = 120,
+    failures: int = 0,
+    fail_status: int = 503,
+) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Start a stub server in a background thread. port=0 picks a free port.
+    The first `failures` chat requests get fail_status. server.requests
+    counts chat requests and server.last_payload holds the latest one.
+    Returns (server, base_url); call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.token_delay = token_delay
+    server.words = words
+    server.failures = failures
+    server.fail_status = fail_status
+    server.requests = 0
+    server.last_payload = None
+    server.lock = threading.Lock()
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.0, help="fixed delay per request (s)")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="extra delay per generated token (s)")
+    parser.add_argument("--words", type=int, default=120, help="length of the placeholder narrative")
+    parser.add_argument("--failures", type=int, default=0, help="answer the first N chat requests with --fail-status")
+    parser.add_argument("--fail-status", type=int, default=503)
+    args = parser.parse_args()
+
+    server, url = start_stub(
+        args.host, args.port, args.latency, args.token_delay, args.words, args.failures, args.fail_status
+    )
+    print(f"Ollama stub listening on {url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
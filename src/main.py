@@ -1,41 +1,250 @@
 import pandas as pd
-from typing import Dict, Any, Tuple
+from typing import Callable, Dict, Any, Optional, Tuple
 from dotenv import load_dotenv
+import argparse
+import asyncio
+import contextvars
 import os
 import json
+from concurrent.futures import Executor
 
-from . import config, query_parser, summarizer, narrative
-from .data_loader import load_data
+from . import answer_store, batch, config, query_parser, speculate, summarizer, narrative, tracing
+from .data_loader import ChunkedSource, load_data, load_cube
+from .index import PrevalenceIndex
 
-def answer_question(df: pd.DataFrame, question: str) -> Tuple[Dict[str, Any], str]:
+def _print_llm_timings(timings: Optional[Dict[str, Any]]) -> None:
+    if timings:
+        print(
+            f"[prompt: {timings['prompt_tokens']} tokens in {timings['prompt_eval_s']:.2f} s, "
+            f"generation: {timings['eval_tokens']} tokens in {timings['eval_s']:.2f} s]"
+        )
+
+
+def answer_question(
+    df: pd.DataFrame,
+    question: str,
+    vocab: Optional[Dict[str, Any]] = None,
+    index: Optional[PrevalenceIndex] = None,
+    cube: Optional[Dict[str, pd.DataFrame]] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+) -> Tuple[Dict[str, Any], str]:
     """
     High-level pipeline:
       question -> query -> filtered data -> summary -> LLM narrative
+    If vocab (from query_parser.build_vocabulary) is given, the rule-based
+    parser is tried before the LLM. If index (a PrevalenceIndex built from
+    df) is given, filtering uses it instead of scanning the table. If cube
+    (from data_loader.load_cube) is given, the summary is rolled up from it.
+    If on_token is given, the narrative is streamed to it token by token
+    (the full text is still returned).
     Returns (query_dict, answer_text).
     """
-    print(f"\nUser question: {question}\n")
+    with tracing.trace(question):
+        print(f"\nUser question: {question}\n")
+
+        # 1) natural language -> structured query
+        summary = None
+        if config.SPECULATIVE_PARSE:
+            query, source, summary = speculate.parse_and_summarize(df, question, vocab, index, cube)
+        else:
+            query, source = query_parser.parse_question(question, vocab)
+        print(f"Parsed query ({source}):", query)
+        if source == "llm":
+            _print_llm_timings(config.last_call_timings())
+
+        if summary is not None:
+            # 2+3) prefetched while the LLM parsed
+            print(f"Summary prefetched: {len(summary.get('by_site', []))} sites")
+        elif cube is not None:
+            # 2+3) roll up pre-aggregated cells
+            summary = summarizer.summarize_cube(cube, query)
+            print(f"Summary from cube: {len(summary.get('by_site', []))} sites")
+        elif isinstance(df, pd.DataFrame):
+            # 2) filter data (row positions only, no subset table)
+            positions = summarizer.select_rows(df, query, index)
+            print(f"Subset size: {len(df) if positions is None else len(positions)} rows")
+
+            # 3) summarize
+            summary = summarizer.summarize_rows(df, positions, summarizer.is_comparison(query))
+        else:
+            # 2+3) lazy source: filter pushed down, then summarized
+            subset = summarizer.filter_data(df, query, index)
+            summary = summarizer.summarize_prevalence(subset, summarizer.is_comparison(query))
 
-    # 1) natural language -> structured query
-    query = query_parser.llm_question_to_query(question)
-    print("Parsed query:", query)
+        # 4) LLM narrative
+        if on_token is None:
+            answer = narrative.llm_generate_answer(question, query, summary)
+            _print_llm_timings(config.last_call_timings())
+        else:
+            answer, stats = narrative.llm_stream_answer(question, query, summary, on_token)
+            if stats["cached"]:
+                print(f"\n\n[cached answer in {stats['total_s'] * 1e3:.1f} ms]")
+            else:
+                print(
+                    f"\n\n[time to first token: {stats['ttft_s']:.2f} s, "
+                    f"{stats['tokens_per_second']:.1f} tokens/s]"
+                )
+                _print_llm_timings(stats)
+        return query, answer
 
-    # 2) filter data
-    subset = summarizer.filter_data(df, query)
-    print(f"Subset size: {len(subset)} rows")
 
-    # 3) summarize
-    summary = summarizer.summarize_prevalence(subset)
+async def answer_question_async(
+    df: pd.DataFrame,
+    question: str,
+    vocab: Optional[Dict[str, Any]] = None,
+    index: Optional[PrevalenceIndex] = None,
+    cube: Optional[Dict[str, pd.DataFrame]] = None,
+    executor: Optional[Executor] = None,
+) -> Tuple[Dict[str, Any], str]:
+    """
+    asyncio version of answer_question for embedding in async services.
+    The LLM calls are awaited without blocking the event loop and the
+    pandas filter/summary step runs in executor (the loop's default
+    thread pool if None). Nothing is printed.
+    Returns (query_dict, answer_text).
+    """
+    with tracing.trace(question):
+        summary = None
+        if config.SPECULATIVE_PARSE:
+            query, _, summary = await speculate.aparse_and_summarize(df, question, vocab, index, cube, executor)
+        else:
+            query, _ = await query_parser.aparse_question(question, vocab)
+
+        if summary is None:
+            # Run in a copy of this task's context so the stage is traced
+            # under the same question
+            loop = asyncio.get_running_loop()
+            summary = await loop.run_in_executor(
+                executor, contextvars.copy_context().run,
+                summarizer.summarize_query, df, query, index, cube,
+            )
 
-    # 4) LLM narrative
-    answer = narrative.llm_generate_answer(question, query, summary)
-    return query, answer
+        answer = await narrative.allm_generate_answer(question, query, summary)
+        return query, answer
+
+
+def load_dataset(path: str):
+    """
+    Load the table and the lookup structures built from it once.
+    Returns (df, vocab, index, cube); index and cube may be None.
+    """
+    if config.STREAMING or os.path.isdir(path):
+        # Read lazily; partitioned datasets only touch the partitions a
+        # question needs
+        df = ChunkedSource(path)
+    else:
+        df = load_data(path, use_snapshot=config.USE_SNAPSHOT)
+    vocab = query_parser.build_vocabulary(df)
+    if config.USE_SUMMARY_CUBE and not os.path.isdir(path):
+        # A partitioned dataset answers each question from the partitions
+        # it selects (pruning), so it gets no cube
+        cube = load_cube(path, df if isinstance(df, pd.DataFrame) else None)
+    else:
+        cube = None
+    # Every question goes to the cube when there is one, so the index is
+    # only worth building without it
+    index = PrevalenceIndex(df) if cube is None and isinstance(df, pd.DataFrame) else None
+    answer_store.activate(path)
+    return df, vocab, index, cube
+
+
+def ask(df, question: str, vocab=None, index=None, cube=None) -> None:
+    """
+    Answer one question and print the query and answer.
+    """
+    if config.STREAM_ANSWERS:
+        # Print tokens as they arrive; the header goes first
+        first = [True]
+
+        def print_token(token: str) -> None:
+            if first[0]:
+                print("\n=== LLM answer ===\n")
+                first[0] = False
+            print(token, end="", flush=True)
+
+        query_dict, answer_text = answer_question(
+            df, question, vocab, index, cube, on_token=print_token
+        )
+    else:
+        query_dict, answer_text = answer_question(df, question, vocab, index, cube)
+
+    print("\n=== Structured query ===")
+    print(json.dumps(query_dict, indent=2))
+
+    if not config.STREAM_ANSWERS:
+        print("\n=== LLM answer ===\n")
+        print(answer_text)
+
+
+def _print_backend_stats() -> None:
+    stats = config.get_dispatcher().stats()
+    print(f"LLM backends (peak queue {stats['peak_waiting']}, {stats['wait_s']:.1f} s waiting):")
+    for b in stats["backends"]:
+        p50 = f"{b['p50_s']:.2f} s" if b["p50_s"] is not None else "-"
+        print(
+            f"  {b['url']:<28} calls {b['calls']:<5} failed {b['failures']:<3} "
+            f"peak in flight {b['peak_in_flight']}/{b['max_in_flight']}  p50 {p50}"
+        )
+
+
+def print_usage_stats() -> None:
+    print("Parser usage:", query_parser.PARSE_STATS)
+    print("Narrative context:", narrative.CONTEXT_STATS)
+    print("LLM timings:", config.LLM_TIMINGS)
+    if config.LLM_BACKENDS:
+        _print_backend_stats()
+    if config.LLM_CACHE_ENABLED:
+        print("LLM cache:", config.get_cache().stats())
+    if speculate.SPEC_STATS["speculated"]:
+        print("Speculative parse:", speculate.SPEC_STATS)
+    if answer_store.active_store() is not None:
+        print("Warmed answers:", answer_store.active_store().stats())
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ask questions about malaria resistance prevalence data.")
+    parser.add_argument("--data", default=config.DATA_PATH, help="prevalence table (.csv, .parquet or dataset directory)")
+    parser.add_argument("--question", help="answer a single question and exit")
+    parser.add_argument("--batch", help="answer every question in a .jsonl/.csv file")
+    parser.add_argument("--out", default="answers.jsonl", help="batch results (JSONL)")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent LLM requests in batch mode")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the LLM reply cache")
+    parser.add_argument("--trace-log", help="write per-stage timings as JSON lines to this file")
+    parser.add_argument("--metrics", action="store_true", help="print p50/p95 per stage at exit")
+    parser.add_argument("--speculate", action="store_true", help="summarize a local guess while the LLM parses")
+    parser.add_argument("--backend", action="append", help="Ollama URL to spread LLM calls over (repeat for several)")
+    parser.add_argument("--parse-model", help="model for parsing questions (default: LLM_MODEL)")
+    parser.add_argument("--narrative-model", help="model for the narrative (default: LLM_MODEL)")
+    args = parser.parse_args()
+
+    if args.no_cache:
+        config.LLM_CACHE_ENABLED = False
+    if args.trace_log:
+        config.TRACE_LOG_PATH = args.trace_log
+    if args.metrics:
+        tracing.print_metrics_at_exit()
+    if args.speculate:
+        config.SPECULATIVE_PARSE = True
+    if args.backend:
+        config.LLM_BACKENDS = [{"url": url} for url in args.backend]
+    config.PARSE_MODEL = args.parse_model or config.PARSE_MODEL
+    config.NARRATIVE_MODEL = args.narrative_model or config.NARRATIVE_MODEL
+
     # Load your data once
-    df_all = load_data(config.DATA_PATH)
+    df_all, vocab, index, cube = load_dataset(args.data)
     print("Data loaded. You can now ask questions about the uploaded prevalence data.\n")
 
+    if args.batch:
+        config.LLM_POOL_SIZE = max(config.LLM_POOL_SIZE, args.concurrency)
+        questions = batch.read_questions(args.batch)
+        batch.run_batch(df_all, questions, args.out, args.concurrency, vocab, index, cube)
+        print_usage_stats()
+        raise SystemExit(0)
+
+    if args.question:
+        ask(df_all, args.question, vocab, index, cube)
+        raise SystemExit(0)
+
     print("Type a question (or 'quit', 'exit', or just press Enter to stop).")
 
     while True:
@@ -47,17 +256,12 @@ if __name__ == "__main__":
 
         if question.lower() in {"", "quit", "exit"}:
             print("Goodbye!")
+            print_usage_stats()
             break
 
         # Run your full pipeline for this question
         try:
-            query_dict, answer_text = answer_question(df_all, question)
+            ask(df_all, question, vocab, index, cube)
         except Exception as e:
             print(f"\n[ERROR] Something went wrong: {e}")
             continue
-
-        print("\n=== Structured query ===")
-        print(json.dumps(query_dict, indent=2))
-
-        print("\n=== LLM answer ===\n")
-        print(answer_text)
\ No newline at end of file
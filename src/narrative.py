@@ -1,8 +1,321 @@
 import pandas as pd
-from typing import Dict, Any
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import json
+import math
+import time
+
+from src import answer_store, config, summarizer, tracing
+
+# Running totals of prompt context size, reported by main.print_usage_stats
+CONTEXT_STATS = {"prompts": 0, "compacted": 0, "tokens_full": 0, "tokens_sent": 0}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count (about 4 characters per token for English and JSON).
+    """
+    return math.ceil(len(text) / 4)
+
+
+def _dumps(obj: Any) -> str:
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def _round(value: Any, digits: int = 4) -> Any:
+    if isinstance(value, float) and not math.isnan(value):
+        return round(value, digits)
+    return value
+
+
+def _pooled_mean(records: List[Dict[str, Any]], key: str) -> Optional[float]:
+    """
+    Sample-weighted mean of records[key], skipping missing values.
+    """
+    num = den = 0.0
+    for r in records:
+        value = r.get(key)
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            continue
+        num += value * r["n_samples"]
+        den += r["n_samples"]
+    return num / den if den else None
+
+
+def _short_authors(authors: Any) -> Any:
+    if not isinstance(authors, str):
+        return authors
+    for sep in (";", ",", " and "):
+        if sep in authors:
+            return authors.split(sep)[0].strip() + " et al."
+    return authors
+
+
+def _collapse_sites(by_site: List[Dict[str, Any]], top_n: int) -> List[Dict[str, Any]]:
+    ranked = sorted(by_site, key=lambda r: r["n_samples"], reverse=True)
+    head, tail = ranked[:top_n], ranked[top_n:]
+    rows = [{k: _round(v) for k, v in r.items()} for r in head]
+    if tail:
+        countries = {r["country"] for r in tail}
+        rows.append({
+            "site": f"{len(tail)} other sites",
+            "country": countries.pop() if len(countries) == 1 else f"{len(countries)} countries",
+            "n_samples": sum(r["n_samples"] for r in tail),
+            "mean_prevalence": _round(_pooled_mean(tail, "mean_prevalence")),
+            "first_year": min(r["first_year"] for r in tail),
+            "last_year": max(r["last_year"] for r in tail),
+        })
+    return rows
+
+
+def _collapse_studies(by_study: List[Dict[str, Any]], top_n: int) -> List[Dict[str, Any]]:
+    ranked = sorted(by_study, key=lambda r: r["n_samples"], reverse=True)
+    head, tail = ranked[:top_n], ranked[top_n:]
+    rows = [
+        {**{k: _round(v) for k, v in r.items()}, "authors": _short_authors(r["authors"])}
+        for r in sorted(head, key=lambda r: r["year_pub"])
+    ]
+    if tail:
+        rows.append({
+            "study_id": f"{len(tail)} other studies",
+            "authors": None,
+            "year_pub": None,
+            "n_samples": sum(r["n_samples"] for r in tail),
+            "year_min": min(r["year_min"] for r in tail),
+            "year_max": max(r["year_max"] for r in tail),
+            "mean_prev": _round(_pooled_mean(tail, "mean_prev")),
+        })
+    return rows
+
+
+def _coarsen_cells(cells: List[Dict[str, Any]], years: Optional[int]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Pool per-(country, mutation, year) cells into periods of `years` years
+    (1: rounded cells, None: left out).
+    """
+    if years is None:
+        return None
+    if years == 1:
+        return [{k: _round(v) for k, v in r.items()} for r in cells]
+    periods: Dict[Tuple, List[Dict[str, Any]]] = {}
+    for r in cells:
+        periods.setdefault((r["country"], r["mutation"], r["year"] // years), []).append(r)
+    return [
+        {
+            "country": country,
+            "mutation": mutation,
+            "first_year": min(r["year"] for r in group),
+            "last_year": max(r["year"] for r in group),
+            "n_samples": sum(r["n_samples"] for r in group),
+            "mean_prevalence": _round(_pooled_mean(group, "mean_prevalence")),
+        }
+        for (country, mutation, _), group in periods.items()
+    ]
+
+
+def build_context(
+    summary: Dict[str, Any],
+    max_tokens: Optional[int] = None,
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Fit the data summary into the prompt's token budget.
+
+    The full summary is used when it fits. Otherwise by_site and by_study
+    keep their largest entries by sample size, the rest of each list is
+    collapsed into one aggregate row, author lists are shortened and
+    values rounded. While that is still over the budget, the per-year
+    comparison cells (by_country_mutation_year) are pooled into periods of
+    config.NARRATIVE_CELL_PERIODS years and then left out, keeping
+    by_country_mutation; after that the number of sites and studies kept is
+    halved until the budget holds.
+    Returns (summary_for_prompt, stats) where stats reports the token
+    estimate of the old indented summary, the tokens sent, the number of
+    sites/studies collapsed and the cell period in years (1: per year,
+    None: cells left out).
+    """
+    if max_tokens is None:
+        max_tokens = config.NARRATIVE_SUMMARY_TOKENS
+
+    stats = {
+        "tokens_full": estimate_tokens(json.dumps(summary, indent=2)),
+        "sites_collapsed": 0,
+        "studies_collapsed": 0,
+        "cell_years": 1,
+    }
+    context = summary
+    tokens = estimate_tokens(_dumps(summary))
+
+    if summary.get("has_data") and tokens > max_tokens:
+        by_site = summary.get("by_site", [])
+        by_study = summary.get("by_study", [])
+        cells = summary.get("by_country_mutation_year")
+        periods = [1, *config.NARRATIVE_CELL_PERIODS, None] if cells else [1]
+        top_sites, top_studies = config.NARRATIVE_TOP_SITES, config.NARRATIVE_TOP_STUDIES
+        while True:
+            cell_years = periods[0]
+            context = {
+                **summary,
+                **{
+                    key: [{k: _round(v) for k, v in r.items()} for r in summary[key]]
+                    for key in ("yearly", "by_country_mutation")
+                    if key in summary
+                },
+                "by_site": _collapse_sites(by_site, top_sites),
+                "by_study": _collapse_studies(by_study, top_studies),
+                "note": (
+                    f"by_site lists the {min(top_sites, len(by_site))} sites and by_study the "
+                    f"{min(top_studies, len(by_study))} studies with the most samples; the last "
+                    "row of each list aggregates the remaining ones."
+                ),
+            }
+            if cells:
+                coarse = _coarsen_cells(cells, cell_years)
+                if coarse is None:
+                    del context["by_country_mutation_year"]
+                    context["note"] += (
+                        " by_country_mutation_year is left out to fit the prompt; "
+                        "use by_country_mutation for the comparison."
+                    )
+                else:
+                    context["by_country_mutation_year"] = coarse
+                    if cell_years > 1:
+                        context["note"] += (
+                            f" by_country_mutation_year pools years into periods of up to {cell_years} "
+                            "years (first_year to last_year) instead of one record per year."
+                        )
+            tokens = estimate_tokens(_dumps(context))
+            if tokens <= max_tokens or (len(periods) == 1 and top_sites <= 1 and top_studies <= 1):
+                break
+            if len(periods) > 1:
+                periods.pop(0)
+            else:
+                top_sites, top_studies = max(top_sites // 2, 1), max(top_studies // 2, 1)
+        stats["sites_collapsed"] = max(len(by_site) - top_sites, 0)
+        stats["studies_collapsed"] = max(len(by_study) - top_studies, 0)
+        stats["cell_years"] = cell_years
+
+    stats["tokens_sent"] = tokens
+    stats["tokens_saved"] = stats["tokens_full"] - tokens
+    return context, stats
+
+
+# Fixed instructions, sent as the system message so every narrative call
+# shares the same prompt prefix; only the user message (question and
+# data) changes between calls, and Ollama can reuse the evaluated prefix
+# while the model stays loaded (config.LLM_KEEP_ALIVE).
+NARRATIVE_SYSTEM_MSG = (
+    "You are an assistant helping a malaria genomicist interpret pre-computed "
+    "prevalence data and study metadata. You must ONLY use the numeric summaries "
+    "and study information provided. Do not invent new data or new studies. "
+    "If data are sparse or missing, say so explicitly. "
+    "Write clearly in a scientific but concise style.\n\n"
+    "Each user message gives structured summaries of malaria resistance prevalence "
+    "data for a specific user question.\n\n"
+    "The JSON has the following structure:\n"
+    "- original_question: the user's natural language question.\n"
+    "- parsed_query: the structured filter (country, mutation, year range, etc.).\n"
+    "- data_summary:\n"
+    "    - has_data: whether any data exist for this query.\n"
+    "    - yearly: list of records {year, n_samples, mean_prevalence}. "
+    "      This is the primary source for temporal trends.\n"
+    "    - by_site: list of records {site, country, n_samples, mean_prevalence, "
+    "      first_year, last_year}. This is the primary source for spatial "
+    "      and geographic variation.\n"
+    "    - by_study: list of study-level records "
+    "      {study_id, authors, year_pub, n_samples, year_min, year_max, mean_prev}. "
+    "      These provide supporting evidence about consistency across studies.\n"
+    "    - by_country_mutation and by_country_mutation_year (only when parsed_query "
+    "      lists several countries or mutations): records {country, mutation, n_samples, "
+    "      mean_prevalence, first_year, last_year} per pair, and {country, mutation, year, "
+    "      n_samples, mean_prevalence} per pair and year. Use these to compare the pairs.\n"
+    "    - note (only for large results): which sites and studies are listed "
+    "      individually; the last row of by_site/by_study then aggregates the rest. "
+    "      It also says when by_country_mutation_year pools years into periods "
+    "      {country, mutation, first_year, last_year, n_samples, mean_prevalence} "
+    "      or is left out.\n\n"
+    "Before writing the summary, extract the mutation name from parsed_query['mutation'] "
+    "(a list of names for comparison questions).\n"
+    "At the start of your response, include the mutation explicitly in the opening sentence.\n"
+    "For comparison questions, write one combined answer that contrasts the countries "
+    "and mutations rather than describing each one separately.\n"
+    "Throughout the response, always refer to this mutation when describing temporal trends, "
+    "site differences, and study-level evidence.\n\n"
+    "Please write a clear and concise scientific-style summary that follows these instructions:\n"
+    "1. **Start with a spatiotemporal overview**: Summarize how prevalence of this mutation "
+    "changes over time (using 'yearly') and across sites (using 'by_site') before discussing "
+    "any individual studies. Use specific years (e.g., 'from 2013 to 2017') and describe "
+    "approximate prevalence levels (e.g., low <1%, moderate 1–10%, high >10%).\n"
+    "2. **Temporal trend**: Use 'yearly' to describe increases, decreases, or stability "
+    "in mean_prevalence across years. Mention sample sizes when relevant.\n"
+    "3. **Spatial differences**: For each site you mention, ALWAYS include the country "
+    "by using the 'country' field in data_summary['by_site']. Write sites as '<site> (<country>)'.\n"
+    "4. **Study-level consistency**: Use 'by_study' **only as supporting examples**. "
+    "Cite studies briefly using 'Authors year_pub' to indicate whether findings across "
+    "studies are consistent or divergent. Do **not** focus on a single study if many exist.\n"
+    "5. **Caveats**: State any limitations visible in the data—uneven site coverage, "
+    "small sample sizes, missing years, or short time series.\n"
+    "6. **No invention**: Base all statements **only** on values present in the JSON. "
+    "Do not invent additional years, sites, or studies.\n"
+)
+
+
+def build_prompt(
+    question: str,
+    query: Dict[str, Any],
+    summary: Dict[str, Any],
+) -> Tuple[str, str]:
+    """
+    Build the (system, user) messages for the narrative call. The
+    summary is fitted to config.NARRATIVE_SUMMARY_TOKENS by build_context.
+    """
+    with tracing.span("prompt") as span:
+        summary, stats = build_context(summary)
+        span.update(stats)
+        CONTEXT_STATS["prompts"] += 1
+        CONTEXT_STATS["tokens_full"] += stats["tokens_full"]
+        CONTEXT_STATS["tokens_sent"] += stats["tokens_sent"]
+        if stats["sites_collapsed"] or stats["studies_collapsed"] or stats["cell_years"] != 1:
+            CONTEXT_STATS["compacted"] += 1
+            cells = {1: "", None: "; per-year cells left out"}.get(
+                stats["cell_years"], f"; per-year cells pooled into {stats['cell_years']}-year periods"
+            )
+            print(
+                f"Prompt summary compacted to ~{stats['tokens_sent']} tokens "
+                f"(saved ~{stats['tokens_saved']}; {stats['sites_collapsed']} sites and "
+                f"{stats['studies_collapsed']} studies collapsed{cells})"
+            )
+
+        context = {
+            "original_question": question,
+            "parsed_query": query,
+            "data_summary": summary,
+        }
+
+        user_msg = (
+            "Here is the structured data:\n\n"
+            + _dumps(context)
+            + "\n\nWrite the summary following the instructions."
+        )
+
+        span["prompt_chars"] = len(NARRATIVE_SYSTEM_MSG) + len(user_msg)
+        return NARRATIVE_SYSTEM_MSG, user_msg
+
+
+def _warm_or_prompt(
+    question: str,
+    query: Dict[str, Any],
+    summary: Dict[str, Any],
+    span: Dict[str, Any],
+) -> Tuple[Optional[str], Optional[Tuple[str, str]]]:
+    """
+    (stored answer, None) when the answer store has one for this summary,
+    else (None, (system, user) prompt) for the LLM.
+    """
+    warmed = answer_store.lookup(summary)
+    span["warm"] = warmed is not None
+    if warmed is not None:
+        return warmed, None
+    return None, build_prompt(question, query, summary)
 
-from src import config
 
 def llm_generate_answer(
     question: str,
@@ -13,61 +326,43 @@ def llm_generate_answer(
     Ask the local LLM to produce a scientific-style narrative based ONLY
     on the provided summary.
     """
-    system_msg = (
-        "You are an assistant helping a malaria genomicist interpret pre-computed "
-        "prevalence data and study metadata. You must ONLY use the numeric summaries "
-        "and study information provided. Do not invent new data or new studies. "
-        "If data are sparse or missing, say so explicitly. "
-        "Write clearly in a scientific but concise style."
-    )
-
-    context = {
-        "original_question": question,
-        "parsed_query": query,
-        "data_summary": summary,
-    }
+    with tracing.span("narrative") as span:
+        warmed, prompt = _warm_or_prompt(question, query, summary, span)
+        if warmed is not None:
+            return warmed
+        return config.call_llm(*prompt, tags=summarizer.partition_tags(query))
 
-    user_msg = (
-        "You are given structured summaries of malaria resistance prevalence data "
-        "for a specific user question.\n\n"
-        "The JSON below has the following structure:\n"
-        "- original_question: the user's natural language question.\n"
-        "- parsed_query: the structured filter (country, mutation, year range, etc.).\n"
-        "- data_summary:\n"
-        "    - has_data: whether any data exist for this query.\n"
-        "    - yearly: list of records {year, n_samples, mean_prevalence}. "
-        "      This is the primary source for temporal trends.\n"
-        "    - by_site: list of records {site, country, n_samples, mean_prevalence, "
-        "      first_year, last_year}. This is the primary source for spatial "
-        "      and geographic variation.\n"
-        "    - by_study: list of study-level records "
-        "      {study_id, authors, year_pub, n_samples, year_min, year_max, mean_prev}. "
-        "      These provide supporting evidence about consistency across studies.\n\n"
-        "Here is the structured data:\n\n"
-        + json.dumps(context, indent=2)
-        + "\n\n"
-        "Before writing the summary, extract the mutation name from parsed_query['mutation'].\n"
-        "At the start of your response, include the mutation explicitly in the opening sentence.\n"
-        "Throughout the response, always refer to this mutation when describing temporal trends, "
-        "site differences, and study-level evidence.\n\n"
-        "Please write a clear and concise scientific-style summary that follows these instructions:\n"
-        "1. **Start with a spatiotemporal overview**: Summarize how prevalence of this mutation "
-        "changes over time (using 'yearly') and across sites (using 'by_site') before discussing "
-        "any individual studies. Use specific years (e.g., 'from 2013 to 2017') and describe "
-        "approximate prevalence levels (e.g., low <1%, moderate 1–10%, high >10%).\n"
-        "2. **Temporal trend**: Use 'yearly' to describe increases, decreases, or stability "
-        "in mean_prevalence across years. Mention sample sizes when relevant.\n"
-        "3. **Spatial differences**: For each site you mention, ALWAYS include the country "
-        "by using the 'country' field in data_summary['by_site']. Write sites as '<site> (<country>)'.\n"
-        "4. **Study-level consistency**: Use 'by_study' **only as supporting examples**. "
-        "Cite studies briefly using 'Authors year_pub' to indicate whether findings across "
-        "studies are consistent or divergent. Do **not** focus on a single study if many exist.\n"
-        "5. **Caveats**: State any limitations visible in the data—uneven site coverage, "
-        "small sample sizes, missing years, or short time series.\n"
-        "6. **No invention**: Base all statements **only** on values present in the JSON. "
-        "Do not invent additional years, sites, or studies.\n"
-    )
-
-
-    answer = config.call_llm(system_msg, user_msg)
-    return answer
\ No newline at end of file
+
+async def allm_generate_answer(
+    question: str,
+    query: Dict[str, Any],
+    summary: Dict[str, Any],
+) -> str:
+    """
+    asyncio version of llm_generate_answer.
+    """
+    with tracing.span("narrative") as span:
+        warmed, prompt = _warm_or_prompt(question, query, summary, span)
+        if warmed is not None:
+            return warmed
+        return await config.acall_llm(*prompt, tags=summarizer.partition_tags(query))
+
+
+def llm_stream_answer(
+    question: str,
+    query: Dict[str, Any],
+    summary: Dict[str, Any],
+    on_token: Callable[[str], None],
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Streaming version of llm_generate_answer: on_token receives each token
+    as it is generated. Returns (answer, stats) with time-to-first-token
+    and tokens per second.
+    """
+    with tracing.span("narrative", streamed=True) as span:
+        start = time.perf_counter()
+        warmed, prompt = _warm_or_prompt(question, query, summary, span)
+        if warmed is not None:
+            on_token(warmed)
+            return warmed, config.cached_reply_stats(start)
+        return config.call_llm_stream(*prompt, on_token, tags=summarizer.partition_tags(query))
@@ -0,0 +1,27 @@
+"""
+Convert a prevalence table into a Parquet dataset partitioned by
+gene/mutation/country, which load_data and ChunkedSource can read with
+partition pruning.
+
+Usage:
+  python -m src.partition data/raw/all_who_get_prevalence.csv data/partitioned
+"""
+import argparse
+
+from .data_loader import write_partitioned
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help=".csv or .parquet file")
+    parser.add_argument("out_dir", help="output dataset directory (must be empty)")
+    parser.add_argument("--chunk-rows", type=int, default=None, help="rows read per chunk")
+    parser.add_argument("--row-group-rows", type=int, default=50_000, help="rows per Parquet row group")
+    args = parser.parse_args()
+
+    n = write_partitioned(args.source, args.out_dir, args.chunk_rows, args.row_group_rows)
+    print(f"Wrote {n} rows to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
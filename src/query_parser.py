@@ -1,33 +1,422 @@
+import contextlib
+import difflib
 import json
-from typing import Dict, Any
+import re
+from typing import Callable, ContextManager, Dict, Any, List, Optional, Tuple
 
-from src import config
+import pandas as pd
 
-def llm_question_to_query(question: str) -> Dict[str, Any]:
+from src import config, tracing
+from src.summarizer import label_key, normalize_mutation_label
+
+# How often each parsing path produced the final query ("rules" or "llm"),
+# and how often an LLM reply needed local repair: labels mapped onto the
+# data vocabulary ("repaired") or an unreadable reply replaced by a local
+# guess ("fallback")
+PARSE_STATS = {"rules": 0, "llm": 0, "repaired": 0, "fallback": 0}
+
+# Similarity needed to map a misspelled label onto a known one
+_FUZZY_CUTOFF = 0.85
+
+# Things that look like a mutation: '675V', 'C580Y', '675:V', 'k13_675V'
+_MUTATION_TOKEN = re.compile(
+    r"(?<![A-Za-z0-9])[A-Za-z]?(\d{2,4})[:_]?([A-Za-z])(?![A-Za-z0-9])"
+)
+_YEAR = r"((?:19|20)\d{2})"
+_YEAR_TOKEN = re.compile(r"(?<!\d)" + _YEAR + r"(?!\d)")
+_YEAR_RANGE = re.compile(
+    r"(?:from|between)?\s*" + _YEAR
+    + r"\s*(?:to|and|until|through|-|–)\s*" + _YEAR,
+    re.IGNORECASE,
+)
+_YEAR_MIN = re.compile(r"(?:after|since|from|starting)\s+(?:in\s+)?" + _YEAR, re.IGNORECASE)
+_YEAR_MAX = re.compile(r"(?:before|until|up to|through)\s+(?:in\s+)?" + _YEAR, re.IGNORECASE)
+_YEAR_EXACT = re.compile(r"(?:in|during)\s+" + _YEAR, re.IGNORECASE)
+# Capitalized words ('Kenya', 'Bissau'); mutation-like and all-caps
+# tokens ('K13', 'C580Y', 'WHO') are not matched
+_CAPITALIZED_WORD = re.compile(r"(?<![\w'’])[A-Z][a-z][A-Za-z'’]*(?![\w])")
+# Negations ('except Uganda', 'not kenya'); the excluded name may be one
+# the vocabulary does not know, so any of them defers to the LLM
+_NEGATION = re.compile(
+    r"(?<!\w)(?:except|excluding|exclude|not|other than|apart from|outside)(?!\w)", re.IGNORECASE
+)
+# Years counted back from today ('over the last 5 years', 'recent')
+_RELATIVE_TIME = re.compile(
+    r"(?<!\w)(?:(?:last|past|previous)\s+(?:\w+\s+)?(?:years?|decades?|months?)|recent(?:ly)?|"
+    r"decades?|latest|nowadays|currently|this year)(?!\w)",
+    re.IGNORECASE,
+)
+# Capitalized words that are not place names, e.g. at the start of a question
+_QUESTION_WORDS = frozenset(
+    "how what which where when who why whose is are was were has have had does do did can could "
+    "would should will compare comparing show list give tell describe summarize summarise please "
+    "in across from for between since after before during until through and or versus vs the "
+    "a an of at on over by with prevalence trend trends".split()
+)
+
+
+def build_vocabulary(df: pd.DataFrame) -> Dict[str, Dict[str, Any]]:
     """
-    Ask the local LLM to turn a free-text question into a JSON query spec.
+    Build lookup tables for the rule-based parser from the loaded data.
 
     Returns a dict with keys:
-      country (str or null)
-      mutation (str or null)
-      year_min (int or null)
-      year_max (int or null)
+      countries: label_key of the name -> canonical country
+      sites:     label_key of the name -> list of countries the site belongs to
+      mutations: upper-cased label (e.g. '675V') -> canonical mutation
+    """
+    if isinstance(df, pd.DataFrame):
+        labels = df[["country", "site", "mutation"]]
+    else:
+        # Lazy source (data_loader.ChunkedSource)
+        labels = df.distinct(["country", "site", "mutation"])
+
+    countries = {
+        label_key(c): str(c) for c in labels["country"].dropna().unique()
+    }
+
+    sites: Dict[str, List[str]] = {}
+    pairs = labels[["site", "country"]].dropna().drop_duplicates()
+    for site, country in pairs.itertuples(index=False):
+        sites.setdefault(label_key(site), []).append(str(country))
+
+    mutations = {
+        str(m).upper(): str(m) for m in labels["mutation"].dropna().unique()
+    }
+
+    return {"countries": countries, "sites": sites, "mutations": mutations}
+
+
+def _find_names(text: str, names) -> List[Tuple[int, int, str]]:
+    """
+    Find whole-word occurrences of names in lower-cased text, preferring
+    longer names so 'Democratic Republic of the Congo' beats 'Congo'.
+    """
+    found = []
+    taken = [False] * len(text)
+    for name in sorted(names, key=len, reverse=True):
+        pattern = r"(?<!\w)" + re.escape(name) + r"(?!\w)"
+        for m in re.finditer(pattern, text):
+            if any(taken[m.start():m.end()]):
+                continue
+            taken[m.start():m.end()] = [True] * (m.end() - m.start())
+            found.append((m.start(), m.end(), name))
+    return found
+
+
+def _parse_years(question: str) -> Tuple[Optional[int], Optional[int], bool]:
+    """
+    Pull a year range out of the question.
+    Returns (year_min, year_max, ok); ok is False when years are present
+    but could not be read unambiguously.
+    """
+    years = _YEAR_TOKEN.findall(question)
+    if not years:
+        return None, None, True
+
+    m = _YEAR_RANGE.search(question)
+    if m:
+        lo, hi = sorted((int(m.group(1)), int(m.group(2))))
+        return lo, hi, len(years) == 2
+
+    year_min = year_max = None
+    used = 0
+    m = _YEAR_MIN.search(question)
+    if m:
+        year_min = int(m.group(1))
+        used += 1
+    m = _YEAR_MAX.search(question)
+    if m:
+        year_max = int(m.group(1))
+        used += 1
+    if used == 0:
+        m = _YEAR_EXACT.search(question)
+        if m:
+            year_min = year_max = int(m.group(1))
+            used = 1
+
+    if year_min is not None and year_max is not None and year_min > year_max:
+        # 'before 2010 or after 2018' is two ranges, not one
+        return year_min, year_max, False
+    return year_min, year_max, used == len(years) and used > 0
+
+
+def rule_based_query(
+    question: str,
+    vocab: Dict[str, Dict[str, Any]],
+) -> Optional[Dict[str, Any]]:
+    """
+    Try to parse a question without the LLM, using vocabularies built
+    from the loaded data (see build_vocabulary).
+
+    Several named countries or mutations (comparison questions) give a
+    list in that field, in the order they appear in the question.
+
+    Returns the query dict, or None if the parse is ambiguous or incomplete
+    (no mutation, a site in several countries, capitalized words that are
+    not known places, unknown mutation labels, a negation such as 'except',
+    relative time such as 'the last 5 years', or years that could not be
+    read as one range).
     """
-    system_msg = (
-        "You convert user questions about malaria genomic prevalence "
-        "into a strict JSON query specification.\n"
-        "Supported fields: country (string or null), mutation (string or null), "
-        "year_min (integer or null), year_max (integer or null).\n"
-        "If a field is not specified in the question, set it to null.\n"
-        "Return ONLY valid JSON, no extra text."
+    text = question.lower()
+    if _NEGATION.search(question) or _RELATIVE_TIME.search(question):
+        return None
+
+    # Mutations: every mutation-like token must be known
+    mutations: Dict[str, None] = {}
+    for m in _MUTATION_TOKEN.finditer(question):
+        label = (m.group(1) + m.group(2)).upper()
+        if label not in vocab["mutations"]:
+            if _YEAR_TOKEN.fullmatch(m.group(1)):
+                continue  # e.g. '2015s'
+            return None
+        mutations[vocab["mutations"][label]] = None
+    if not mutations:
+        return None
+
+    # Countries, falling back to a site that belongs to exactly one country
+    country_hits = sorted(_find_names(text, vocab["countries"]))
+    countries = dict.fromkeys(vocab["countries"][name] for _, _, name in country_hits)
+    matched = [(s, e) for s, e, _ in country_hits]
+    if not countries:
+        site_countries = set()
+        for s, e, name in _find_names(text, vocab["sites"]):
+            site_countries.update(vocab["sites"][name])
+            matched.append((s, e))
+        if len(site_countries) > 1:
+            return None
+        countries = dict.fromkeys(site_countries)
+
+    # A capitalized word outside the recognised names is a place the data
+    # vocabulary does not cover ('Kenya' in 'Uganda and Kenya') or part of
+    # a longer name around a known one ('South Sudan', 'Republic of the
+    # Congo'); let the LLM decide.
+    for m in _CAPITALIZED_WORD.finditer(question):
+        if m.group().lower() in _QUESTION_WORDS:
+            continue
+        if not any(s <= m.start() < e for s, e in matched):
+            return None
+
+    year_min, year_max, years_ok = _parse_years(question)
+    if not years_ok:
+        return None
+
+    return {
+        "country": _one_or_list(list(countries)),
+        "mutation": _one_or_list(list(mutations)),
+        "year_min": year_min,
+        "year_max": year_max,
+    }
+
+
+def guess_query(question: str, vocab: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Best-effort local guess of the query for a question the rule-based
+    parser gave up on: known mutations and countries (or the country of
+    a site that belongs to only one) and whatever years could be read.
+    Unknown labels are ignored rather than rejected, so the guess may be
+    wrong; it is only used to start work early (see src.speculate).
+    """
+    text = question.lower()
+    mutations = dict.fromkeys(
+        vocab["mutations"][label]
+        for label in ((m.group(1) + m.group(2)).upper() for m in _MUTATION_TOKEN.finditer(question))
+        if label in vocab["mutations"]
     )
+    countries = dict.fromkeys(vocab["countries"][name] for _, _, name in sorted(_find_names(text, vocab["countries"])))
+    if not countries:
+        site_countries = {c for _, _, name in _find_names(text, vocab["sites"]) for c in vocab["sites"][name]}
+        if len(site_countries) == 1:
+            countries = dict.fromkeys(site_countries)
+    year_min, year_max, _ = _parse_years(question)
+    return {
+        "country": _one_or_list(list(countries)),
+        "mutation": _one_or_list(list(mutations)),
+        "year_min": year_min,
+        "year_max": year_max,
+    }
+
+
+def _one_or_list(values: List[str]) -> Any:
+    if not values:
+        return None
+    return values[0] if len(values) == 1 else values
+
+
+def _rules_parse(
+    question: str,
+    vocab: Optional[Dict[str, Dict[str, Any]]],
+    span: Dict[str, Any],
+) -> Optional[Dict[str, Any]]:
+    """
+    rule_based_query when a vocabulary is available, counted in
+    PARSE_STATS and the parse span; None means the LLM has to parse.
+    """
+    query = rule_based_query(question, vocab) if vocab is not None else None
+    span["source"] = "llm" if query is None else "rules"
+    if query is not None:
+        PARSE_STATS["rules"] += 1
+        span["query"] = query
+    return query
 
-    raw = config.call_llm(system_msg, question)
 
+def _llm_parsed(query: Dict[str, Any], span: Dict[str, Any]) -> Dict[str, Any]:
+    PARSE_STATS["llm"] += 1
+    span["query"] = query
+    return query
+
+
+def parse_question(
+    question: str,
+    vocab: Optional[Dict[str, Dict[str, Any]]] = None,
+    gate: Callable[[], ContextManager] = contextlib.nullcontext,
+) -> Tuple[Dict[str, Any], str]:
+    """
+    Turn a question into a query, trying the rule-based parser first and
+    only calling the LLM when that parse is ambiguous or incomplete.
+    gate() is entered around the LLM call only (e.g. a concurrency
+    limit), so rules-only parses never wait on it.
+
+    Returns (query, source) where source is "rules" or "llm".
+    """
+    with tracing.span("parse", question_chars=len(question)) as span:
+        query = _rules_parse(question, vocab, span)
+        if query is not None:
+            return query, "rules"
+        with gate():
+            query = llm_question_to_query(question, vocab)
+        return _llm_parsed(query, span), "llm"
+
+
+async def aparse_question(
+    question: str,
+    vocab: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> Tuple[Dict[str, Any], str]:
+    """
+    asyncio version of parse_question.
+    """
+    with tracing.span("parse", question_chars=len(question)) as span:
+        query = _rules_parse(question, vocab, span)
+        if query is not None:
+            return query, "rules"
+        return _llm_parsed(await allm_question_to_query(question, vocab), span), "llm"
+
+
+QUERY_SYSTEM_MSG = (
+    "You convert user questions about malaria genomic prevalence "
+    "into a strict JSON query specification.\n"
+    "Supported fields: country (string or null), mutation (string or null), "
+    "year_min (integer or null), year_max (integer or null).\n"
+    "If the question compares several countries or mutations, give that field "
+    "as a list of strings.\n"
+    "If a field is not specified in the question, set it to null.\n"
+    "Return ONLY valid JSON, no extra text."
+)
+
+
+_NULLABLE_LABEL = {
+    "anyOf": [{"type": "string"}, {"type": "array", "items": {"type": "string"}}, {"type": "null"}]
+}
+_NULLABLE_YEAR = {"anyOf": [{"type": "integer"}, {"type": "null"}]}
+
+# JSON schema the parse reply is constrained to (Ollama's format option)
+QUERY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "country": _NULLABLE_LABEL,
+        "mutation": _NULLABLE_LABEL,
+        "year_min": _NULLABLE_YEAR,
+        "year_max": _NULLABLE_YEAR,
+    },
+    "required": ["country", "mutation", "year_min", "year_max"],
+    "additionalProperties": False,
+}
+
+
+def _parse_request() -> Dict[str, Any]:
+    return {
+        "format": QUERY_SCHEMA,
+        "options": {"temperature": config.PARSE_TEMPERATURE, "num_predict": config.PARSE_NUM_PREDICT},
+    }
+
+
+def _repair_country(value: str, vocab: Dict[str, Dict[str, Any]]) -> str:
+    key = label_key(value)
+    countries = vocab["countries"]
+    if key in countries:
+        return countries[key]
+    sites = vocab["sites"].get(key, [])
+    if len(sites) == 1:
+        return sites[0]
+    # No matching on a known name inside a longer one: 'South Sudan' is not
+    # 'Sudan', nor 'Equatorial Guinea' 'Guinea'
+    close = difflib.get_close_matches(key, list(countries), n=1, cutoff=_FUZZY_CUTOFF)
+    return countries[close[0]] if close else value
+
+
+def _repair_mutation(value: str, vocab: Dict[str, Dict[str, Any]]) -> str:
+    mutations = vocab["mutations"]
+    label = normalize_mutation_label(value)
+    if label in mutations:
+        return mutations[label]
+    # 'K13-675V', 'pfkelch13 C580Y'
+    for m in _MUTATION_TOKEN.finditer(value):
+        label = (m.group(1) + m.group(2)).upper()
+        if label in mutations:
+            return mutations[label]
+    close = difflib.get_close_matches(value.strip().upper(), list(mutations), n=1, cutoff=_FUZZY_CUTOFF)
+    return mutations[close[0]] if close else value
+
+
+def _year(value: Any) -> Optional[int]:
+    try:
+        return int(str(value).strip()[:4]) if value not in (None, "") else None
+    except ValueError:
+        return None
+
+
+def repair_query(query: Dict[str, Any], vocab: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Check an LLM query against the data vocabulary: country and mutation
+    labels are mapped onto known ones (site names, other mutation
+    spellings and close misspellings), years are coerced
+    to integers and put in order. Labels that match nothing are kept, so
+    the query finds no data rather than silently widening.
+    """
+    repaired = {}
+    for field, repair in [("country", _repair_country), ("mutation", _repair_mutation)]:
+        value = query.get(field)
+        values = value if isinstance(value, list) else [value]
+        values = [repair(str(v), vocab) for v in values if v not in (None, "")]
+        repaired[field] = _one_or_list(list(dict.fromkeys(values)))
+    year_min, year_max = _year(query.get("year_min")), _year(query.get("year_max"))
+    if year_min is not None and year_max is not None and year_min > year_max:
+        year_min, year_max = year_max, year_min
+    repaired["year_min"], repaired["year_max"] = year_min, year_max
+    return repaired
+
+
+def _query_from_reply(
+    raw: str,
+    question: str,
+    vocab: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
     try:
         query = json.loads(raw)
     except json.JSONDecodeError:
-        raise ValueError(f"LLM did not return valid JSON:\n{raw}")
+        # Cut off by num_predict or wrapped in prose; try the outermost object
+        match = re.search(r"\{.*\}", raw, re.DOTALL)
+        try:
+            query = json.loads(match.group(0)) if match else None
+        except json.JSONDecodeError:
+            query = None
+
+    if not isinstance(query, dict):
+        guess = guess_query(question, vocab) if vocab is not None else None
+        if guess is None or (guess["country"] is None and guess["mutation"] is None):
+            # A guess with no labels would summarize the whole table
+            raise ValueError(f"LLM did not return valid JSON:\n{raw}")
+        PARSE_STATS["fallback"] += 1
+        return guess
 
     # Basic normalization / defaults
     query.setdefault("country", None)
@@ -35,4 +424,41 @@ def llm_question_to_query(question: str) -> Dict[str, Any]:
     query.setdefault("year_min", None)
     query.setdefault("year_max", None)
 
-    return query
\ No newline at end of file
+    if vocab is not None:
+        repaired = repair_query(query, vocab)
+        if repaired != {k: query[k] for k in repaired}:
+            PARSE_STATS["repaired"] += 1
+        query = repaired
+    return query
+
+
+def llm_question_to_query(
+    question: str,
+    vocab: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """
+    Ask the local LLM to turn a free-text question into a JSON query spec.
+    The reply is constrained to QUERY_SCHEMA; with vocab, labels are
+    repaired against the data (repair_query) and an unreadable reply
+    falls back to guess_query instead of failing, unless the guess names
+    no country or mutation (ValueError, as without vocab).
+
+    Returns a dict with keys:
+      country (str or null)
+      mutation (str or null)
+      year_min (int or null)
+      year_max (int or null)
+    """
+    raw = config.call_llm(QUERY_SYSTEM_MSG, question, role="parse", **_parse_request())
+    return _query_from_reply(raw, question, vocab)
+
+
+async def allm_question_to_query(
+    question: str,
+    vocab: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """
+    asyncio version of llm_question_to_query.
+    """
+    raw = await config.acall_llm(QUERY_SYSTEM_MSG, question, role="parse", **_parse_request())
+    return _query_from_reply(raw, question, vocab)
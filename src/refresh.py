@@ -0,0 +1,210 @@
+"""
+Refresh of a loaded dataset when a new export of its source arrives.
+
+The new export is loaded as a whole and served as is. It is compared with
+the previous table per study: each study's rows are reduced to a count
+and an order-independent digest of their content hashes, which gives the
+studies that are new, changed or gone. Cube cells are rebuilt only for
+the (country, mutation) partitions whose rows changed, and only the
+cached LLM answers tagged with those partitions are dropped.
+"""
+import time
+from typing import Dict, Any, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from . import config, query_parser
+from .data_loader import build_cube, load_data, save_cube, source_hash
+from .index import PrevalenceIndex
+from .summarizer import partition_tag
+
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """
+    64-bit content hash of every row (categoricals hash their labels, so
+    tables with different category sets still compare equal).
+    """
+    return pd.util.hash_pandas_object(df[sorted(df.columns)], index=False).to_numpy()
+
+
+def _digests(codes: np.ndarray, n_groups: int, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Per group: row count and wrap-around sum of row hashes, which does not
+    depend on row order.
+    """
+    counts = np.bincount(codes, minlength=n_groups)
+    sums = np.zeros(n_groups, dtype=np.uint64)
+    np.add.at(sums, codes, hashes)
+    return counts, sums
+
+
+def study_digests(df: pd.DataFrame, hashes: Optional[np.ndarray] = None) -> Dict[Any, Tuple[int, int]]:
+    """
+    study_id -> (row count, digest of its rows).
+    """
+    if hashes is None:
+        hashes = row_hashes(df)
+    codes, ids = pd.factorize(df["study_id"], use_na_sentinel=False)
+    counts, sums = _digests(codes, len(ids), hashes)
+    return {study: (int(n), int(h)) for study, n, h in zip(ids, counts, sums)}
+
+
+def diff_studies(old: pd.DataFrame, new: pd.DataFrame) -> Dict[str, Set[Any]]:
+    """
+    Studies added, changed (same study_id, different rows) or removed
+    between two versions of the table.
+    """
+    before = study_digests(old)
+    after = study_digests(new)
+    return {
+        "added": set(after) - set(before),
+        "changed": {s for s in after.keys() & before.keys() if after[s] != before[s]},
+        "removed": set(before) - set(after),
+    }
+
+
+def concat_categorical(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate frames whose categorical columns have different category
+    sets. New categories are appended after the first frame's, so its
+    codes stay valid.
+    """
+    frames = [f for f in frames if len(f)] or frames[:1]
+    base = frames[0]
+    columns = {}
+    for col in base.columns:
+        if not isinstance(base[col].dtype, pd.CategoricalDtype):
+            continue
+        categories = base[col].cat.categories
+        extra = [
+            f[col].astype("category").cat.categories.difference(categories, sort=False)
+            for f in frames[1:]
+        ]
+        extra = [e for e in extra if len(e)]
+        if extra:
+            categories = categories.append(extra).drop_duplicates()
+        columns[col] = pd.CategoricalDtype(categories)
+    return pd.concat([f.astype(columns) for f in frames], ignore_index=True)
+
+
+def _pairs(frame: pd.DataFrame) -> Tuple[np.ndarray, List[str]]:
+    """
+    Group number of every row by (country, mutation), and the partition
+    tag of each group.
+    """
+    grouped = frame.groupby(["country", "mutation"], observed=True, dropna=False, sort=False)
+    tags = [partition_tag(str(c), str(m)) for c, m in grouped.size().index]
+    return grouped.ngroup().to_numpy(), tags
+
+
+def _in_partitions(frame: pd.DataFrame, tags: Set[str]) -> np.ndarray:
+    """
+    Rows of frame whose (country, mutation) partition tag is in tags.
+    """
+    groups, group_tags = _pairs(frame)
+    hit = np.array([tag in tags for tag in group_tags] + [False])
+    return hit[groups]
+
+
+def changed_partitions(old_rows: pd.DataFrame, new_rows: pd.DataFrame) -> Set[str]:
+    """
+    Tags of the partitions whose rows differ between old_rows and
+    new_rows. A study that changed in one partition leaves its other
+    partitions, and the cube cells and cached answers for them, alone.
+    """
+    digests = []
+    for rows in (old_rows, new_rows):
+        groups, tags = _pairs(rows)
+        counts, sums = _digests(groups, len(tags), row_hashes(rows))
+        digests.append({tag: (int(n), int(h)) for tag, n, h in zip(tags, counts, sums)})
+    before, after = digests
+    return {tag for tag in before.keys() | after.keys() if before.get(tag) != after.get(tag)}
+
+
+def update_cube(
+    cube: Dict[str, pd.DataFrame],
+    df: pd.DataFrame,
+    touched: Set[str],
+) -> Dict[str, pd.DataFrame]:
+    """
+    Rebuild the cube cells of the touched partitions from the updated
+    table and keep all other cells.
+    """
+    rows = _in_partitions(df, touched)
+    if rows.all():
+        # Every partition changed: nothing to keep
+        return build_cube(df)
+    fresh = build_cube(df[rows])
+    updated = {}
+    for name in ("sites", "studies"):
+        kept = cube[name][~_in_partitions(cube[name], touched)]
+        updated[name] = concat_categorical([kept, fresh[name]])
+    return updated
+
+
+def invalidation_tags(touched: Iterable[str]) -> Set[str]:
+    """
+    Cache tags to drop for touched partitions: the partitions themselves
+    and the country-wide, mutation-wide and global answers that cover them.
+    """
+    tags = set()
+    for tag in touched:
+        country, mutation = tag.split("|", 1)
+        tags.update({tag, f"*|{mutation}", f"{country}|*", "*|*"})
+    return tags
+
+
+def refresh_dataset(
+    path: str,
+    df: pd.DataFrame,
+    index: Optional[PrevalenceIndex] = None,
+    cube: Optional[Dict[str, pd.DataFrame]] = None,
+) -> Tuple[pd.DataFrame, Dict[str, Any], Optional[PrevalenceIndex], Optional[Dict[str, pd.DataFrame]], Dict[str, Any]]:
+    """
+    Bring a loaded (df, index, cube) up to date with the current contents
+    of path. The table, vocabulary and index come from the new export;
+    the cube and the LLM cache are only updated for the partitions that
+    changed. Returns (df, vocab, index, cube, report); the inputs are not
+    modified, so callers can swap the new state in atomically.
+    """
+    start = time.perf_counter()
+    sha256 = source_hash(path)
+    new = load_data(path, use_snapshot=config.USE_SNAPSHOT)
+
+    diff = diff_studies(df, new)
+    replace = diff["changed"] | diff["removed"]
+    incoming_ids = diff["added"] | diff["changed"]
+    report = {k: len(v) for k, v in diff.items()}
+
+    if not replace and not incoming_ids:
+        report.update(rows_removed=0, rows_added=0, partitions=0, cache_entries_dropped=0)
+        report["elapsed_s"] = time.perf_counter() - start
+        return df, query_parser.build_vocabulary(df), index, cube, report
+
+    # The new table is served as loaded; only the cube cells and cached
+    # answers of the partitions whose rows changed are redone
+    dropped = df["study_id"].isin(replace).to_numpy()
+    incoming = new["study_id"].isin(incoming_ids).to_numpy()
+    touched = changed_partitions(df[dropped], new[incoming])
+
+    vocab = query_parser.build_vocabulary(new)
+    if index is not None:
+        # Rebuilt from integer codes; no per-row strings involved
+        index = PrevalenceIndex(new)
+    if cube is not None:
+        cube = update_cube(cube, new, touched)
+        save_cube(path, cube, sha256)
+
+    removed_entries = 0
+    if config.LLM_CACHE_ENABLED:
+        removed_entries = config.get_cache().invalidate(invalidation_tags(touched))
+
+    report.update(
+        rows_removed=int(dropped.sum()),
+        rows_added=int(incoming.sum()),
+        partitions=len(touched),
+        cache_entries_dropped=removed_entries,
+        elapsed_s=time.perf_counter() - start,
+    )
+    return new, vocab, index, cube, report
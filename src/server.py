@@ -0,0 +1,325 @@
+"""
+Long-running local HTTP service: the dataset is loaded once and shared
+by every request.
+
+Endpoints (JSON in, JSON out):
+  POST /answer     {"question": ...}                      -> {"query", "parse_source", "answer"}
+  POST /parse      {"question": ...}                      -> {"query", "parse_source"}
+  POST /summary    {"query": {...}}                       -> summary
+  POST /narrative  {"question": ..., "query": {...}, "summary": {...}} -> {"answer"}
+  GET  /health                                            -> dataset version, load and LLM backends
+  GET  /metrics                                           -> p50/p95 per pipeline stage
+
+Usage:
+  python -m src.server --data data/raw/all_who_get_prevalence.csv --port 8000
+"""
+import argparse
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional
+
+import pandas as pd
+
+from . import answer_store, config, narrative, query_parser, speculate, summarizer, tracing
+from .data_loader import source_hash
+from .main import load_dataset
+from .refresh import refresh_dataset
+
+
+class DatasetState:
+    """
+    One loaded version of the dataset with its lookup structures.
+    Requests keep a reference to the state they started with, so a
+    reload never changes the data under an in-flight request.
+    """
+
+    def __init__(self, path: str, previous: Optional["DatasetState"] = None):
+        self.path = path
+        self.version = source_hash(path)
+        self.refresh_report = None
+        if previous is not None and isinstance(previous.df, pd.DataFrame):
+            # Cube cells and cached answers are kept for unchanged partitions
+            self.df, self.vocab, self.index, self.cube, self.refresh_report = refresh_dataset(
+                path, previous.df, previous.index, previous.cube
+            )
+            answer_store.activate(path)
+        else:
+            self.df, self.vocab, self.index, self.cube = load_dataset(path)
+        self.loaded_at = time.time()
+
+
+class PrevalenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, path: str, max_llm: int, queue_timeout: float):
+        super().__init__(address, RequestHandler)
+        self.path = path
+        self.state = DatasetState(path)
+        self.llm_slots = threading.BoundedSemaphore(max_llm)
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.reloading = False
+
+    def check_reload(self) -> bool:
+        """
+        Reload the dataset if the source changed (see refresh_dataset); the
+        new state is complete before it replaces the old one.
+        """
+        try:
+            version = source_hash(self.path)
+        except OSError as e:
+            print(f"Cannot read {self.path}: {e}")
+            return False
+        if version == self.state.version:
+            return False
+
+        print(f"Source changed; reloading {self.path}")
+        self.reloading = True
+        try:
+            self.state = DatasetState(self.path, previous=self.state)
+        finally:
+            self.reloading = False
+        print(f"Reloaded dataset version {self.state.version[:12]}")
+        report = self.state.refresh_report
+        if report is not None:
+            print(
+                f"  studies +{report['added']} ~{report['changed']} -{report['removed']}, "
+                f"rows +{report['rows_added']} -{report['rows_removed']}, "
+                f"{report['partitions']} partitions, "
+                f"{report['cache_entries_dropped']} cached answers dropped, "
+                f"{report['elapsed_s']:.2f} s"
+            )
+        return True
+
+    def watch(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                self.check_reload()
+            except Exception as e:
+                # Keep serving the previous version
+                print(f"Reload failed: {e}")
+
+
+# Body fields each route requires, with their JSON types
+REQUIRED_FIELDS = {
+    "/answer": {"question": str},
+    "/parse": {"question": str},
+    "/summary": {"query": dict},
+    "/narrative": {"question": str, "query": dict, "summary": dict},
+}
+
+
+def query_error(query: Dict[str, Any]) -> Optional[str]:
+    """
+    Why a query object cannot be summarized, or None if it can.
+    """
+    for name in ("country", "mutation"):
+        value = query.get(name)
+        values = value if isinstance(value, list) else [value]
+        if not all(v is None or isinstance(v, str) for v in values):
+            return f"field 'query.{name}' must be a string, a list of strings or null"
+    for name in ("year_min", "year_max"):
+        value = query.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+            return f"field 'query.{name}' must be an integer or null"
+    return None
+
+
+def body_error(path: str, body: Any) -> Optional[str]:
+    """
+    Why the request body does not fit the route, or None if it does.
+    """
+    if not isinstance(body, dict):
+        return "request body must be a JSON object"
+    for name, kind in REQUIRED_FIELDS.get(path, {}).items():
+        if name not in body:
+            return f"missing field {name!r}"
+        if not isinstance(body[name], kind):
+            return f"field {name!r} must be a JSON {'string' if kind is str else 'object'}"
+    if "query" in REQUIRED_FIELDS.get(path, {}):
+        return query_error(body["query"])
+    return None
+
+
+class Busy(Exception):
+    pass
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    @contextmanager
+    def _llm_slot(self):
+        """
+        Hold one of the server's LLM slots; Busy if none frees up within
+        queue_timeout.
+        """
+        if not self.server.llm_slots.acquire(timeout=self.server.queue_timeout):
+            raise Busy()
+        try:
+            yield
+        finally:
+            self.server.llm_slots.release()
+
+    def _llm(self, fn, *args):
+        """
+        Run an LLM-backed call within the server's concurrency limit.
+        """
+        with self._llm_slot():
+            return fn(*args)
+
+    def _parse_question(self, question: str, vocab):
+        # Only a parse that falls back to the LLM takes a slot
+        return query_parser.parse_question(question, vocab, gate=self._llm_slot)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send_json(200, tracing.metrics_summary())
+            return
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        state = self.server.state
+        self._send_json(200, {
+            "dataset_version": state.version,
+            "loaded_at": state.loaded_at,
+            "reloading": self.server.reloading,
+            "last_refresh": state.refresh_report,
+            "in_flight": self.server.in_flight,
+            "parse_stats": query_parser.PARSE_STATS,
+            "llm_backends": config.get_dispatcher().stats(),
+            "speculation": speculate.SPEC_STATS,
+        })
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "invalid JSON"})
+            return
+
+        routes = {
+            "/answer": self._answer,
+            "/parse": self._parse,
+            "/summary": self._summary,
+            "/narrative": self._narrative,
+        }
+        route = routes.get(self.path)
+        if route is None:
+            self._send_json(404, {"error": "not found"})
+            return
+        error = body_error(self.path, body)
+        if error is not None:
+            self._send_json(400, {"error": error})
+            return
+
+        state = self.server.state
+        with self.server.lock:
+            self.server.in_flight += 1
+        try:
+            self._send_json(200, route(state, body))
+        except Busy:
+            self._send_json(503, {"error": "too many concurrent LLM requests; try again"})
+        except (KeyError, TypeError, ValueError) as e:
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def _parse(self, state: DatasetState, body: Dict[str, Any]) -> Dict[str, Any]:
+        query, source = self._parse_question(body["question"], state.vocab)
+        return {"query": query, "parse_source": source}
+
+    def _summary(self, state: DatasetState, body: Dict[str, Any]) -> Dict[str, Any]:
+        return summarizer.summarize_query(state.df, body["query"], state.index, state.cube)
+
+    def _narrative(self, state: DatasetState, body: Dict[str, Any]) -> Dict[str, Any]:
+        answer = self._llm(narrative.llm_generate_answer, body["question"], body["query"], body["summary"])
+        return {"answer": answer}
+
+    def _answer(self, state: DatasetState, body: Dict[str, Any]) -> Dict[str, Any]:
+        with tracing.trace(body["question"]):
+            if config.SPECULATIVE_PARSE:
+                query, source, summary = speculate.parse_and_summarize(
+                    state.df, body["question"], state.vocab, state.index, state.cube,
+                    parse=self._parse_question,
+                )
+                parsed = {"query": query, "parse_source": source}
+            else:
+                parsed, summary = self._parse(state, body), None
+            if summary is None:
+                summary = self._summary(state, {"query": parsed["query"]})
+            answer = self._narrative(state, {"question": body["question"], "query": parsed["query"], "summary": summary})
+            return {**parsed, **answer}
+
+
+def serve(
+    path: str,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_llm: int = 2,
+    queue_timeout: float = 120.0,
+    reload_interval: Optional[float] = 10.0,
+) -> PrevalenceServer:
+    """
+    Load the dataset and start serving in a background thread.
+    Returns the server; call shutdown() to stop it.
+    """
+    server = PrevalenceServer((host, port), path, max_llm, queue_timeout)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    if reload_interval:
+        threading.Thread(target=server.watch, args=(reload_interval,), daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=config.DATA_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-llm", type=int, default=2, help="concurrent requests sent to Ollama")
+    parser.add_argument("--queue-timeout", type=float, default=120.0, help="seconds to wait for an LLM slot before 503")
+    parser.add_argument("--reload-interval", type=float, default=10.0, help="seconds between source checks (0 disables)")
+    parser.add_argument("--trace-log", help="write per-stage timings as JSON lines to this file")
+    parser.add_argument("--backend", action="append", help="Ollama URL to spread LLM calls over (repeat for several)")
+    parser.add_argument("--speculate", action="store_true", help="summarize a local guess while the LLM parses")
+    args = parser.parse_args()
+
+    if args.trace_log:
+        config.TRACE_LOG_PATH = args.trace_log
+    if args.backend:
+        config.LLM_BACKENDS = [{"url": url} for url in args.backend]
+    if args.speculate:
+        config.SPECULATIVE_PARSE = True
+
+    config.LLM_POOL_SIZE = max(config.LLM_POOL_SIZE, args.max_llm)
+    server = serve(args.data, args.host, args.port, args.max_llm, args.queue_timeout, args.reload_interval)
+    print(f"Serving on http://{args.host}:{server.server_address[1]} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
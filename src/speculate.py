@@ -0,0 +1,164 @@
+"""
+Speculative parsing: overlap the data work with the LLM parse.
+
+When a question needs the LLM to parse, a local guess of the query
+(query_parser.guess_query) is summarized in the background while the
+parse request is in flight. If the parsed query selects the same data as
+the guess, the prefetched summary is used; otherwise it is discarded and
+the summary is computed for the parsed query as usual.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict, Any, Optional, Tuple
+
+from . import config, query_parser, summarizer, tracing
+
+# Speculation outcomes; saved_s is the summary time taken off the
+# critical path by hits (prefetch time minus time still waited for it)
+SPEC_STATS = {"speculated": 0, "hits": 0, "misses": 0, "saved_s": 0.0, "wasted_s": 0.0}
+_stats_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> Executor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.SPECULATIVE_WORKERS, thread_name_prefix="speculate")
+    return _executor
+
+
+def _year(value: Any) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _normalized(query: Dict[str, Any]) -> Tuple:
+    countries = summarizer.query_values(query, "country") or []
+    mutations = summarizer.query_values(query, "mutation") or []
+    return (
+        tuple(sorted({summarizer.label_key(c) for c in countries})),
+        tuple(sorted({summarizer.normalize_mutation_label(str(m)) for m in mutations})),
+        # Single values and lists give different summary shapes
+        len(countries) > 1 or len(mutations) > 1,
+        _year(query.get("year_min")),
+        _year(query.get("year_max")),
+    )
+
+
+def queries_match(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    """
+    True if two queries select the same rows with the same summary shape
+    (ignoring label case, mutation spelling and value order).
+    """
+    return _normalized(a) == _normalized(b)
+
+
+def _prefetch(df, guess: Dict[str, Any], index, cube) -> Tuple[Dict[str, Any], float]:
+    with tracing.span("prefetch"):
+        start = time.perf_counter()
+        return summarizer.summarize_query(df, guess, index, cube), time.perf_counter() - start
+
+
+def _record_hit(prefetch_s: float, waited_s: float) -> float:
+    saved = max(prefetch_s - waited_s, 0.0)
+    with _stats_lock:
+        SPEC_STATS["speculated"] += 1
+        SPEC_STATS["hits"] += 1
+        SPEC_STATS["saved_s"] += saved
+    return saved
+
+
+def _record_miss(future) -> None:
+    # Called when the discarded prefetch finishes
+    with _stats_lock:
+        SPEC_STATS["speculated"] += 1
+        SPEC_STATS["misses"] += 1
+        if not future.cancelled() and future.exception() is None:
+            SPEC_STATS["wasted_s"] += future.result()[1]
+
+
+def _guess(question: str, vocab: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    The query to prefetch, or None when the rules parse the question (no
+    LLM wait to overlap) or there is no vocabulary to guess from.
+    """
+    if vocab is None or query_parser.rule_based_query(question, vocab) is not None:
+        return None
+    return query_parser.guess_query(question, vocab)
+
+
+def _hit(query: Dict[str, Any], guess: Dict[str, Any], future, span: Dict[str, Any]) -> bool:
+    """
+    Whether the prefetch for guess can be used for the parsed query. On a
+    miss the prefetch finishes in the background and its result is dropped.
+    """
+    span["hit"] = queries_match(query, guess)
+    if not span["hit"]:
+        future.add_done_callback(_record_miss)
+    return span["hit"]
+
+
+def parse_and_summarize(
+    df,
+    question: str,
+    vocab: Optional[Dict[str, Any]],
+    index=None,
+    cube=None,
+    parse: Callable = query_parser.parse_question,
+) -> Tuple[Dict[str, Any], str, Optional[Dict[str, Any]]]:
+    """
+    Parse the question, prefetching the summary of a guessed query while
+    an LLM parse is in flight. Returns (query, source, summary); summary
+    is None when nothing was prefetched or the guess was wrong, and the
+    caller computes it for the query.
+    """
+    guess = _guess(question, vocab)
+    if guess is None:
+        query, source = parse(question, vocab)
+        return query, source, None
+
+    future = _get_executor().submit(contextvars.copy_context().run, _prefetch, df, guess, index, cube)
+    with tracing.span("speculate") as span:
+        query, source = parse(question, vocab)
+        if not _hit(query, guess, future, span):
+            return query, source, None
+        start = time.perf_counter()
+        summary, prefetch_s = future.result()
+        span["saved_s"] = _record_hit(prefetch_s, time.perf_counter() - start)
+        return query, source, summary
+
+
+async def aparse_and_summarize(
+    df,
+    question: str,
+    vocab: Optional[Dict[str, Any]],
+    index=None,
+    cube=None,
+    executor: Optional[Executor] = None,
+) -> Tuple[Dict[str, Any], str, Optional[Dict[str, Any]]]:
+    """
+    asyncio version of parse_and_summarize; the prefetch runs in executor
+    (the loop's default thread pool if None).
+    """
+    guess = _guess(question, vocab)
+    if guess is None:
+        query, source = await query_parser.aparse_question(question, vocab)
+        return query, source, None
+
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(executor, contextvars.copy_context().run, _prefetch, df, guess, index, cube)
+    with tracing.span("speculate") as span:
+        query, source = await query_parser.aparse_question(question, vocab)
+        if not _hit(query, guess, future, span):
+            return query, source, None
+        start = time.perf_counter()
+        summary, prefetch_s = await future
+        span["saved_s"] = _record_hit(prefetch_s, time.perf_counter() - start)
+        return query, source, summary
@@ -1,93 +1,409 @@
+import numpy as np
 import pandas as pd
-from typing import Dict, Any
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
 
-def filter_data(df: pd.DataFrame, query: Dict[str, Any]) -> pd.DataFrame:
-    subset = df.copy()
+from src import tracing
 
-    if query.get("country"):
-        subset = subset[subset["country"].str.lower() ==
-                        query["country"].lower()]
+# Columns the row summaries read; the rest of the table is never touched
+SUMMARY_COLUMNS = ["year", "site", "country", "mutation", "n_samples", "prevalence", "study_id", "authors", "year_pub"]
 
-    if query.get("mutation"):
-        norm = normalize_mutation_label(query["mutation"])
+
+def filter_data(df: pd.DataFrame, query: Dict[str, Any], index=None) -> pd.DataFrame:
+    """
+    Select the rows matching the query. If a PrevalenceIndex built from df
+    is given, the lookup goes through the index instead of scanning and
+    copying the whole table.
+    """
+    with tracing.span("filter", indexed=index is not None) as span:
+        subset = _filter_rows(df, query, index)
+        if isinstance(subset, pd.DataFrame):
+            span["rows"] = len(subset)
+        return subset
+
+
+def select_rows(df: pd.DataFrame, query: Dict[str, Any], index=None) -> Optional[np.ndarray]:
+    """
+    Positions of the rows matching the query, or None for all rows. Like
+    filter_data without building the subset table; pass the result to
+    summarize_rows.
+    """
+    with tracing.span("filter", indexed=index is not None) as span:
+        if index is not None:
+            if len(df) != index.n_rows:
+                raise ValueError("Index was built for a different table; rebuild it after reloading data")
+            positions = index.positions(query)
+        else:
+            mask = _row_mask(df, query)
+            positions = None if mask.all() else np.flatnonzero(mask)
+        span["rows"] = len(df) if positions is None else len(positions)
+        return positions
+
+
+def _filter_rows(df: pd.DataFrame, query: Dict[str, Any], index=None) -> pd.DataFrame:
+    if not isinstance(df, pd.DataFrame):
+        # Lazy source (data_loader.ChunkedSource): push the filter down
+        return df.filter(query)
+
+    if index is not None:
+        return index.filter(df, query)
+
+    return df[_row_mask(df, query)]
+
+
+def _row_mask(df: pd.DataFrame, query: Dict[str, Any]) -> np.ndarray:
+    mask = np.ones(len(df), dtype=bool)
+
+    countries = query_values(query, "country")
+    if countries:
+        mask &= _label_mask(df["country"], [label_key(c) for c in countries])
+
+    mutations = query_values(query, "mutation")
+    if mutations:
         # df["mutation"] is like '675V'
-        subset = subset[subset["mutation"].str.upper() == norm]
+        mask &= _label_mask(df["mutation"], [label_key(normalize_mutation_label(m)) for m in mutations])
 
     if query.get("year_min") is not None:
-        subset = subset[subset["year"] >= int(query["year_min"])]
+        mask &= (df["year"] >= int(query["year_min"])).to_numpy()
 
     if query.get("year_max") is not None:
-        subset = subset[subset["year"] <= int(query["year_max"])]
+        mask &= (df["year"] <= int(query["year_max"])).to_numpy()
 
-    return subset
+    return mask
 
 
-def summarize_prevalence(subset: pd.DataFrame) -> Dict[str, Any]:
+def is_comparison(query: Dict[str, Any]) -> bool:
     """
-    Produce a compact summary of the numeric + geographic patterns
-    to feed into the LLM.
+    True if the query lists several countries or mutations, in which
+    case summaries also break results down per (country, mutation).
     """
-    if subset.empty:
-        return {"has_data": False}
+    return any(len(query_values(query, key) or []) > 1 for key in ("country", "mutation"))
+
+
+def query_values(query: Dict[str, Any], key: str) -> Optional[List[str]]:
+    """
+    The query's country or mutation as a list (the field may hold one
+    label or a list of them), or None when the field is empty.
+    """
+    value = query.get(key)
+    if not value:
+        return None
+    if isinstance(value, str):
+        return [value]
+    return [v for v in value if v] or None
+
+
+def partition_tag(country: Optional[str], mutation: Optional[str]) -> str:
+    """
+    Cache tag for one (country, mutation) partition; None stands for all.
+    """
+    country = label_key(country) if country else "*"
+    mutation = normalize_mutation_label(mutation) if mutation else "*"
+    return f"{country}|{mutation}"
+
+
+def partition_tags(query: Dict[str, Any]) -> List[str]:
+    """
+    Tags of the (country, mutation) partitions a query's results depend on.
+    """
+    return [
+        partition_tag(c, m)
+        for c in query_values(query, "country") or [None]
+        for m in query_values(query, "mutation") or [None]
+    ]
+
+
+def label_key(label: Any) -> str:
+    """
+    Form of a label that lookups compare: surrounding spaces and case are
+    ignored. Used by the scan, index (labels.LabelTable), cube, vocabulary
+    and cache tags alike, so every path matches the same rows.
+    """
+    return str(label).strip().lower()
+
+
+def _label_mask(values: pd.Series, keys: List[str]) -> np.ndarray:
+    """
+    Rows whose label_key is one of keys. Categorical columns only
+    transform their distinct categories and match rows on the integer
+    codes.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = values.cat.categories.str.strip().str.lower()
+        return np.isin(values.array.codes, np.flatnonzero(categories.isin(keys)))
+    return values.str.strip().str.lower().isin(keys).to_numpy()
+
+
+def _columns(df: pd.DataFrame, names: List[str], positions: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """
+    The named columns as numpy arrays, restricted to positions (None: all
+    rows) without building a sub-table. Categorical columns come as
+    (codes, categories) and only their integer codes are gathered.
+    """
+    out = {}
+    for name in names:
+        col = df[name]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            values = col.array.codes  # a view; .cat.codes copies the whole column
+            out[name] = (values if positions is None else values[positions], col.cat.categories)
+        elif positions is not None and not isinstance(col.dtype, np.dtype):
+            # Extension arrays (e.g. Arrow strings) convert only the rows taken
+            out[name] = col.array.take(positions).to_numpy()
+        else:
+            values = col.to_numpy()
+            out[name] = values if positions is None else values[positions]
+    return out
+
+
+def _key(column) -> Tuple[np.ndarray, Any]:
+    """
+    (codes, labels) of a grouping column; missing values get code -1.
+    """
+    if isinstance(column, tuple):
+        return column
+    if column.dtype.kind in "iu" and len(column):
+        # Small integer ranges (years) need no hashing: offsets are the codes
+        low, high = int(column.min()), int(column.max())
+        if high - low < 4096:
+            return column - column.dtype.type(low), np.arange(low, high + 1, dtype=column.dtype)
+    return pd.factorize(column, sort=True)
+
+
+class _Groups:
+    """
+    Rows grouped by one or more key columns (arrays, or (codes, labels)
+    pairs from _columns), in the order groupby(sort=True,
+    observed=True) would give; rows with a missing key are left out, as
+    groupby does. Aggregates are numpy reduceat calls over the rows sorted
+    by group, so no Python code runs per group or per row.
+    """
+
+    def __init__(self, keys: List[Any]):
+        keys = [_key(k) for k in keys]
+        codes = [c for c, _ in keys]
+        dims = tuple(len(labels) for _, labels in keys)
+        valid = np.logical_and.reduce([c >= 0 for c in codes])
+        if valid.all():
+            flat = np.ravel_multi_index(tuple(codes), dims)
+            self.order = np.argsort(flat, kind="stable")
+            flat = flat[self.order]
+        else:
+            rows = np.flatnonzero(valid)
+            flat = np.ravel_multi_index(tuple(c[rows] for c in codes), dims)
+            order = np.argsort(flat, kind="stable")
+            flat = flat[order]
+            self.order = rows[order]
+        self.starts = np.flatnonzero(np.r_[True, flat[1:] != flat[:-1]]) if len(flat) else flat
+        firsts = self.order[self.starts]
+        self.labels = [labels[c[firsts]].tolist() for c, (_, labels) in zip(codes, keys)]
+
+    def sum(self, values: np.ndarray) -> np.ndarray:
+        # Counts and sample sizes are summed in int64 whatever their storage type
+        dtype = np.int64 if values.dtype.kind in "biu" else None
+        return np.add.reduceat(values[self.order], self.starts, dtype=dtype)
+
+    def min(self, values: np.ndarray) -> np.ndarray:
+        return np.minimum.reduceat(values[self.order], self.starts)
+
+    def max(self, values: np.ndarray) -> np.ndarray:
+        return np.maximum.reduceat(values[self.order], self.starts)
+
+
+def _records(names: List[str], columns: List[Any], order: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+    """
+    Plain Python records (built-in ints, floats and strs) from parallel
+    per-group columns, optionally reordered.
+    """
+    columns = [
+        (c if order is None else c[order]).tolist() if isinstance(c, np.ndarray)
+        else (c if order is None else [c[i] for i in order])
+        for c in columns
+    ]
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def _summary(tables: Dict[str, Tuple]) -> Dict[str, Any]:
+    """
+    Summary with the records of each table from _aggregate.
+    """
+    return {"has_data": True, **{name: _records(*table) for name, table in tables.items()}}
+
+
+def _aggregate(sites: Dict[str, Any], studies: Dict[str, Any], breakdown: bool = False) -> Dict[str, Tuple]:
+    """
+    Per-group columns of each summary table, as (names, columns, order)
+    for _records, from column arrays (see _columns): sites needs year,
+    site, country, mutation, n_samples and weighted (prevalence *
+    n_samples); studies needs study_id, authors, year_pub, year, n_samples,
+    prev_sum and n_prev. Raw rows and cube cells both fit this shape.
+
+    Weighted prevalences are computed from pre-summed numerators.
+    """
+    n, weighted, year = sites["n_samples"], sites["weighted"], sites["year"]
+    tables = {}
 
     # Yearly prevalence summary
-    year_grp = (
-        subset.groupby("year")
-        .apply(
-            lambda g: pd.Series(
-                {
-                    "n_samples": int(g["n_samples"].sum()),
-                    "mean_prevalence": float(
-                        (g["prevalence"] * g["n_samples"]).sum()
-                        / max(g["n_samples"].sum(), 1)
-                    ),
-                }
-            )
-        )
-        .reset_index()
-        .sort_values("year")
+    grp = _Groups([year])
+    n_sum = grp.sum(n)
+    tables["yearly"] = (
+        ["year", "n_samples", "mean_prevalence"],
+        [*grp.labels, n_sum, grp.sum(weighted) / np.maximum(n_sum, 1)],
+        None,
     )
 
     # Regional/site summary (if you have region column, swap that in)
-    site_grp = (
-        subset.groupby(["site", "country"])
-        .apply(
-            lambda g: pd.Series(
-                {
-                    "n_samples": int(g["n_samples"].sum()),
-                    "mean_prevalence": float(
-                        (g["prevalence"] * g["n_samples"]).sum()
-                        / max(g["n_samples"].sum(), 1)
-                    ),
-                    "first_year": int(g["year"].min()),
-                    "last_year": int(g["year"].max()),
-                }
-            )
-        )
-        .reset_index()
-        .sort_values("mean_prevalence", ascending=False)
+    grp = _Groups([sites["site"], sites["country"]])
+    n_sum = grp.sum(n)
+    mean = grp.sum(weighted) / np.maximum(n_sum, 1)
+    tables["by_site"] = (
+        ["site", "country", "n_samples", "mean_prevalence", "first_year", "last_year"],
+        [*grp.labels, n_sum, mean, grp.min(year), grp.max(year)],
+        np.argsort(-mean, kind="stable"),
     )
 
     # Study-level metadata
-    study_grp = (
-        subset.groupby(["study_id", "authors", "year_pub"])
-        .agg(
-            n_samples=("n_samples", "sum"),
-            year_min=("year", "min"),
-            year_max=("year", "max"),
-            mean_prev=("prevalence", "mean"),
-        )
-        .reset_index()
-        .sort_values("year_pub")
+    grp = _Groups([studies["study_id"], studies["authors"], studies["year_pub"]])
+    # A study with no prevalence at all gets NaN, as pandas mean does
+    with np.errstate(invalid="ignore"):
+        mean_prev = grp.sum(studies["prev_sum"]) / grp.sum(studies["n_prev"])
+    tables["by_study"] = (
+        ["study_id", "authors", "year_pub", "n_samples", "year_min", "year_max", "mean_prev"],
+        [
+            *grp.labels,
+            grp.sum(studies["n_samples"]),
+            grp.min(studies["year"]),
+            grp.max(studies["year"]),
+            mean_prev,
+        ],
+        # Same (unstable) sort as pandas sort_values, so ties keep their old order
+        np.argsort(np.asarray(grp.labels[2], dtype=float)),
+    )
+
+    if breakdown:
+        tables.update(_pair_breakdown(sites))
+    return tables
+
+
+def _pair_breakdown(sites: Dict[str, Any]) -> Dict[str, Tuple]:
+    """
+    Per (country, mutation) and per (country, mutation, year) tables for
+    comparison queries, ordered by country, mutation and year.
+    """
+    n, weighted, year = sites["n_samples"], sites["weighted"], sites["year"]
+
+    pairs = _Groups([sites["country"], sites["mutation"]])
+    n_sum = pairs.sum(n)
+    by_pair = (
+        ["country", "mutation", "n_samples", "mean_prevalence", "first_year", "last_year"],
+        [*pairs.labels, n_sum, pairs.sum(weighted) / np.maximum(n_sum, 1), pairs.min(year), pairs.max(year)],
+        None,
+    )
+
+    cells = _Groups([sites["country"], sites["mutation"], year])
+    n_sum = cells.sum(n)
+    by_cell = (
+        ["country", "mutation", "year", "n_samples", "mean_prevalence"],
+        [*cells.labels, n_sum, cells.sum(weighted) / np.maximum(n_sum, 1)],
+        None,
+    )
+    return {"by_country_mutation": by_pair, "by_country_mutation_year": by_cell}
+
+
+def summarize_prevalence(subset: pd.DataFrame, breakdown: bool = False) -> Dict[str, Any]:
+    """
+    Produce a compact summary of the numeric + geographic patterns
+    to feed into the LLM.
+
+    Weighted prevalences are computed from pre-summed numerators
+    (prevalence * n_samples) with numpy aggregations over the grouped
+    rows, so no Python code runs per group.
+
+    With breakdown (see is_comparison) the summary also has
+    by_country_mutation and by_country_mutation_year records.
+    """
+    with tracing.span("summarize") as span:
+        if not isinstance(subset, pd.DataFrame):
+            # Lazy source: stream the chunks into a cube and roll it up
+            summary = _rollup_cube(subset.cube(), {}, breakdown)
+        else:
+            span["rows"] = len(subset)
+            summary = _summarize_rows(subset, None, breakdown)
+        _count_groups(span, summary)
+        return summary
+
+
+def _count_groups(span: Dict[str, Any], summary: Dict[str, Any]) -> None:
+    span["sites"] = len(summary.get("by_site", []))
+    span["studies"] = len(summary.get("by_study", []))
+
+
+def summarize_rows(df: pd.DataFrame, positions: Optional[np.ndarray] = None, breakdown: bool = False) -> Dict[str, Any]:
+    """
+    summarize_prevalence of the rows of df at positions (from select_rows;
+    None: all rows), reading only SUMMARY_COLUMNS at those positions.
+    """
+    with tracing.span("summarize") as span:
+        span["rows"] = len(df) if positions is None else len(positions)
+        summary = _summarize_rows(df, positions, breakdown)
+        _count_groups(span, summary)
+        return summary
+
+
+def _summarize_rows(df: pd.DataFrame, positions: Optional[np.ndarray] = None, breakdown: bool = False) -> Dict[str, Any]:
+    if len(df) == 0 or (positions is not None and len(positions) == 0):
+        return {"has_data": False}
+
+    cols = _columns(df, SUMMARY_COLUMNS, positions)
+    prevalence = cols["prevalence"].astype(np.float64, copy=False)
+    # NaN prevalences are skipped by the sums, as pandas sum/mean do
+    cols["n_prev"] = ~np.isnan(prevalence)
+    cols["prev_sum"] = np.where(cols["n_prev"], prevalence, 0.0)
+    cols["weighted"] = cols["prev_sum"] * cols["n_samples"]
+    tables = _aggregate(cols, cols, breakdown)
+    # Let the row arrays go before the records are built
+    del cols, prevalence
+    return _summary(tables)
+
+
+def summarize_cube(cube: Dict[str, pd.DataFrame], query: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Same result as summarize_prevalence(filter_data(df, query)), computed
+    by rolling up the pre-aggregated cells from data_loader.build_cube
+    instead of touching raw rows.
+    """
+    with tracing.span("summarize", from_cube=True) as span:
+        summary = _rollup_cube(cube, query, is_comparison(query))
+        _count_groups(span, summary)
+        return summary
+
+
+def _rollup_cube(cube: Dict[str, pd.DataFrame], query: Dict[str, Any], breakdown: bool = False) -> Dict[str, Any]:
+    site_rows = np.flatnonzero(_row_mask(cube["sites"], query))
+    if len(site_rows) == 0:
+        return {"has_data": False}
+    study_rows = np.flatnonzero(_row_mask(cube["studies"], query))
+
+    sites = _columns(cube["sites"], ["year", "site", "country", "mutation", "n_samples", "weighted"], site_rows)
+    studies = _columns(
+        cube["studies"], ["study_id", "authors", "year_pub", "year", "n_samples", "prev_sum", "n_prev"], study_rows
     )
+    return _summary(_aggregate(sites, studies, breakdown))
+
+
+def summarize_query(df, query: Dict[str, Any], index=None, cube=None) -> Dict[str, Any]:
+    """
+    filter_data + summarize_prevalence, or a cube roll-up when a cube
+    (data_loader.load_cube) is available. In-memory tables go through
+    select_rows + summarize_rows, so no subset table is built.
+    """
+    if cube is not None:
+        return summarize_cube(cube, query)
+    if not isinstance(df, pd.DataFrame):
+        return summarize_prevalence(filter_data(df, query, index), is_comparison(query))
+    return summarize_rows(df, select_rows(df, query, index), is_comparison(query))
 
-    return {
-        "has_data": True,
-        "yearly": year_grp.to_dict(orient="records"),
-        "by_site": site_grp.to_dict(orient="records"),
-        "by_study": study_grp.to_dict(orient="records"),
-    }
 
+@lru_cache(maxsize=4096)
 def normalize_mutation_label(label: str) -> str:
     """
     Normalize a mutation string like:
@@ -110,5 +426,10 @@ def normalize_mutation_label(label: str) -> str:
         if len(p) >= 2 and p[:-1].isdigit() and p[-1].isalpha():
             return p.upper()
 
+    # Or position and amino acid as separate pieces ('k13:675:V')
+    for pos, aa in zip(parts, parts[1:]):
+        if pos.isdigit() and aa.isalpha() and len(aa) == 1:
+            return (pos + aa).upper()
+
     # Fallback: just return stripped, uppercased
     return s.upper()
\ No newline at end of file
@@ -0,0 +1,136 @@
+"""
+Per-stage timing for the question pipeline.
+
+Stages are wrapped in span(); spans nest, so a stage is identified by its
+path (e.g. "question/narrative/llm"). Every finished span is
+  - added to in-process metrics (metrics_summary / print_metrics), and
+  - written as one JSON line to config.TRACE_LOG_PATH when that is set.
+Attributes such as row counts, prompt sizes and Ollama token counts are
+attached by filling the dict a span yields.
+"""
+import atexit
+import contextvars
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, Optional, Tuple
+
+from . import config
+
+# Durations kept per stage for the percentiles (oldest dropped first)
+MAX_SAMPLES = 10_000
+
+# (trace_id, path) of the innermost open span
+_current: contextvars.ContextVar[Tuple[Optional[str], str]] = contextvars.ContextVar(
+    "trace_span", default=(None, "")
+)
+_durations: Dict[str, deque] = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+_lock = threading.Lock()
+_log_file = None
+_log_path = None
+
+
+def _write_log(record: Dict[str, Any]) -> None:
+    global _log_file, _log_path
+    with _lock:
+        if config.TRACE_LOG_PATH != _log_path:
+            if _log_file is not None:
+                _log_file.close()
+            _log_path = config.TRACE_LOG_PATH
+            _log_file = open(_log_path, "a") if _log_path else None
+        if _log_file is not None:
+            _log_file.write(json.dumps(record, default=str) + "\n")
+            _log_file.flush()
+
+
+@contextmanager
+def span(stage: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Time the enclosed block as `stage`, nested under the current span.
+    Yields the attribute dict so the block can add results to it.
+    """
+    trace_id, parent = _current.get()
+    path = f"{parent}/{stage}" if parent else stage
+    token = _current.set((trace_id, path))
+    start = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        _current.reset(token)
+        with _lock:
+            _durations[path].append(elapsed)
+        if config.TRACE_LOG_PATH:
+            record = {"ts": time.time(), "trace_id": trace_id, "stage": path, "duration_s": elapsed, **attrs}
+            if error is not None:
+                record["error"] = error
+            _write_log(record)
+
+
+@contextmanager
+def trace(question: str) -> Iterator[Dict[str, Any]]:
+    """
+    Root span for one question; spans opened inside share its trace_id.
+    """
+    token = _current.set((uuid.uuid4().hex[:12], ""))
+    try:
+        with span("question", question=question) as attrs:
+            yield attrs
+    finally:
+        _current.reset(token)
+
+
+def percentile(values, q: float, empty: Optional[float] = None) -> Optional[float]:
+    """
+    Nearest-rank percentile q (0-100) of values; empty if there are none.
+    """
+    if not len(values):
+        return empty
+    values = sorted(values)
+    k = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[k]
+
+
+def metrics_summary() -> Dict[str, Dict[str, Any]]:
+    """
+    Count, p50, p95 and total seconds per stage path.
+    """
+    with _lock:
+        snapshot = {path: list(d) for path, d in _durations.items() if d}
+    return {
+        path: {
+            "count": len(values),
+            "p50_s": percentile(values, 50),
+            "p95_s": percentile(values, 95),
+            "total_s": sum(values),
+        }
+        for path, values in sorted(snapshot.items())
+    }
+
+
+def print_metrics() -> None:
+    summary = metrics_summary()
+    if not summary:
+        return
+    print("\nStage timings:")
+    for path, m in summary.items():
+        print(
+            f"  {path:<28} n={m['count']:<5} p50 {m['p50_s'] * 1e3:9.1f} ms   "
+            f"p95 {m['p95_s'] * 1e3:9.1f} ms"
+        )
+
+
+def print_metrics_at_exit() -> None:
+    atexit.register(print_metrics)
+
+
+def reset() -> None:
+    with _lock:
+        _durations.clear()
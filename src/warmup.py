@@ -0,0 +1,126 @@
+"""
+Offline warm-up: generate narratives ahead of time for the (country,
+mutation) pairs asked about most, so those questions are answered
+without waiting on the LLM.
+
+Pairs with data in the table are ranked by row count, or by how often
+they were asked according to a trace log (see --trace-log), and the
+top ones are summarized and narrated. Answers go to the dataset's
+answer store (src.answer_store); narrative.llm_generate_answer serves
+them when a question's summary matches a warmed one. The store is tied
+to the dataset version, so re-run the warm-up after the data changes.
+
+Usage:
+  python -m src.warmup --data data/raw/all_who_get_prevalence.csv --top 50
+  python -m src.warmup --data ... --history trace.jsonl --top 50
+"""
+import argparse
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+import pandas as pd
+
+from . import answer_store, config, narrative, summarizer
+from .main import load_dataset
+
+QUESTION_TEMPLATE = "How has {mutation} prevalence changed over time in {country}?"
+
+
+def history_counts(trace_log: str) -> Counter:
+    """
+    How often each (country, mutation) partition was asked, from the
+    parsed queries in a trace log.
+    """
+    counts: Counter = Counter()
+    with open(trace_log) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            query = record.get("query")
+            if not record.get("stage", "").endswith("parse") or not isinstance(query, dict):
+                continue
+            counts.update(summarizer.partition_tags(query))
+    return counts
+
+
+def rank_pairs(df, history: Optional[Counter] = None, top: Optional[int] = None) -> List[Tuple[str, str]]:
+    """
+    (country, mutation) pairs with data, most asked first when history
+    is given, then by row count.
+    """
+    sizes = df.groupby(["country", "mutation"], observed=True).size()
+    sizes = sizes[sizes > 0]
+    history = history or Counter()
+    pairs = sorted(
+        sizes.items(),
+        key=lambda item: (-history.get(summarizer.partition_tag(*item[0]), 0), -item[1]),
+    )
+    return [pair for pair, _ in pairs[:top]]
+
+
+def warm(
+    path: str,
+    df,
+    pairs: List[Tuple[str, str]],
+    index=None,
+    cube=None,
+    concurrency: int = 2,
+) -> Dict[str, Any]:
+    """
+    Generate and store narratives for pairs that are not warmed yet.
+    Returns counts and timing.
+    """
+    store = answer_store.open_store(path)
+    report = {"pairs": len(pairs), "generated": 0, "already_warm": 0, "no_data": 0}
+    start = time.perf_counter()
+
+    def work(pair: Tuple[str, str]) -> str:
+        country, mutation = pair
+        query = {"country": country, "mutation": mutation, "year_min": None, "year_max": None}
+        summary = summarizer.summarize_query(df, query, index, cube)
+        if not summary.get("has_data"):
+            return "no_data"
+        if summary in store:
+            return "already_warm"
+        question = QUESTION_TEMPLATE.format(country=country, mutation=mutation)
+        store.put(summary, query, question, narrative.llm_generate_answer(question, query, summary))
+        return "generated"
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        for outcome in pool.map(work, pairs):
+            report[outcome] += 1
+
+    report["elapsed_s"] = time.perf_counter() - start
+    report["entries"] = store.stats()["entries"]
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=config.DATA_PATH)
+    parser.add_argument("--top", type=int, default=50, help="number of (country, mutation) pairs to warm")
+    parser.add_argument("--history", help="trace log (JSONL) to rank pairs by how often they were asked")
+    parser.add_argument("--concurrency", type=int, default=2, help="concurrent LLM requests")
+    args = parser.parse_args()
+
+    df, _, index, cube = load_dataset(args.data)
+    if not isinstance(df, pd.DataFrame):
+        raise SystemExit("Warm-up needs an in-memory table; not available for streamed or partitioned sources")
+    history = history_counts(args.history) if args.history else None
+    pairs = rank_pairs(df, history, args.top)
+    print(f"Warming {len(pairs)} pairs")
+    report = warm(args.data, df, pairs, index, cube, args.concurrency)
+    print(
+        f"Generated {report['generated']}, already warm {report['already_warm']}, "
+        f"no data {report['no_data']}; {report['entries']} answers stored "
+        f"({report['elapsed_s']:.1f} s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+import socket
+
+import pytest
+
+
+@pytest.fixture
+def messages():
+    """
+    A one-question chat for the LLM client tests.
+    """
+    return [{"role": "user", "content": "How has 675V changed in Uganda?"}]
+
+
+@pytest.fixture
+def dead_url():
+    """
+    A URL nothing listens on: connections are refused.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from src import batch, config, query_parser
+from src.benchmark import make_synthetic_prevalence
+from src.llm_stub import start_stub
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    server, url = start_stub()
+    monkeypatch.setattr(config, "OLLAMA_URL", url)
+    monkeypatch.setattr(config, "LLM_BACKENDS", [])
+    monkeypatch.setattr(config, "LLM_CACHE_ENABLED", False)
+    yield server
+    server.shutdown()
+
+
+def test_stage_latency_is_printed_per_question(llm, tmp_path, capsys):
+    df = make_synthetic_prevalence(2_000)
+    questions = [
+        {"id": i, "question": f"How has {m} changed in {c}?"}
+        for i, (m, c) in enumerate(zip(df["mutation"][:3], df["country"][:3]))
+    ]
+    out = str(tmp_path / "answers.jsonl")
+    stats = batch.run_batch(df, questions, out, concurrency=2, vocab=query_parser.build_vocabulary(df))
+    assert stats["failed"] == 0
+
+    progress = [line for line in capsys.readouterr().out.splitlines() if line.startswith("[")]
+    assert len(progress) == len(questions)
+    for line in progress:
+        for stage in batch.STAGES:
+            assert f"{stage} " in line.split("| p50 ")[1]
+    with open(out) as f:
+        assert len([json.loads(line) for line in f]) == len(questions)
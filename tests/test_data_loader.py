@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from src import config, main, summarizer
+from src.benchmark import make_synthetic_prevalence, to_raw_export
+from src.data_loader import PARTITION_COLS, ChunkedSource, normalize_table, write_partitioned
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    """
+    (table, partitioned dataset directory) for a synthetic export with
+    more country x mutation pairs than write_dataset's default limit.
+    """
+    tmp = tmp_path_factory.mktemp("data")
+    raw = to_raw_export(make_synthetic_prevalence(30_000))
+    source = str(tmp / "export.csv")
+    raw.to_csv(source, index=False)
+    out = str(tmp / "partitioned")
+    assert write_partitioned(source, out, chunksize=5_000) == len(raw)
+    return normalize_table(raw), out
+
+
+def _partitions(path):
+    depth = path.rstrip(os.sep).count(os.sep) + len(PARTITION_COLS)
+    return [d for d, _, _ in os.walk(path) if d.count(os.sep) == depth]
+
+
+def test_write_partitioned_handles_more_than_1024_partitions(dataset):
+    df, path = dataset
+    n_pairs = len(df[["mutation", "country"]].drop_duplicates())
+    assert n_pairs > 1024
+    assert len(_partitions(path)) == n_pairs
+
+
+def test_partitioned_dataset_is_pruned_not_cubed(dataset, monkeypatch):
+    df, path = dataset
+    monkeypatch.setattr(config, "USE_SUMMARY_CUBE", True)
+    source, vocab, index, cube = main.load_dataset(path)
+    assert isinstance(source, ChunkedSource)
+    assert index is None and cube is None
+    assert set(vocab["countries"].values()) == set(df["country"].astype(str))
+
+    query = {"country": "uganda", "mutation": df["mutation"].iloc[0], "year_min": 2010}
+    expected = summarizer.summarize_rows(df, summarizer.select_rows(df, query))
+    summary = summarizer.summarize_query(source, query, index, cube)
+    assert summary.keys() == expected.keys()
+    for name in ("yearly", "by_site", "by_study"):
+        # Chunked sums may round differently in the last digit
+        assert summary[name] == [pytest.approx(r) for r in expected[name]]
+
+    # Only the matching rows of the selected partition are read
+    read = sum(len(raw) for raw in source.filter(query)._raw_chunks())
+    assert read == len(summarizer.filter_data(df, query))
+
+
+@pytest.mark.parametrize("use_cube", [True, False])
+def test_index_is_built_only_without_a_cube(tmp_path, monkeypatch, use_cube):
+    monkeypatch.setattr(config, "USE_SUMMARY_CUBE", use_cube)
+    monkeypatch.setattr(config, "STREAMING", False)
+    monkeypatch.setattr(config, "USE_SNAPSHOT", False)
+    path = str(tmp_path / "export.csv")
+    to_raw_export(make_synthetic_prevalence(2_000)).to_csv(path, index=False)
+    _, _, index, cube = main.load_dataset(path)
+    assert (cube is not None) == use_cube
+    assert (index is None) == use_cube
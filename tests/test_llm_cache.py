@@ -0,0 +1,139 @@
+from types import SimpleNamespace
+
+import pytest
+
+from src import config, llm_cache
+from src.llm_cache import LLMCache
+from src.llm_stub import start_stub
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Cache timestamps come from a clock the test moves by hand
+    now = SimpleNamespace(value=1_000_000.0)
+    monkeypatch.setattr(llm_cache, "time", SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def test_get_and_put_count_hits_and_misses(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get("a") is None
+    cache.put("a", "reply")
+    assert cache.get("a") == "reply"
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1, "bytes": 5}
+
+
+def test_entries_persist_across_instances(tmp_path):
+    path = str(tmp_path / "sub" / "cache.sqlite")
+    LLMCache(path).put("a", "reply")
+    reopened = LLMCache(path)
+    assert reopened.get("a") == "reply"
+    assert reopened.stats()["hits"] == 1
+
+
+def test_key_parts_do_not_run_together():
+    assert LLMCache.make_key("m", "ab", "c") != LLMCache.make_key("m", "a", "bc")
+    assert LLMCache.make_key("m", "s", "u") == LLMCache.make_key("m", "s", "u")
+
+
+def test_old_entries_expire(tmp_path, clock):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), max_age_s=60)
+    cache.put("a", "old")
+    clock.value += 30
+    cache.put("b", "new")
+    assert cache.get("a") == "old"
+
+    # Reading does not extend the age limit
+    clock.value += 40
+    assert cache.get("a") is None
+    assert cache.get("b") == "new"
+    assert cache.stats()["entries"] == 1
+
+    # Writing drops expired entries too
+    clock.value += 60
+    cache.put("c", "newest")
+    assert cache.stats()["entries"] == 1
+
+
+def test_least_recently_used_entries_go_first(tmp_path, clock):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    for key in ("a", "b"):
+        cache.put(key, key)
+        clock.value += 1
+    assert cache.get("a") == "a"
+    clock.value += 1
+    cache.put("c", "c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "a"
+    assert cache.get("c") == "c"
+
+
+def test_size_limit_evicts_until_it_holds(tmp_path, clock):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), max_bytes=10)
+    for key in ("a", "b", "c"):
+        cache.put(key, "x" * 4)
+        clock.value += 1
+    assert cache.stats() == {"hits": 0, "misses": 0, "entries": 2, "bytes": 8}
+    assert cache.get("a") is None
+
+
+def test_invalidate_drops_tagged_entries(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"))
+    cache.put("a", "1", tags=["uganda|675V"])
+    cache.put("b", "2", tags=["uganda|469Y", "*|469Y"])
+    cache.put("c", "3")
+    assert cache.invalidate(["*|469Y", "kenya|*"]) == 1
+    assert cache.invalidate([]) == 0
+    assert cache.get("a") == "1"
+    assert cache.get("b") is None
+    assert cache.get("c") == "3"
+
+
+@pytest.fixture
+def llm(tmp_path, monkeypatch):
+    """
+    call_llm wired to a stub backend and an empty cache.
+    """
+    server, url = start_stub()
+    monkeypatch.setattr(config, "LLM_BACKENDS", [{"url": url}])
+    monkeypatch.setattr(config, "LLM_CACHE_ENABLED", True)
+    monkeypatch.setattr(config, "_cache", LLMCache(str(tmp_path / "cache.sqlite")))
+    yield server
+    server.shutdown()
+
+
+def test_call_llm_serves_repeats_from_the_cache(llm):
+    first = config.call_llm("system", "question")
+    assert config.call_llm("system", "question") == first
+    assert llm.requests == 1
+    assert config.last_call_timings() is None
+
+    # Different request options are a different reply
+    config.call_llm("system", "question", options={"num_predict": 3})
+    assert llm.requests == 2
+    assert config.get_cache().stats()["hits"] == 1
+
+
+def test_cache_can_be_bypassed(llm, monkeypatch):
+    config.call_llm("system", "question", use_cache=False)
+    config.call_llm("system", "question", use_cache=False)
+    assert llm.requests == 2
+    assert config.get_cache().stats()["entries"] == 0
+
+    monkeypatch.setattr(config, "LLM_CACHE_ENABLED", False)
+    config.call_llm("system", "question")
+    assert llm.requests == 3
+    assert config.get_cache().stats() == {"hits": 0, "misses": 0, "entries": 0, "bytes": 0}
+
+
+def test_streamed_reply_is_cached(llm):
+    tokens = []
+    answer, stats = config.call_llm_stream("system", "question", tokens.append)
+    assert "".join(tokens).strip() == answer
+    assert not stats["cached"] and stats["eval_tokens"] > 0
+
+    tokens = []
+    again, stats = config.call_llm_stream("system", "question", tokens.append)
+    assert again == answer and tokens == [answer]
+    assert stats["cached"]
+    assert llm.requests == 1
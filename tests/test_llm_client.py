@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+import requests
+
+from src.llm_client import AsyncOllamaClient, OllamaClient, is_transient
+from src.llm_stub import start_stub
+
+
+@pytest.fixture
+def stub(request):
+    server, url = start_stub(**getattr(request, "param", {}))
+    yield server, url
+    server.shutdown()
+
+
+def test_chat_sends_keep_alive(stub, messages):
+    server, url = stub
+    client = OllamaClient(url, keep_alive="30m")
+    data = client.chat("llama3", messages)
+    assert data["message"]["content"].startswith("Prevalence")
+    assert server.last_payload["keep_alive"] == "30m"
+    assert server.last_payload["stream"] is False
+
+    # An explicit keep_alive wins over the client default
+    client.chat("llama3", messages, keep_alive=0)
+    assert server.last_payload["keep_alive"] == 0
+    client.close()
+
+
+@pytest.mark.parametrize("stub", [{"failures": 2}], indirect=True)
+def test_transient_status_is_retried_with_backoff(stub, messages):
+    server, url = stub
+    client = OllamaClient(url, max_retries=2, backoff=0.05)
+    start = time.perf_counter()
+    data = client.chat("llama3", messages)
+    assert data["done"]
+    assert server.requests == 3
+    # Two waits: backoff, then twice the backoff
+    assert time.perf_counter() - start >= 0.15
+
+
+@pytest.mark.parametrize("stub", [{"failures": 5}], indirect=True)
+def test_retries_give_up_with_the_last_error(stub, messages):
+    server, url = stub
+    client = OllamaClient(url, max_retries=2, backoff=0.0)
+    with pytest.raises(requests.HTTPError) as info:
+        client.chat("llama3", messages)
+    assert info.value.response.status_code == 503
+    assert is_transient(info.value)
+    assert server.requests == 3
+
+
+@pytest.mark.parametrize("stub", [{"failures": 1, "fail_status": 400}], indirect=True)
+def test_client_errors_are_not_retried(stub, messages):
+    server, url = stub
+    client = OllamaClient(url, max_retries=2, backoff=0.0)
+    with pytest.raises(requests.HTTPError) as info:
+        client.chat("llama3", messages)
+    assert not is_transient(info.value)
+    assert server.requests == 1
+
+
+@pytest.mark.parametrize("stub", [{"latency": 0.5}], indirect=True)
+def test_read_timeout_is_retried(stub, messages):
+    server, url = stub
+    client = OllamaClient(url, read_timeout=0.1, max_retries=1, backoff=0.0)
+    with pytest.raises(requests.Timeout):
+        client.chat("llama3", messages)
+    assert server.requests == 2
+
+
+def test_refused_connection_raises_after_retries(messages, dead_url):
+    client = OllamaClient(dead_url, connect_timeout=1.0, max_retries=1, backoff=0.0)
+    with pytest.raises(requests.ConnectionError) as info:
+        client.chat("llama3", messages)
+    assert is_transient(info.value)
+
+
+@pytest.mark.parametrize("stub", [{"failures": 1}], indirect=True)
+def test_stream_retries_before_the_first_token(stub, messages):
+    server, url = stub
+    client = OllamaClient(url, max_retries=1, backoff=0.0)
+    tokens = []
+    data = client.chat_stream("llama3", messages, tokens.append, options={"num_predict": 5})
+    assert server.requests == 2
+    assert len(tokens) == 5
+    assert data["message"]["content"] == "".join(tokens)
+    assert data["eval_count"] == 5
+
+
+@pytest.mark.parametrize("stub", [{"failures": 2}], indirect=True)
+def test_async_client_retries(stub, messages):
+    server, url = stub
+    client = AsyncOllamaClient(url, max_retries=2, backoff=0.0, keep_alive="30m")
+    data = asyncio.run(client.chat("llama3", messages))
+    assert data["done"]
+    assert server.requests == 3
+    assert server.last_payload["keep_alive"] == "30m"
+
+    # The pooled client follows the event loop it is used from
+    assert asyncio.run(client.chat("llama3", messages))["done"]
+    client.close()
+
+
+@pytest.mark.parametrize("stub", [{"failures": 1, "fail_status": 400}], indirect=True)
+def test_async_client_errors_are_not_retried(stub, messages):
+    server, url = stub
+    client = AsyncOllamaClient(url, max_retries=2, backoff=0.0)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(client.chat("llama3", messages))
+    assert server.requests == 1
+
+
+def test_async_refused_connection_raises_after_retries(messages, dead_url):
+    client = AsyncOllamaClient(dead_url, connect_timeout=1.0, max_retries=1, backoff=0.0)
+    with pytest.raises(httpx.ConnectError) as info:
+        asyncio.run(client.chat("llama3", messages))
+    assert is_transient(info.value)
@@ -0,0 +1,106 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from src.llm_client import AsyncOllamaClient, OllamaClient
+from src.llm_dispatch import Backend, LLMDispatcher
+from src.llm_stub import start_stub
+
+
+def _backend(url, max_in_flight=2, models=None):
+    client = OllamaClient(url, max_retries=0, connect_timeout=1.0)
+    async_client = AsyncOllamaClient(url, max_retries=0, connect_timeout=1.0)
+    return Backend(url, lambda: client, lambda: async_client, max_in_flight=max_in_flight, models=models)
+
+
+@pytest.fixture
+def stubs():
+    servers = [start_stub(latency=0.05) for _ in range(2)]
+    yield servers
+    for server, _ in servers:
+        server.shutdown()
+
+
+def test_calls_are_spread_and_capped(stubs, messages):
+    backends = [_backend(url) for _, url in stubs]
+    dispatcher = LLMDispatcher(backends)
+    with ThreadPoolExecutor(8) as pool:
+        urls = list(pool.map(lambda _: dispatcher.chat("llama3", messages)[1], range(16)))
+    assert {url for _, url in stubs} == set(urls)
+    assert all(b.peak_in_flight <= 2 for b in backends)
+    assert sum(server.requests for server, _ in stubs) == 16
+
+
+def test_failed_backend_is_not_used_while_cooling_down(stubs, messages, dead_url):
+    dead = _backend(dead_url)
+    dispatcher = LLMDispatcher([*(_backend(url) for _, url in stubs), dead], cooldown=30)
+    with ThreadPoolExecutor(8) as pool:
+        for _ in range(3):
+            results = list(pool.map(lambda _: dispatcher.chat("llama3", messages)[1], range(8)))
+            assert dead.url not in results
+    # Only the calls that reached it before it failed; none during the cool-down
+    assert dead.failures <= dead.max_in_flight
+    assert not dead.healthy(dead.down_until - 1)
+
+
+def test_cooling_backend_is_used_when_no_other_is_healthy(stubs, messages):
+    (_, url), _ = stubs
+    backend = _backend(url)
+    dispatcher = LLMDispatcher([backend], cooldown=30)
+    backend.down_until = float("inf")
+    assert dispatcher.chat("llama3", messages)[1] == url
+
+
+def test_failover_on_connection_error(stubs, messages, dead_url):
+    (_, url), _ = stubs
+    dead = _backend(dead_url)
+    dispatcher = LLMDispatcher([dead, _backend(url)], cooldown=30)
+    assert dispatcher.chat("llama3", messages)[1] == url
+    assert asyncio.run(dispatcher.achat("llama3", messages))[1] == url
+
+
+class _Rejecting:
+    """
+    Client whose requests fail with an HTTP status.
+    """
+
+    def __init__(self, status):
+        self.status = status
+        self.calls = 0
+
+    def chat(self, model, messages, **extra):
+        self.calls += 1
+        response = requests.Response()
+        response.status_code = self.status
+        raise requests.HTTPError(f"HTTP {self.status}", response=response)
+
+
+def test_request_errors_do_not_fail_over(stubs, messages):
+    (server, url), _ = stubs
+    rejecting = _Rejecting(400)
+    first = Backend("rejecting", lambda: rejecting, lambda: None, max_in_flight=None)
+    dispatcher = LLMDispatcher([first, _backend(url, max_in_flight=None)], cooldown=30)
+    with pytest.raises(requests.HTTPError):
+        dispatcher.chat("llama3", messages)
+    assert rejecting.calls == 1 and server.requests == 0
+    # A bad request says nothing about the backend
+    assert first.failures == 0 and first.down_until == 0.0
+
+
+def test_server_errors_fail_over(stubs, messages):
+    (_, url), _ = stubs
+    overloaded = _Rejecting(503)
+    first = Backend("overloaded", lambda: overloaded, lambda: None, max_in_flight=None)
+    second = _backend(url, max_in_flight=None)
+    dispatcher = LLMDispatcher([first, second], cooldown=30)
+    assert dispatcher.chat("llama3", messages)[1] == url
+    assert overloaded.calls == 1 and first.failures == 1
+
+
+def test_models_route_to_their_backends(stubs, messages):
+    (_, small), (_, large) = stubs
+    dispatcher = LLMDispatcher([_backend(small, models=["small"]), _backend(large, models=["llama3"])])
+    assert dispatcher.chat("small", messages)[1] == small
+    assert dispatcher.chat("llama3", messages)[1] == large
@@ -0,0 +1,41 @@
+from src import narrative, summarizer
+from src.benchmark import make_synthetic_prevalence, to_raw_export
+from src.data_loader import normalize_table
+
+
+def _comparison_summary():
+    df = normalize_table(to_raw_export(make_synthetic_prevalence(50_000)))
+    countries = df["country"].value_counts().index[:8].tolist()
+    mutations = df["mutation"].value_counts().index[:6].tolist()
+    return summarizer.summarize_query(df, {"country": countries, "mutation": mutations})
+
+
+def test_comparison_context_fits_the_budget():
+    summary = _comparison_summary()
+    context, stats = narrative.build_context(summary, 2000)
+    assert stats["tokens_sent"] <= 2000
+    # The per-pair totals are kept whatever happens to the per-year cells
+    assert len(context["by_country_mutation"]) == len(summary["by_country_mutation"])
+    assert stats["cell_years"] != 1
+    assert "by_country_mutation_year" in context["note"]
+
+
+def test_coarsen_cells_pools_years():
+    cells = [
+        {"country": "Uganda", "mutation": "675V", "year": year, "n_samples": n, "mean_prevalence": p}
+        for year, n, p in [(2010, 10, 0.1), (2011, 30, 0.3), (2015, 20, 0.5)]
+    ]
+    assert narrative._coarsen_cells(cells, 5) == [
+        {"country": "Uganda", "mutation": "675V", "first_year": 2010, "last_year": 2011,
+         "n_samples": 40, "mean_prevalence": 0.25},
+        {"country": "Uganda", "mutation": "675V", "first_year": 2015, "last_year": 2015,
+         "n_samples": 20, "mean_prevalence": 0.5},
+    ]
+    assert narrative._coarsen_cells(cells, None) is None
+
+
+def test_small_summary_is_sent_as_is():
+    summary = {"has_data": True, "yearly": [{"year": 2015, "n_samples": 10, "mean_prevalence": 0.1}]}
+    context, stats = narrative.build_context(summary, 2000)
+    assert context is summary
+    assert stats["cell_years"] == 1
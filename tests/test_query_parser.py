@@ -0,0 +1,134 @@
+import pytest
+
+from src import query_parser
+
+
+def _vocab(countries, sites=None, mutations=("675V", "580Y", "469Y")):
+    return {
+        "countries": {c.lower(): c for c in countries},
+        "sites": {s.lower(): [c] for s, c in (sites or {}).items()},
+        "mutations": {m.upper(): m for m in mutations},
+    }
+
+
+VOCAB = _vocab(["Guinea", "Sudan", "Congo", "Uganda", "Guinea-Bissau"], {"Gulu": "Uganda"})
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "Democratic Republic of Congo",
+        "Republic of the Congo",
+        "South Sudan",
+        "Equatorial Guinea",
+        "Papua New Guinea",
+    ],
+)
+def test_repair_keeps_countries_missing_from_the_data(name):
+    # A known name inside a longer one is a different country
+    vocab = _vocab(["Guinea", "Sudan", "Congo"])
+    assert query_parser.repair_query({"country": name}, vocab)["country"] == name
+
+
+def test_repair_guinea_bissau_without_the_country_in_the_data():
+    vocab = _vocab(["Guinea", "Sudan", "Congo"])
+    assert query_parser.repair_query({"country": "Guinea Bissau"}, vocab)["country"] == "Guinea Bissau"
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("uganda", "Uganda"),
+        ("Ugandda", "Uganda"),
+        ("Gulu", "Uganda"),
+        ("Guinea Bissau", "Guinea-Bissau"),
+    ],
+)
+def test_repair_maps_onto_known_countries(value, expected):
+    assert query_parser.repair_query({"country": value}, VOCAB)["country"] == expected
+
+
+def test_repair_mutations_and_years():
+    query = query_parser.repair_query(
+        {"country": ["Uganda", "Sudan"], "mutation": "k13:675:V", "year_min": "2020", "year_max": 2010}, VOCAB
+    )
+    assert query == {"country": ["Uganda", "Sudan"], "mutation": "675V", "year_min": 2010, "year_max": 2020}
+
+
+RULES_VOCAB = _vocab(
+    ["Uganda", "Rwanda", "Congo", "Sudan", "Guinea", "Gambia", "Democratic Republic of the Congo"],
+    {"Gulu": "Uganda"},
+)
+
+
+@pytest.mark.parametrize(
+    "question, country",
+    [
+        ("How has 675V prevalence changed over time in Uganda?", "Uganda"),
+        ("Compare 675V and 469Y across Uganda and Rwanda", ["Uganda", "Rwanda"]),
+        ("Is K13 C580Y reported by WHO in Gulu?", "Uganda"),
+        ("675V in the Democratic Republic of the Congo", "Democratic Republic of the Congo"),
+        ("675V in The Gambia", "Gambia"),
+    ],
+)
+def test_rules_parse_known_places(question, country):
+    assert query_parser.rule_based_query(question, RULES_VOCAB)["country"] == country
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "675V in the Democratic Republic of Congo",
+        "675V in Republic of the Congo",
+        "675V in Uganda and Kenya",
+        "South Sudan 675V trends",
+        "675V in Guinea-Bissau",
+        "Show 675V in Papua New Guinea",
+    ],
+)
+def test_rules_leave_unknown_places_to_the_llm(question):
+    assert query_parser.rule_based_query(question, RULES_VOCAB) is None
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "675V in uganda before 2010 or after 2018",
+        "675V everywhere except Uganda",
+        "show 675V in uganda, not kenya",
+        "show 675V in uganda, not rwanda",
+        "675V in Uganda excluding Gulu",
+        "675V in Africa other than Uganda",
+        "675V in Uganda over the last 5 years",
+        "675V in Uganda in the past decade",
+        "recent 675V trends in Uganda",
+    ],
+)
+def test_rules_leave_exclusions_and_relative_years_to_the_llm(question):
+    assert query_parser.rule_based_query(question, RULES_VOCAB) is None
+
+
+@pytest.mark.parametrize(
+    "question, years",
+    [
+        ("675V in Uganda since 2015", (2015, None)),
+        ("675V in Uganda between 2018 and 2010", (2010, 2018)),
+        ("675V in Uganda after 2010 and before 2018", (2010, 2018)),
+        ("Is 675V notable in Uganda?", (None, None)),
+    ],
+)
+def test_rules_read_one_year_range(question, years):
+    query = query_parser.rule_based_query(question, RULES_VOCAB)
+    assert (query["year_min"], query["year_max"]) == years
+
+
+def test_garbage_reply_falls_back_to_a_labelled_guess():
+    query = query_parser._query_from_reply("Sure! Here you go", "675V in Uganda, not Rwanda", RULES_VOCAB)
+    assert query["mutation"] == "675V"
+
+
+@pytest.mark.parametrize("vocab", [RULES_VOCAB, None])
+def test_garbage_reply_without_labels_is_an_error(vocab):
+    # Falling back to an empty guess would summarize the whole table
+    with pytest.raises(ValueError):
+        query_parser._query_from_reply("Sure! Here you go", "What changed lately?", vocab)
@@ -0,0 +1,68 @@
+import pytest
+import requests
+
+from src import config, server
+from src.benchmark import make_synthetic_prevalence, to_raw_export
+from src.llm_stub import start_stub
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    """
+    (server, base url, table) with one LLM slot, backed by a stub.
+    """
+    stub, url = start_stub()
+    monkeypatch.setattr(config, "OLLAMA_URL", url)
+    monkeypatch.setattr(config, "LLM_BACKENDS", [])
+    monkeypatch.setattr(config, "LLM_CACHE_ENABLED", False)
+    monkeypatch.setattr(config, "SPECULATIVE_PARSE", False)
+    df = make_synthetic_prevalence(2_000)
+    path = str(tmp_path / "export.csv")
+    to_raw_export(df).to_csv(path, index=False)
+
+    srv = server.serve(path, port=0, max_llm=1, queue_timeout=0.2, reload_interval=None)
+    yield srv, f"http://127.0.0.1:{srv.server_address[1]}", df
+    srv.shutdown()
+    stub.shutdown()
+
+
+def test_rules_parse_does_not_need_an_llm_slot(service):
+    srv, base, df = service
+    row = df.iloc[0]
+    rules_question = f"How has {row['mutation']} changed in {row['country']}?"
+    llm_question = f"How has {row['mutation']} changed recently?"
+
+    assert srv.llm_slots.acquire(timeout=1)
+    try:
+        r = requests.post(base + "/parse", json={"question": rules_question})
+        assert r.status_code == 200 and r.json()["parse_source"] == "rules"
+        assert requests.post(base + "/parse", json={"question": llm_question}).status_code == 503
+    finally:
+        srv.llm_slots.release()
+
+    r = requests.post(base + "/parse", json={"question": llm_question})
+    assert r.status_code == 200 and r.json()["parse_source"] == "llm"
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        {"country": 5},
+        {"country": ["Uganda", 5]},
+        {"mutation": {"label": "675V"}},
+        {"year_min": "2010"},
+        {"year_max": True},
+    ],
+)
+def test_summary_rejects_mistyped_query_fields(service, query):
+    _, base, _ = service
+    r = requests.post(base + "/summary", json={"query": query})
+    assert r.status_code == 400
+    assert "query." in r.json()["error"]
+
+
+def test_summary_accepts_labels_and_lists(service):
+    _, base, df = service
+    query = {"country": [df["country"].iloc[0], df["country"].iloc[1]], "mutation": None, "year_min": 2010}
+    r = requests.post(base + "/summary", json={"query": query})
+    assert r.status_code == 200 and r.json()["has_data"]
@@ -0,0 +1,220 @@
+import math
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import summarizer
+from src.benchmark import make_synthetic_prevalence, to_raw_export
+from src.data_loader import build_cube, normalize_table
+from src.index import PrevalenceIndex
+
+
+def _legacy_summarize_prevalence(subset: pd.DataFrame) -> Dict[str, Any]:
+    """
+    The original groupby.apply implementation of summarize_prevalence,
+    kept as the reference the vectorized version must agree with.
+    """
+    if subset.empty:
+        return {"has_data": False}
+
+    year_grp = (
+        subset.groupby("year")
+        .apply(
+            lambda g: pd.Series(
+                {
+                    "n_samples": int(g["n_samples"].sum()),
+                    "mean_prevalence": float(
+                        (g["prevalence"] * g["n_samples"]).sum()
+                        / max(g["n_samples"].sum(), 1)
+                    ),
+                }
+            )
+        )
+        .reset_index()
+        .sort_values("year")
+    )
+
+    site_grp = (
+        subset.groupby(["site", "country"])
+        .apply(
+            lambda g: pd.Series(
+                {
+                    "n_samples": int(g["n_samples"].sum()),
+                    "mean_prevalence": float(
+                        (g["prevalence"] * g["n_samples"]).sum()
+                        / max(g["n_samples"].sum(), 1)
+                    ),
+                    "first_year": int(g["year"].min()),
+                    "last_year": int(g["year"].max()),
+                }
+            )
+        )
+        .reset_index()
+        .sort_values("mean_prevalence", ascending=False)
+    )
+
+    study_grp = (
+        subset.groupby(["study_id", "authors", "year_pub"])
+        .agg(
+            n_samples=("n_samples", "sum"),
+            year_min=("year", "min"),
+            year_max=("year", "max"),
+            mean_prev=("prevalence", "mean"),
+        )
+        .reset_index()
+        .sort_values("year_pub")
+    )
+
+    return {
+        "has_data": True,
+        "yearly": year_grp.to_dict(orient="records"),
+        "by_site": site_grp.to_dict(orient="records"),
+        "by_study": study_grp.to_dict(orient="records"),
+    }
+
+
+def _records_match(a: List[Dict[str, Any]], b: List[Dict[str, Any]], keys: List[str]) -> bool:
+    """
+    Compare two record lists regardless of tie order, with a small
+    tolerance on floats (summation order differs between implementations).
+    """
+    if len(a) != len(b):
+        return False
+
+    def key(r):
+        return tuple(str(r[k]) for k in keys)
+
+    for ra, rb in zip(sorted(a, key=key), sorted(b, key=key)):
+        if ra.keys() != rb.keys():
+            return False
+        for k in ra:
+            va, vb = ra[k], rb[k]
+            if isinstance(va, float) or isinstance(vb, float):
+                if math.isnan(va) and math.isnan(vb):
+                    continue
+                if not math.isclose(va, vb, rel_tol=1e-9, abs_tol=1e-12):
+                    return False
+            elif va != vb:
+                return False
+    return True
+
+
+def _assert_matches_legacy(new: Dict[str, Any], subset: pd.DataFrame) -> None:
+    old = _legacy_summarize_prevalence(subset)
+    assert new["has_data"] == old["has_data"]
+    if not old["has_data"]:
+        return
+    assert _records_match(new["yearly"], old["yearly"], ["year"]), "yearly differs"
+    assert _records_match(new["by_site"], old["by_site"], ["site", "country"]), "by_site differs"
+    assert _records_match(new["by_study"], old["by_study"], ["study_id", "authors", "year_pub"]), "by_study differs"
+    assert [r["year"] for r in new["yearly"]] == [r["year"] for r in old["yearly"]]
+
+
+@pytest.fixture(scope="module")
+def table():
+    raw = to_raw_export(make_synthetic_prevalence(20_000))
+    # Missing prevalences, including studies with no prevalence at all
+    raw.loc[::7, "prevalence"] = np.nan
+    df = normalize_table(raw)
+    df.loc[df["study_id"] == df["study_id"].iloc[0], "prevalence"] = np.nan
+    return df
+
+
+def _paths(df: pd.DataFrame, query: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    The summary of query from a subset table, from row positions (scan
+    and index) and from the cube.
+    """
+    return {
+        "subset": summarizer.summarize_prevalence(summarizer.filter_data(df, query)),
+        "scan": summarizer.summarize_rows(df, summarizer.select_rows(df, query)),
+        "index": summarizer.summarize_rows(df, summarizer.select_rows(df, query, PrevalenceIndex(df))),
+        "cube": summarizer.summarize_cube(build_cube(df), query),
+    }
+
+
+def _legacy_subset(df: pd.DataFrame, country: str = None, mutation: str = None) -> pd.DataFrame:
+    mask = np.ones(len(df), dtype=bool)
+    if country is not None:
+        mask &= (df["country"].astype(str).str.lower() == country.lower()).to_numpy()
+    if mutation is not None:
+        mask &= (df["mutation"].astype(str) == mutation).to_numpy()
+    return df[mask]
+
+
+def test_whole_table_matches_legacy_with_nan_prevalences(table):
+    assert table["prevalence"].isna().any()
+    _assert_matches_legacy(summarizer.summarize_rows(table), table)
+    _assert_matches_legacy(summarizer.summarize_prevalence(table), table)
+
+
+def test_all_nan_study_keeps_nan_mean(table):
+    study = table["study_id"].iloc[0]
+    by_study = summarizer.summarize_prevalence(table)["by_study"]
+    (record,) = [r for r in by_study if r["study_id"] == study]
+    assert math.isnan(record["mean_prev"])
+
+
+@pytest.mark.parametrize("country", ["Uganda", "uganda", "uGaNdA", "UGANDA"])
+def test_mixed_case_country_matches_legacy(table, country):
+    mutation = table["mutation"].value_counts().index[0]
+    subset = _legacy_subset(table, country, mutation)
+    assert len(subset)
+    for path, summary in _paths(table, {"country": country, "mutation": mutation}).items():
+        try:
+            _assert_matches_legacy(summary, subset)
+        except AssertionError as e:
+            raise AssertionError(f"{path}: {e}") from None
+
+
+def test_broad_query_matches_legacy_on_every_path(table):
+    mutation = table["mutation"].value_counts().index[0]
+    subset = _legacy_subset(table, mutation=mutation)
+    for path, summary in _paths(table, {"mutation": mutation}).items():
+        try:
+            _assert_matches_legacy(summary, subset)
+        except AssertionError as e:
+            raise AssertionError(f"{path}: {e}") from None
+
+
+def test_year_pub_ties_keep_the_same_studies_in_order(table):
+    years = table.drop_duplicates("study_id")["year_pub"]
+    assert years.duplicated().any()
+    old = _legacy_summarize_prevalence(table)["by_study"]
+    for path, summary in _paths(table, {}).items():
+        new = summary["by_study"]
+        # Ties may come out in any order, but the set and the ordering
+        # by publication year must agree
+        assert [r["year_pub"] for r in new] == [r["year_pub"] for r in old], path
+        for year in {r["year_pub"] for r in old}:
+            assert {r["study_id"] for r in new if r["year_pub"] == year} == {
+                r["study_id"] for r in old if r["year_pub"] == year
+            }, path
+
+
+def test_no_match_has_no_data(table):
+    for summary in _paths(table, {"country": "Atlantis"}).values():
+        assert summary == {"has_data": False}
+
+
+def test_rows_of_string_columns_match_the_subset():
+    # make_synthetic_prevalence keeps plain string columns, not categoricals
+    df = make_synthetic_prevalence(5_000)
+    query = {"mutation": df["mutation"].iloc[0]}
+    subset = summarizer.filter_data(df, query)
+    _assert_matches_legacy(summarizer.summarize_rows(df, summarizer.select_rows(df, query)), subset)
+
+
+@pytest.mark.parametrize("country", [" Uganda", "uganda ", "  UGANDA  "])
+def test_padded_labels_match_on_every_path(country):
+    df = make_synthetic_prevalence(5_000)
+    # Some rows carry a padded spelling of the same country
+    df.loc[df.index[::2], "country"] = df.loc[df.index[::2], "country"].str.pad(8, side="left")
+    df = normalize_table(to_raw_export(df))
+    mask = (df["country"].astype(str).str.strip() == "Uganda").to_numpy()
+    assert mask.sum() and (df["country"].astype(str) != "Uganda")[mask].any()
+
+    for path, summary in _paths(df, {"country": country}).items():
+        assert sum(r["n_samples"] for r in summary["yearly"]) == df["n_samples"][mask].sum(), path